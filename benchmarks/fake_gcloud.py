@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""Stand-in for gcloud, ssh and scp that emulates a fleet from a local directory tree.
+
+benchmarks/orchestration.py puts this script on PATH as gcloud, ssh and scp.
+Instances are the directories $FAKE_GCLOUD_ROOT/fleet/<project>/<zone>/<instance>.
+Remote commands are recognised by the ishield command they come from rather
+than executed, so no docker or clamscan is needed. Behaviour is set through
+environment variables:
+
+    FAKE_GCLOUD_ROOT          state directory (required)
+    FAKE_GCLOUD_LATENCY       seconds added to every call (default 0)
+    FAKE_GCLOUD_JITTER        +/- seconds of uniform jitter on that latency (default 0)
+    FAKE_GCLOUD_FAILURE_RATE  fraction of calls that fail like a dropped connection (default 0)
+    FAKE_GCLOUD_HANG_RATE     fraction of calls that hang like a stuck IAP tunnel (default 0)
+    FAKE_GCLOUD_DOWN_ZONES    comma-separated zones whose IAP endpoint refuses every connection
+    FAKE_GCLOUD_SCAN_SECONDS  scan duration (default 5)
+    FAKE_GCLOUD_SCAN_JITTER   +/- fraction of jitter on the scan duration (default 0)
+    FAKE_GCLOUD_FINDING_RATE  fraction of instances with findings (default 0)
+    FAKE_GCLOUD_STOPPED_RATE  fraction of instances listed as TERMINATED (default 0)
+
+Every call appends its kind to $FAKE_GCLOUD_ROOT/calls.log.
+"""
+import json
+import os
+import random
+import re
+import sys
+import time
+import zlib
+
+ROOT = os.environ['FAKE_GCLOUD_ROOT']
+FLEET = os.path.join(ROOT, 'fleet')
+TUNNELS = os.path.join(ROOT, 'tunnels')
+# Used by the scheduler to estimate scan time from filesystem size (ishield.ASSUMED_SCAN_BYTES_PER_SECOND)
+ASSUMED_SCAN_BYTES_PER_SECOND = 25 * 1024 * 1024
+
+
+def setting(name: str, default: float) -> float:
+    return float(os.environ.get(f'FAKE_GCLOUD_{name}', default))
+
+
+def option(args, name: str):
+    for arg in args:
+        if arg.startswith(name + '='):
+            return arg.split('=', 1)[1]
+    return None
+
+
+def log_call(kind: str) -> None:
+    # Short O_APPEND writes do not interleave between concurrent processes
+    with open(os.path.join(ROOT, 'calls.log'), 'a') as f:
+        f.write(kind + '\n')
+
+
+def delay() -> None:
+    latency = setting('LATENCY', 0) + random.uniform(-1, 1) * setting('JITTER', 0)
+    if latency > 0:
+        time.sleep(latency)
+
+
+def fail(message: str) -> None:
+    sys.stderr.write(message + '\n')
+    sys.exit(255)
+
+
+def misbehave(zone: str) -> None:
+    """Fail or hang the call as the failure settings ask."""
+    if zone in os.environ.get('FAKE_GCLOUD_DOWN_ZONES', '').split(','):
+        fail('ERROR: (gcloud.compute.start-iap-tunnel) Error while connecting [4003: \'failed to connect to backend\'].')
+    if random.random() < setting('HANG_RATE', 0):
+        time.sleep(3600)
+
+
+def instance_seed(instance: str) -> int:
+    """Stable per-instance number so repeated runs see the same fleet."""
+    return zlib.crc32(instance.encode())
+
+
+def filter_term_matches(term: str, instance: dict) -> bool:
+    """One term of the filters ishield builds: name ~ "regex", status=X or labels.key=value."""
+    if term.startswith('name ~ '):
+        return re.search(term[len('name ~ '):].strip('"').replace('\\"', '"'), instance['name']) is not None
+    field, _, value = term.partition('=')
+    if field == 'status':
+        return instance['status'] == value
+    if field.startswith('labels.'):
+        return instance['labels'].get(field[len('labels.'):]) == value
+    return True
+
+
+def filter_matches(expression: str, instance: dict) -> bool:
+    """Evaluate an AND of parenthesised OR groups, the only form ishield sends."""
+    return all(
+        any(filter_term_matches(term.strip(), instance) for term in group.strip().strip('()').split(' OR '))
+        for group in expression.split(' AND ')
+    )
+
+
+def list_instances(args) -> None:
+    project = option(args, '--project')
+    project_dir = os.path.join(FLEET, project)
+    if not os.path.isdir(project_dir):
+        sys.stderr.write(f"ERROR: (gcloud.compute.instances.list) project {project} not found\n")
+        sys.exit(1)
+    instances = []
+    for zone in sorted(os.listdir(project_dir)):
+        for instance in sorted(os.listdir(os.path.join(project_dir, zone))):
+            stopped = instance_seed(instance) % 100 < setting('STOPPED_RATE', 0) * 100
+            instances.append({
+                'name': instance,
+                'zone': f'https://www.googleapis.com/compute/v1/projects/{project}/zones/{zone}',
+                'status': 'TERMINATED' if stopped else 'RUNNING',
+                'labels': {}
+            })
+    expression = option(args, '--filter')
+    if expression:
+        instances = [instance for instance in instances if filter_matches(expression, instance)]
+    print(json.dumps(instances))
+
+
+def start_tunnel(args) -> None:
+    import socket
+    misbehave(option(args, '--zone'))
+    instance_dir = os.path.join(FLEET, option(args, '--project'), option(args, '--zone'), args[2])
+    port = int(option(args, '--local-host-port').rsplit(':', 1)[1])
+    os.makedirs(TUNNELS, exist_ok=True)
+    with open(os.path.join(TUNNELS, str(port)), 'w') as f:
+        f.write(instance_dir)
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('localhost', port))
+    server.listen(64)
+    while True:
+        connection, _ = server.accept()
+        connection.close()
+
+
+def tunnel_instance(port: str) -> str:
+    with open(os.path.join(TUNNELS, port)) as f:
+        return f.read()
+
+
+def scan_state(instance_dir: str, name: str = 'scan.json'):
+    try:
+        with open(os.path.join(instance_dir, name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def start_scan(instance_dir: str) -> None:
+    if os.path.exists(os.path.join(instance_dir, 'scan.fetched.json')):
+        os.remove(os.path.join(instance_dir, 'scan.fetched.json'))
+    seconds = setting('SCAN_SECONDS', 5) * (1 + random.uniform(-1, 1) * setting('SCAN_JITTER', 0))
+    with open(os.path.join(instance_dir, 'scan.json'), 'w') as f:
+        json.dump({'started': time.time(), 'seconds': max(seconds, 0)}, f)
+
+
+def scan_remaining(instance_dir: str) -> float:
+    state = scan_state(instance_dir)
+    return state['started'] + state['seconds'] - time.time() if state else 0
+
+
+def findings(instance: str):
+    if instance_seed(instance) % 10000 >= setting('FINDING_RATE', 0) * 10000:
+        return []
+    return [{'path': f'/var/www/uploads/{instance}-{n}.php', 'signature': 'Php.Webshell-1'}
+            for n in range(1 + instance_seed(instance) % 3)]
+
+
+def scan_log(instance: str) -> bytes:
+    lines = [f"/host{finding['path']}: {finding['signature']} FOUND" for finding in findings(instance)]
+    lines += ['', '----------- SCAN SUMMARY -----------'] + summary_lines(instance)
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def summary_fields(instance: str):
+    seed = instance_seed(instance)
+    return {
+        'known_viruses': 8700000,
+        'engine_version': '1.4.1',
+        'scanned_directories': 4000 + seed % 1000,
+        'scanned_files': 40000 + seed % 20000,
+        'infected_files': len(findings(instance)),
+        'data_scanned': f"{2000 + seed % 3000}.00 MB",
+        'data_read': f"{1500 + seed % 2000}.00 MB (ratio 1.33:1)",
+        'time': "5.000 sec (0 m 5 s)",
+        'start_date': "2026:10:17 00:00:00",
+        'end_date': "2026:10:17 00:00:05"
+    }
+
+
+def summary_lines(instance: str):
+    return [f"{name.replace('_', ' ').title()}: {value}" for name, value in summary_fields(instance).items()]
+
+
+def result_files(instance_dir: str, state=None):
+    """The files run_clamav_scan.sh leaves in ~/clamav-logs, keyed by name."""
+    import gzip
+    instance = os.path.basename(instance_dir)
+    state = state or scan_state(instance_dir) or {'seconds': 0}
+    instance_findings = findings(instance)
+    files = {
+        'summary.json': json.dumps({
+            'complete': True,
+            'scan_type': 'full',
+            'scan_mode': 'single',
+            'db_version': '27431',
+            'duration_seconds': round(state['seconds']),
+            'summary': summary_fields(instance),
+            'findings': instance_findings
+        }).encode(),
+        'scan_info.log': (f"scan_type=full\nfull_reason=no previous manifest\ndb_version=27431\n"
+                          f"scan_seconds={round(state['seconds'])}\n").encode(),
+        'manifest.tsv.gz': gzip.compress(b''),
+    }
+    if instance_findings:
+        files['scan.log.gz'] = gzip.compress(scan_log(instance))
+    return files
+
+
+def run_command(instance_dir: str, command: str) -> None:
+    """Emulate a remote command from ishield on the instance."""
+    instance = os.path.basename(instance_dir)
+    if 'run_clamav_scan.sh "$TARGET_HOME"' in command:
+        if not sys.stdin.isatty():
+            sys.stdin.buffer.read()
+        start_scan(instance_dir)
+        if 'df ' in command:
+            print(int(setting('SCAN_SECONDS', 5) * ASSUMED_SCAN_BYTES_PER_SECOND))
+    elif 'echo idle' in command:
+        if scan_state(instance_dir) is None:
+            print('idle')
+        else:
+            print('running' if scan_remaining(instance_dir) > 0 else 'finished')
+    elif 'findings.live' in command:
+        stream_findings(instance_dir, command)
+    elif 'docker ps' in command:
+        wait = re.search(r'timeout (\d+) sudo docker wait', command)
+        remaining = scan_remaining(instance_dir)
+        if wait and remaining > 0:
+            time.sleep(min(remaining, int(wait.group(1))))
+            remaining = scan_remaining(instance_dir)
+        if remaining > 0:
+            print('abc123 clamav/clamav:latest "clamscan" clamav-manual')
+    elif 'tar -czf -' in command:
+        import io
+        import tarfile
+        # A retry after the logs were moved aside archives ~/clamav-logs.fetched
+        state = scan_state(instance_dir) or scan_state(instance_dir, 'scan.fetched.json')
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+            for name, content in result_files(instance_dir, state).items():
+                info = tarfile.TarInfo(f'./{name}')
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        sys.stdout.buffer.write(buffer.getvalue())
+        if 'clamav-logs.fetched' in command and os.path.exists(os.path.join(instance_dir, 'scan.json')):
+            os.replace(os.path.join(instance_dir, 'scan.json'), os.path.join(instance_dir, 'scan.fetched.json'))
+    elif 'cat ~/clamav-archive/scan.log.gz' in command:
+        import gzip
+        sys.stdout.buffer.write(gzip.compress(scan_log(instance)))
+    elif command.startswith('sudo rm -rf ~/clamav-logs'):
+        if os.path.exists(os.path.join(instance_dir, 'scan.json')):
+            os.remove(os.path.join(instance_dir, 'scan.json'))
+
+
+def live_findings(instance_dir: str):
+    """Findings the running scan has streamed so far: finding k of n at (k + 1) / (n + 1) of the scan."""
+    state = scan_state(instance_dir)
+    if state is None:
+        return []
+    instance_findings = findings(os.path.basename(instance_dir))
+    elapsed = time.time() - state['started']
+    return [finding for number, finding in enumerate(instance_findings)
+            if elapsed >= state['seconds'] * (number + 1) / (len(instance_findings) + 1)]
+
+
+def stream_findings(instance_dir: str, command: str) -> None:
+    """Emulate STREAM_WAIT_COMMAND and STREAM_STATUS_COMMAND: wait for a new finding or the
+    end of the scan, then report whether it runs and the findings after the first seen."""
+    seen = int(re.search(r'NR > (\d+)', command).group(1))
+    wait = re.search(r'timeout (\d+) sh -c', command)
+    if wait:
+        deadline = time.time() + int(wait.group(1))
+        while (scan_remaining(instance_dir) > 0 and len(live_findings(instance_dir)) <= seen
+               and time.time() < deadline):
+            time.sleep(min(0.5, max(deadline - time.time(), 0)))
+    if scan_remaining(instance_dir) > 0:
+        print('abc123 clamav/clamav:latest "clamscan" clamav-manual')
+    for finding in live_findings(instance_dir)[seen:]:
+        print(f"LIVE /host{finding['path']}: {finding['signature']} FOUND")
+
+
+def copy_files(instance_dir: str, source: str, destination: str) -> None:
+    """Emulate scp: uploads are discarded, downloads of ~/clamav-logs/* get the scan results."""
+    if ':' in source and 'clamav-logs' in source:
+        for name, content in result_files(instance_dir).items():
+            with open(os.path.join(destination, name), 'wb') as f:
+                f.write(content)
+
+
+def main() -> None:
+    program = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+
+    if program in ('ssh', 'scp'):
+        if '-O' in args:
+            log_call(f'{program} -O')
+            return
+        log_call(program)
+        delay()
+        if random.random() < setting('FAILURE_RATE', 0):
+            fail('Connection closed by remote host')
+        instance_dir = tunnel_instance(args[args.index('-P' if program == 'scp' else '-p') + 1])
+        misbehave(os.path.basename(os.path.dirname(instance_dir)))
+        if program == 'ssh':
+            run_command(instance_dir, args[-1])
+        else:
+            copy_files(instance_dir, args[-2], args[-1])
+        return
+
+    kind = ' '.join(args[:3]) if args[:2] == ['compute', 'instances'] else ' '.join(args[:2])
+    log_call(f'gcloud {kind}')
+    delay()
+    if args[:3] == ['compute', 'instances', 'list']:
+        list_instances(args)
+        return
+    if args[:2] == ['compute', 'start-iap-tunnel']:
+        start_tunnel(args)
+        return
+    if random.random() < setting('FAILURE_RATE', 0):
+        fail(f'ERROR: ({kind.replace(" ", ".")}) [ssh] exited with return code [255].')
+    misbehave(option(args, '--zone'))
+    if args[:2] == ['compute', 'ssh']:
+        command = args[args.index('--command') + 1]
+        instance = [arg for arg in args[2:] if not arg.startswith('-') and arg != command][0]
+        run_command(os.path.join(FLEET, option(args, '--project'), option(args, '--zone'), instance), command)
+    elif args[:2] == ['compute', 'scp']:
+        source, destination = args[-2], args[-1]
+        instance = (source if ':' in source else destination).split(':', 1)[0]
+        copy_files(os.path.join(FLEET, option(args, '--project'), option(args, '--zone'), instance),
+                   source, destination)
+    else:
+        fail(f"fake gcloud: unsupported command: {' '.join(args)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Wall time, subprocess count and peak memory of a full ishield run against a simulated fleet.
+
+Puts benchmarks/fake_gcloud.py on PATH as gcloud, ssh and scp, builds a fake
+fleet of the requested size and runs ishield.main() against it, one fresh
+process per fleet size, without touching GCP.
+
+    python benchmarks/orchestration.py --instances 10 100 1000 10000
+    python benchmarks/orchestration.py --instances 1000 --latency 0.5 --jitter 0.2 --failure-rate 0.01 --pool
+    python benchmarks/orchestration.py --instances 1000 --workers 4
+
+With --workers, a coordinator (--coordinate) and that many worker processes
+(--work) share the fleet; peak MB is then that of the largest process.
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+FAKE_GCLOUD = Path(__file__).resolve().parent / "fake_gcloud.py"
+ZONES_PER_PROJECT = 3
+
+
+def build_fleet(root: Path, instance_count: int, project_count: int) -> list:
+    """Create the fake-instance directory tree and return the project names."""
+    projects = [f"bench-project-{number}" for number in range(min(project_count, instance_count))]
+    for number in range(instance_count):
+        project = projects[number % len(projects)]
+        zone = f"us-central1-{'abc'[(number // len(projects)) % ZONES_PER_PROJECT]}"
+        (root / "fleet" / project / zone / f"bench-{number:05d}").mkdir(parents=True)
+    return projects
+
+
+def build_path(root: Path) -> str:
+    """A PATH with the fake gcloud, ssh and scp in front of everything else."""
+    bin_dir = root / "bin"
+    bin_dir.mkdir()
+    for name in ('gcloud', 'ssh', 'scp'):
+        (bin_dir / name).symlink_to(FAKE_GCLOUD)
+    return f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+
+
+def measure(instance_count: int, args) -> dict:
+    """Run ishield against a fresh fleet of instance_count instances in a child process."""
+    with contextlib.ExitStack() as stack:
+        if args.keep:
+            root = Path(args.keep) / f"fleet-{instance_count}"
+            root.mkdir(parents=True)
+        else:
+            root = Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="ishield-bench-")))
+        projects = build_fleet(root, instance_count, args.projects)
+        (root / "work").mkdir()
+        env = dict(
+            os.environ,
+            PATH=build_path(root),
+            FAKE_GCLOUD_ROOT=str(root),
+            FAKE_GCLOUD_LATENCY=str(args.latency),
+            FAKE_GCLOUD_JITTER=str(args.jitter),
+            FAKE_GCLOUD_FAILURE_RATE=str(args.failure_rate),
+            FAKE_GCLOUD_HANG_RATE=str(args.hang_rate),
+            FAKE_GCLOUD_DOWN_ZONES=','.join(args.down_zones),
+            FAKE_GCLOUD_SCAN_SECONDS=str(args.scan_seconds),
+            FAKE_GCLOUD_SCAN_JITTER=str(args.scan_jitter),
+            FAKE_GCLOUD_FINDING_RATE=str(args.finding_rate),
+            FAKE_GCLOUD_STOPPED_RATE=str(args.stopped_rate)
+        )
+        config = {
+            'PROJECTS': projects,
+            'INSTANCE_FILTERS': ['bench-*'],
+            'USE_CONNECTION_POOL': args.pool,
+            'MIN_CHECK_INTERVAL': 1,
+            'MAX_CHECK_INTERVAL': max(5, int(args.scan_seconds)),
+            'DEFAULT_EXPECTED_SCAN_SECONDS': args.scan_seconds,
+            'LONG_POLL_TIMEOUT': args.long_poll,
+            'STREAM_FINDINGS': args.stream_findings
+        }
+        if args.workers:
+            config.update(QUEUE_POLL_INTERVAL=1, LEASE_HEARTBEAT_INTERVAL=5)
+        if args.deadline:
+            config['CALL_DEADLINES'] = dict.fromkeys(('list', 'deploy', 'status', 'probe', 'fetch', 'cleanup', 'default'),
+                                                     args.deadline)
+        command = [sys.executable, __file__, '--run', str(root / "work"), json.dumps(config)]
+        if args.workers:
+            processes = [subprocess.Popen(command + ['--coordinate'], env=env, stdout=subprocess.PIPE, text=True)]
+            processes += [subprocess.Popen(command + ['--work'], env=env, stdout=subprocess.PIPE, text=True)
+                          for _ in range(args.workers)]
+            outputs = [process.communicate()[0].split() for process in processes]
+            if any(process.returncode for process in processes):
+                raise RuntimeError(f"A coordinated run failed, see the logs in {root / 'work'}")
+        else:
+            outputs = [subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout.split()]
+        calls = Counter((root / "calls.log").read_text().splitlines())
+    return {
+        'seconds': float(outputs[0][-2]),
+        'peak_mb': max(float(output[-1]) for output in outputs),
+        'subprocesses': sum(calls.values()),
+        'calls': calls
+    }
+
+
+def run(work_dir: str, config: str, *argv: str) -> None:
+    """Run ishield.main(argv) in work_dir with config applied, then print wall time and peak RSS."""
+    # ishield writes its scripts, results and report under the working directory at import
+    os.chdir(work_dir)
+    sys.path.insert(0, str(REPO))
+    started = time.perf_counter()
+    log_name = f'ishield-worker-{os.getpid()}.log' if '--work' in argv else 'ishield.log'
+    with open(log_name, 'w') as log, contextlib.redirect_stdout(log):
+        import ishield
+        for name, value in json.loads(config).items():
+            setattr(ishield, name, value)
+        ishield.main(list(argv))
+    elapsed = time.perf_counter() - started
+    # ru_maxrss is in kilobytes on Linux
+    print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0], allow_abbrev=False)
+    parser.add_argument('--instances', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--projects', type=int, default=4, help='projects the fleet is spread over')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds added to every gcloud/ssh call')
+    parser.add_argument('--jitter', type=float, default=0.1, help='+/- seconds of jitter on that latency')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of calls that fail')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='fraction of calls that hang')
+    parser.add_argument('--down-zones', nargs='+', default=[], metavar='ZONE',
+                        help='zones whose IAP endpoint refuses every connection')
+    parser.add_argument('--scan-seconds', type=float, default=5.0, help='simulated scan duration')
+    parser.add_argument('--scan-jitter', type=float, default=0.5, help='+/- fraction of jitter on the scan duration')
+    parser.add_argument('--finding-rate', type=float, default=0.05, help='fraction of instances with findings')
+    parser.add_argument('--stopped-rate', type=float, default=0.0, help='fraction of instances listed as TERMINATED')
+    parser.add_argument('--long-poll', type=int, default=5, help='LONG_POLL_TIMEOUT for the run')
+    parser.add_argument('--deadline', type=float, help='CALL_DEADLINES for every operation, in seconds')
+    parser.add_argument('--pool', action='store_true', help='enable USE_CONNECTION_POOL')
+    parser.add_argument('--workers', type=int, default=0, help='run coordinated, with this many worker processes')
+    parser.add_argument('--stream-findings', action='store_true', help='enable STREAM_FINDINGS')
+    parser.add_argument('--keep', metavar='DIR', help='keep each fleet, its ishield.log and report under DIR')
+    parser.add_argument('--run', nargs='+', metavar='ARG', help=argparse.SUPPRESS)
+    # The ishield arguments after --run WORK_DIR CONFIG start with dashes themselves
+    args, ishield_args = parser.parse_known_args()
+
+    if args.run:
+        run(*args.run, *ishield_args)
+        return
+    if ishield_args:
+        parser.error(f"unrecognized arguments: {' '.join(ishield_args)}")
+
+    print(f"{'instances':>9} {'seconds':>8} {'peak MB':>8} {'processes':>9}  calls")
+    for count in args.instances:
+        result = measure(count, args)
+        calls = ", ".join(f"{kind} {number}" for kind, number in sorted(result['calls'].items()))
+        print(f"{count:>9} {result['seconds']:>8.2f} {result['peak_mb']:>8.1f} {result['subprocesses']:>9}  {calls}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Render time and peak memory of the PDF report against fleet size.
+
+Compares the direct structured-report path (write_pdf_report) with the
+markdown round trip (write_markdown_report + convert_markdown_to_pdf).
+
+    python benchmarks/report_render.py --instances 100 1000 5000
+"""
+import argparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from reportgen import convert_markdown_to_pdf, write_markdown_report, write_pdf_report  # noqa: E402
+
+
+def synthetic_report(instance_count: int, seed: int = 1) -> dict:
+    """A report where 5% of instances have findings and a few have thousands."""
+    rng = random.Random(seed)
+    instances = []
+    for number in range(instance_count):
+        findings = []
+        if rng.random() < 0.05:
+            count = 5000 if rng.random() < 0.02 else rng.randint(1, 20)
+            findings = [f"/var/www/uploads/file-{n}.php: Php.Webshell-{n % 7} FOUND" for n in range(count)]
+            findings.append(f"Infected files: {count}")
+        instances.append({
+            'name': f"instance-{number}",
+            'fields': [
+                ("Project", f"project-{number % 40}"),
+                ("Zone", f"us-central1-{'abc'[number % 3]}"),
+                ("Scan type", "full (no previous manifest)"),
+                ("Signature database", "version 27431"),
+                ("Scanned", "152000 files, 12.4 GB in 0 h 41 m"),
+            ],
+            'findings': findings,
+            'note': "Please review the full logs for more details: ./results/example/scan.log.gz" if findings else None
+        })
+    return {
+        'title': "Generated by InterstellarShield",
+        'generated': f"Report generated: {time.strftime('%Y-%m-%d %H:%M:%S')}",
+        'sections': [{'heading': "Summary", 'bullets': [f"Total instances scanned: {instance_count}"]}],
+        'instances': instances
+    }
+
+
+def measure(path: str, instance_count: int):
+    """(seconds, peak RSS MB) of rendering one report, in a fresh process so
+    neither the timing nor the memory peak carries over between runs."""
+    output = subprocess.run(
+        [sys.executable, __file__, '--render', path, str(instance_count)],
+        capture_output=True, text=True, check=True
+    ).stdout.split()
+    return float(output[-2]), float(output[-1])
+
+
+def render(path: str, instance_count: int) -> None:
+    """Render one synthetic report and print its render time and peak RSS."""
+    report = synthetic_report(instance_count)
+    with tempfile.TemporaryDirectory() as directory:
+        md_file = os.path.join(directory, 'report.md')
+        pdf_file = os.path.join(directory, 'report.pdf')
+        started = time.perf_counter()
+        if path == 'direct':
+            write_pdf_report(report, pdf_file)
+        else:
+            markdown_round_trip(report, md_file, pdf_file)
+        elapsed = time.perf_counter() - started
+    # ru_maxrss is in kilobytes on Linux
+    print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def markdown_round_trip(report, md_file, pdf_file):
+    write_markdown_report(report, md_file)
+    convert_markdown_to_pdf(md_file, pdf_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--instances', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--skip-markdown', action='store_true', help='only time the direct path')
+    parser.add_argument('--render', nargs=2, metavar=('PATH', 'INSTANCES'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.render:
+        render(args.render[0], int(args.render[1]))
+        return
+
+    print(f"{'instances':>9}  {'path':<10} {'seconds':>8} {'peak MB':>8}")
+    for count in args.instances:
+        for path in ('direct',) if args.skip_markdown else ('direct', 'markdown'):
+            seconds, peak = measure(path, count)
+            print(f"{count:>9}  {path:<10} {seconds:>8.2f} {peak:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
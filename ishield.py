@@ -1,53 +1,941 @@
 #!/usr/bin/env python3
 import subprocess
 import json
-from typing import List, Dict
+import io
+import tarfile
+import getpass
+import socket
+import tempfile
+import shutil
+import heapq
+import statistics
+import shlex
+import argparse
+import signal
+import sqlite3
+import gzip
+import fnmatch
+import fcntl
+import re
+import random
+import zlib
+from typing import Collection, List, Dict, Optional, Union
 import time
 import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from collections import Counter
 from pathlib import Path
-from reportgen import convert_markdown_to_pdf
+from reportgen import instance_markdown, write_markdown_report, write_pdf_report
+from scanlog import FileResult, InstanceResults, ScanSummary, open_scan_log, parse_scan_log, records_from_summary
+from resultsindex import ResultsIndex
+from runmetrics import RunMetrics
+from runjournal import RunJournal, read_journal
+from workqueue import WorkQueue
+from logarchive import LogArchive
 
 # Projects and Instance names to scan
 # REPLACE THESE VALUES WITH YOUR PROJECT NAMES AND INSTANCE FILTER PATTERNS
 PROJECTS = ['<PROJECT_NAME_1>', '<PROJECT_NAME_2>', '<PROJECT_NAME_3>'] # Replace me!
 INSTANCE_FILTERS = ['<INSTANCE_FILTER_PATTERN_1>','<INSTANCE_FILTER_PATTERN_2>'] # Replace me!
+# Instance filters are globs matched against the whole name (web-*, db-?),
+# or regular expressions prefixed with re: (re:^web-[0-9]+$). Use ['*'] to
+# scan every instance; an empty list scans none. Filters used to match any
+# part of the name, so 'web' must now be written '*web*'. Only instances in
+# one of INSTANCE_STATUSES with every label in INSTANCE_LABELS are scanned. All three are sent to the
+# Compute API as a --filter and checked again locally.
+INSTANCE_STATUSES = ['RUNNING']
+INSTANCE_LABELS = {}  # Such as {'env': 'prod'}
+
+# Concurrency limits for gcloud operations (ssh/scp over IAP).
+# Keep these below your IAP tunnel and Compute API quotas.
+MAX_CONCURRENT_OPERATIONS = 32   # Across the whole fleet
+MAX_CONCURRENT_PER_PROJECT = 16  # Within a single project
+MAX_CONCURRENT_PER_ZONE = 8      # Within a single zone of a project
+MAX_WORKER_THREADS = 128         # Threads available to wait on the limits above
+
+# Deadlines in seconds for each kind of gcloud/ssh/scp call, including retries.
+# Calls that fail because the instance or its IAP endpoint is unreachable, time
+# out or hit a quota are retried with jittered exponential backoff until their
+# deadline; deploys are not, as a failed attempt may still have started a scan.
+# After BREAKER_FAILURE_THRESHOLD connection failures in a row in one zone its
+# circuit breaker opens: calls to the zone fail at once for BREAKER_COOLDOWN
+# seconds, then a single trial call decides whether it closes again.
+CALL_DEADLINES = {
+    'list': 120,
+    'deploy': 300,
+    'status': 60,     # Plus LONG_POLL_TIMEOUT for long polls
+    'probe': 60,
+    'fetch': 900,
+    'cleanup': 120,
+    'image': 1800,    # Whole resumable upload of a tunnelled scan image
+    'default': 300
+}
+RETRIED_OPERATIONS = ('list', 'status', 'probe', 'fetch', 'cleanup')
+CALL_ATTEMPTS = 3
+RETRY_BASE_DELAY = 2       # Seconds, doubled on every attempt
+RETRY_MAX_DELAY = 30       # Seconds
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN = 300     # Seconds
+MAX_STATUS_FAILURES = 10   # Failed status checks in a row before an instance's scan is abandoned
+
+# Stream the scan script over stdin of a single ssh session and fetch results as
+# a single archive (two IAP tunnels per instance instead of five). The fetch
+# moves the results aside on the instance rather than deleting them, so a fetch
+# whose connection drops can be retried without losing them; the next deploy
+# removes them.
+# Set to False to fall back to separate scp/ssh calls for each step.
+SINGLE_SESSION_TRANSFER = True
+
+# The scan script writes a compact summary.json with findings and statistics,
+# and keeps the full scan log gzip'd. 'findings' transfers the full log only
+# from instances with findings, 'always' from every instance, 'never' from
+# none. Logs not transferred stay on the instance until its next scan and can
+# be fetched with --fetch-full-log.
+FULL_LOG_TRANSFER = 'findings'
+
+# Reuse one IAP tunnel (gcloud compute start-iap-tunnel) and one SSH
+# ControlMaster connection per instance for every phase, instead of building a
+# new tunnel and key exchange for each gcloud compute ssh/scp call.
+# Plain ssh authenticates with SSH_KEY_FILE as SSH_USER; set SSH_USER to your
+# POSIX username when the project uses OS Login. Daemon mode always pools.
+USE_CONNECTION_POOL = False
+MAX_OPEN_TUNNELS = 64       # Least recently used idle tunnels are closed above this
+TUNNEL_IDLE_TIMEOUT = 900   # Seconds before an unused tunnel is closed
+TUNNEL_START_TIMEOUT = 30   # Seconds to wait for a new tunnel to accept connections
+SSH_USER = getpass.getuser()
+SSH_KEY_FILE = Path.home() / ".ssh" / "google_compute_engine"
+
+# Completion scheduling. Each instance is first checked when its scan is expected
+# to finish, estimated from previous scan durations or, for new instances, from
+# the used filesystem size. Overdue scans are then checked with a backoff
+# between the two intervals.
+MIN_CHECK_INTERVAL = 30                            # Seconds
+MAX_CHECK_INTERVAL = 300                           # Seconds
+DEFAULT_EXPECTED_SCAN_SECONDS = 1800               # With no history or size information
+ASSUMED_SCAN_BYTES_PER_SECOND = 25 * 1024 * 1024   # Used to estimate from filesystem size
+SCAN_HISTORY_LENGTH = 5                            # Previous durations kept per instance
+# Once a scan is due to end within this many seconds, block on the instance for
+# up to that long so retrieval starts as soon as it finishes. Checks before
+# then return at once. Set to 0 to disable long polling.
+LONG_POLL_TIMEOUT = 120
+
+# Scan engine used on each instance:
+#   'single'    - one clamscan process (single core)
+#   'multiscan' - clamd with a shared signature database and clamdscan --multiscan
+#   'sharded'   - the file list is split across several clamscan processes; each
+#                 loads its own signature database (~1.5 GB of memory per worker)
+SCAN_MODE = 'single'
+SCAN_WORKERS = 'auto'  # Worker count for multiscan/sharded, or 'auto' to use nproc
+
+# Resource profile for the scan container, so production hosts keep their
+# latency budget. Profiles set docker --cpus (CPUs or a percentage of nproc),
+# --memory, --blkio-weight and a read rate limit on the root disk, run the
+# scanner under nice/ionice, and can pause the container (docker pause) while
+# load per core or CPU/IO pressure (PSI some avg10, %) of the host's other work,
+# without the container's own share, is above a threshold.
+SCAN_PROFILE = 'unrestricted'
+SCAN_PROFILES = {
+    'unrestricted': {},
+    'balanced': {
+        'cpus': '50%',
+        'memory': '4g',
+        'blkio_weight': 300,
+        'device_read_bps': '100mb',
+        'nice': 10,
+        'ionice_class': 2
+    },
+    'gentle': {
+        'cpus': '25%',
+        'memory': '3g',
+        'blkio_weight': 100,
+        'device_read_bps': '50mb',
+        'nice': 19,
+        'ionice_class': 3,
+        'pause_load': 0.8,
+        'resume_load': 0.5,
+        'pause_pressure': 20,
+        'resume_pressure': 10,
+        'max_pause_seconds': 4 * 3600  # Stop pausing once paused this long in total
+    }
+}
+
+# Priority scanning. Files under the paths of the first tier are scanned first,
+# then the second tier's and so on, and all other files last, so the places
+# attackers drop files are covered early. Directories excluded from the scan
+# (such as /tmp) are scanned when a tier names them. Paths must not contain
+# spaces or semicolons.
+PRIORITY_SCAN = False
+PRIORITY_TIERS = [
+    ['/tmp', '/var/tmp'],
+    ['/etc/crontab', '/etc/cron.d', '/etc/cron.hourly', '/etc/cron.daily', '/var/spool/cron',
+     '/etc/systemd/system', '/usr/lib/systemd/system', '/etc/init.d', '/etc/rc.local'],
+    ['/var/www', '/srv', '/home', '/root'],
+    ['/usr/local', '/opt']
+]
+# Stream findings: the scan appends each detection to ~/clamav-logs/findings.live
+# as it happens, and instances are checked at least every FINDINGS_POLL_INTERVAL
+# seconds to collect new ones, instead of waiting for the scan to end.
+STREAM_FINDINGS = False
+FINDINGS_POLL_INTERVAL = 300   # Seconds
+
+# Incremental scanning. Each instance keeps a manifest of its files (path, size,
+# mtime, inode and optionally a SHA-256 hash) from its last completed scan,
+# stored under clamav-scripts/manifests and shipped with the scan script.
+# Only new or changed files are scanned; a full scan runs when there is no
+# manifest, the signature database version changed, or FORCE_FULL_SCAN is set.
+INCREMENTAL_SCAN = False
+FORCE_FULL_SCAN = False
+MANIFEST_CONTENT_HASH = False  # Skip changed files whose content hash is unchanged
+
+# Fleet-wide known-clean cache. Instances built from the same images share most
+# of their files, so hashes of files scanned clean are collected per signature
+# database version and the most frequently seen ones are shipped to every
+# instance, which then only passes files with unknown hashes to ClamAV.
+KNOWN_CLEAN_CACHE = False
+KNOWN_CLEAN_MAX_ENTRIES = 500000   # Hashes shipped to each instance
+KNOWN_CLEAN_MIN_SEEN = 2           # Times a hash must have been scanned clean before it is shipped
+KNOWN_CLEAN_DB_VERSIONS_KEPT = 2   # Signature database versions kept in the cache
+
+# Staging: resolve SCAN_IMAGE to a pinned digest once on the orchestrator (needs
+# a local docker) so every instance scans with the same image and signatures.
+# Instances that already have the pinned image skip the pull.
+SCAN_IMAGE = "clamav/clamav:latest"
+STAGE_SCAN_ASSETS = False
+# 'pull': instances pull the pinned digest themselves; point SCAN_IMAGE at a
+# registry mirror to keep pulls inside the network. 'tunnel': upload the image
+# over ssh to instances that do not have it yet, streamed from disk as a step of
+# its own that resumes where a dropped connection left off.
+STAGE_IMAGE_TRANSFER = 'pull'
+# Run freshclam once on the orchestrator and ship that database snapshot,
+# instead of using the database built into the pinned image
+REFRESH_SIGNATURES = False
+SIGNATURE_SNAPSHOT_MAX_AGE = 4 * 3600   # Seconds before a new snapshot is fetched
+STAGING_PLATFORM = 'linux/amd64'
 
 # Use the current working directory for script and results
 SCRIPT_DIR = Path(os.getcwd()) / "clamav-scripts"
 SCRIPT_DIR.mkdir(exist_ok=True)
+MANIFEST_DIR = SCRIPT_DIR / "manifests"
+KNOWN_CLEAN_EXPORT_PATH = SCRIPT_DIR / "known-clean.txt.gz"
+STAGING_DIR = SCRIPT_DIR / "staging"
+# Index of runs, instance results, phase timings and findings across runs
+RESULTS_INDEX_PATH = SCRIPT_DIR / "results.db"
+
+# Projects are listed in parallel and each listing is reused for
+# INVENTORY_CACHE_TTL seconds (0 disables the cache), unless the filters
+# changed or --refresh-inventory is given.
+INVENTORY_LIST_WORKERS = 8
+INVENTORY_CACHE_TTL = 900
+INVENTORY_CACHE_PATH = SCRIPT_DIR / "inventory.json"
+
+# Every instance state transition of a run (deployed, running, retrieved,
+# cleaned) is appended and fsync'd to the run journal. After a crash,
+# --resume continues the journal's run instead of starting a new one.
+RUN_JOURNAL_PATH = SCRIPT_DIR / "run_journal.jsonl"
+
+# Coordinated runs. --coordinate queues the discovered instances in the work
+# queue, waits for worker processes (--work, on this host or others sharing
+# SCRIPT_DIR) to process them and writes the report from their results.
+# A worker leases up to WORKER_MAX_INSTANCES instances at a time, LEASE_BATCH_SIZE
+# per request, and renews its leases every LEASE_HEARTBEAT_INTERVAL seconds.
+# Leases not renewed for LEASE_SECONDS pass to the next worker, which reattaches
+# to the scan. Instances leased MAX_LEASES times without finishing are failed.
+# The queue is a SQLite file: across hosts, keep it on a filesystem with working
+# POSIX locks.
+WORK_QUEUE_PATH = SCRIPT_DIR / "work_queue.db"
+WORKER_MAX_INSTANCES = 200
+LEASE_BATCH_SIZE = 20
+LEASE_SECONDS = 300
+LEASE_HEARTBEAT_INTERVAL = 60
+MAX_LEASES = 3
+QUEUE_POLL_INTERVAL = 10   # Seconds between queue checks of idle workers and the coordinator
+
+# Daemon mode (--daemon). Every instance is rescanned once per DAEMON_SCAN_PERIOD.
+# Within each zone, instances get start times spaced evenly over the period,
+# shifted by a per-zone phase, so scans of a zone never bunch up. At most
+# DAEMON_MAX_SCANNING_FRACTION of the fleet scans at once; instances due beyond
+# that wait their turn. Every DAEMON_REPORT_INTERVAL seconds the inventory is
+# listed again and a report of every instance's latest results is written,
+# without waiting for scans in flight; they carry over into the next window.
+# Start times are kept in DAEMON_STATE_PATH so a restarted daemon keeps its
+# cadence and reattaches to the scans it left running.
+DAEMON_SCAN_PERIOD = 24 * 3600
+DAEMON_REPORT_INTERVAL = 6 * 3600
+DAEMON_MAX_SCANNING_FRACTION = 0.1
+DAEMON_STATE_PATH = SCRIPT_DIR / "daemon_schedule.json"
+
+# Results archive. The files retrieved from each instance (scan log, summary,
+# scan info, manifest) are added to a content-addressed archive under
+# ARCHIVE_DIR before the next run replaces them. Files are split into chunks at
+# content-defined boundaries and each distinct chunk is stored once, compressed,
+# so logs that barely change between runs or between instances cost little.
+# Each instance keeps its files from its last ARCHIVE_KEEP_RUNS runs, and the
+# oldest runs are evicted while the archive is larger than ARCHIVE_MAX_BYTES.
+# --report-run and --archived-log read archived runs without extracting them.
+ARCHIVE_RESULTS = True
+ARCHIVE_DIR = SCRIPT_DIR / "archive"
+ARCHIVE_KEEP_RUNS = 30
+ARCHIVE_MAX_BYTES = 20 * 1024 ** 3
+
+# Report fragments are built per instance as soon as its results are retrieved,
+# so the final report only assembles them. A provisional report of the
+# instances finished so far is rewritten at most every PARTIAL_REPORT_INTERVAL
+# seconds, and a PDF of it on SIGUSR1.
+PARTIAL_REPORT_INTERVAL = 60
+PARTIAL_REPORT_NAME = "InterstellarShield_Scan_Report_partial"
+
+# Each run times every lifecycle phase per instance and counts the calls,
+# failures, retries and bytes of its gcloud/ssh traffic. A JSON timeline of the
+# run is written under METRICS_DIR and the totals as a Prometheus textfile
+# (point PROMETHEUS_TEXTFILE_PATH into node_exporter's textfile directory).
+METRICS_DIR = SCRIPT_DIR / "metrics"
+PROMETHEUS_TEXTFILE_PATH = METRICS_DIR / "ishield.prom"
+SLOWEST_HOSTS_IN_REPORT = 10
 
 # Create the scan script content
-SCAN_SCRIPT_CONTENT = '''#!/bin/bash
+SCAN_SCRIPT_CONTENT = r'''#!/bin/bash
 TARGET_HOME="$1"
+LOG_DIR="$TARGET_HOME/clamav-logs"
+WORK_DIR="$TARGET_HOME/clamav-work"
+INPUT_DIR="$TARGET_HOME/clamav-inputs"
+IMAGE_DIR="$TARGET_HOME/clamav-image"
+# Compressed full log of the last scan, kept for on-demand retrieval
+ARCHIVE_DIR="$TARGET_HOME/clamav-archive"
+TAB=$'\t'
+export LC_ALL=C
+
+# Scan settings, passed in the environment by ishield.py
+SCAN_MODE="${SCAN_MODE:-single}"       # single, multiscan or sharded
+SCAN_WORKERS="${SCAN_WORKERS:-auto}"   # Parallel workers for multiscan/sharded, or auto
+SCAN_PROFILE="${SCAN_PROFILE:-unrestricted}"
+# Resource limits from the scan profile; empty means unlimited
+SCAN_CPUS="${SCAN_CPUS:-}"                       # CPUs, or a percentage of nproc such as 50%
+SCAN_MEMORY="${SCAN_MEMORY:-}"                   # docker --memory value such as 4g
+SCAN_BLKIO_WEIGHT="${SCAN_BLKIO_WEIGHT:-}"       # 10-1000
+SCAN_DEVICE_READ_BPS="${SCAN_DEVICE_READ_BPS:-}" # Read rate limit on the root disk such as 100mb
+SCAN_NICE="${SCAN_NICE:-}"                       # CPU niceness of the scanner, 0-19
+SCAN_IONICE_CLASS="${SCAN_IONICE_CLASS:-}"       # IO scheduling class: 2 best-effort, 3 idle
+# Load-aware pausing: pause while load per core or CPU/IO pressure is above the
+# pause threshold, resume once it drops below the resume threshold
+SCAN_PAUSE_LOAD="${SCAN_PAUSE_LOAD:-}"
+SCAN_RESUME_LOAD="${SCAN_RESUME_LOAD:-}"
+SCAN_PAUSE_PRESSURE="${SCAN_PAUSE_PRESSURE:-}"   # PSI "some avg10" percentage
+SCAN_RESUME_PRESSURE="${SCAN_RESUME_PRESSURE:-}"
+SCAN_MAX_PAUSE_SECONDS="${SCAN_MAX_PAUSE_SECONDS:-}"
+LOAD_CHECK_INTERVAL=5
+# Incremental scanning: only scan files that are new or changed since the
+# manifest shipped in clamav-inputs, unless SCAN_FULL is set or the signature
+# database changed. SCAN_HASH also compares content hashes of changed files.
+SCAN_INCREMENTAL="${SCAN_INCREMENTAL:-0}"
+SCAN_FULL="${SCAN_FULL:-0}"
+SCAN_HASH="${SCAN_HASH:-0}"
+# Fleet known-clean cache: hash the files to scan, skip those listed in the
+# known-clean.txt.gz shipped in clamav-inputs, and report the clean hashes
+SCAN_KNOWN_CLEAN="${SCAN_KNOWN_CLEAN:-0}"
+# Staged runs pin the image by its ID, which survives docker save/load, and may
+# ship a signature database snapshot. Both are kept on the instance between runs.
+SCAN_IMAGE="${SCAN_IMAGE:-clamav/clamav:latest}"
+SCAN_IMAGE_ID="${SCAN_IMAGE_ID:-}"
+SCAN_IMAGE_ARCHIVE="${SCAN_IMAGE_ARCHIVE:-}"   # Uploaded to $IMAGE_DIR when the image is tunnelled
+SCAN_DB_VERSION="${SCAN_DB_VERSION:-}"
+STAGE_CACHE_DIR=/var/cache/ishield
+# Priority scanning: files under the first tier's paths are scanned first, then
+# the next tier's, and all other files last. Tiers are separated by ";" and
+# their paths by spaces. Excluded directories named by a tier are scanned.
+SCAN_PRIORITY_TIERS="${SCAN_PRIORITY_TIERS:-}"
+# Append every detection to findings.live as soon as the scanner reports it
+SCAN_STREAM_FINDINGS="${SCAN_STREAM_FINDINGS:-0}"
+
+# Directories excluded from the scan, relative to the instance root
+EXCLUDE_DIRS="/proc /sys /dev /usr/src/linux-gcp-fips-headers-5.15.0-1071 /var/cache
+/var/lib/docker /var/lib/containerd /run /tmp /var/tmp /boot"
+if [ -n "$SCAN_PRIORITY_TIERS" ]; then
+    EXCLUDE_DIRS=$(for dir in $EXCLUDE_DIRS; do
+        for path in ${SCAN_PRIORITY_TIERS//;/ }; do
+            case "$dir/" in
+                "$path"/*) continue 2 ;;
+            esac
+        done
+        echo "$dir"
+    done)
+fi
+
+if [ "$SCAN_WORKERS" = "auto" ]; then
+    SCAN_WORKERS=$(nproc)
+    if [ "$SCAN_MODE" = "sharded" ]; then
+        # Every clamscan worker loads its own copy of the signature database (~1.5 GB)
+        MEMORY_WORKERS=$(awk '/^MemAvailable:/ { print int($2 / 1572864) }' /proc/meminfo)
+        if [ "$MEMORY_WORKERS" -lt "$SCAN_WORKERS" ]; then
+            SCAN_WORKERS=$MEMORY_WORKERS
+        fi
+    fi
+fi
+if [ "$SCAN_WORKERS" -lt 1 ]; then
+    SCAN_WORKERS=1
+fi
+
+# Container resource limits
+DOCKER_LIMITS=()
+if [ -n "$SCAN_CPUS" ]; then
+    case "$SCAN_CPUS" in
+        *%) SCAN_CPUS=$(awk -v p="${SCAN_CPUS%\%}" -v n="$(nproc)" 'BEGIN { printf "%.2f", n * p / 100 }') ;;
+    esac
+    DOCKER_LIMITS+=(--cpus="$SCAN_CPUS")
+fi
+if [ -n "$SCAN_MEMORY" ]; then
+    DOCKER_LIMITS+=(--memory="$SCAN_MEMORY")
+fi
+if [ -n "$SCAN_BLKIO_WEIGHT" ]; then
+    DOCKER_LIMITS+=(--blkio-weight="$SCAN_BLKIO_WEIGHT")
+fi
+if [ -n "$SCAN_DEVICE_READ_BPS" ]; then
+    ROOT_SOURCE=$(findmnt -no SOURCE /)
+    ROOT_DISK=$(lsblk -ndo PKNAME "$ROOT_SOURCE" 2>/dev/null)
+    if [ -z "$ROOT_DISK" ]; then
+        ROOT_DISK=$(lsblk -ndo NAME "$ROOT_SOURCE" 2>/dev/null)
+    fi
+    if [ -n "$ROOT_DISK" ]; then
+        DOCKER_LIMITS+=(--device-read-bps="/dev/$ROOT_DISK:$SCAN_DEVICE_READ_BPS")
+    fi
+fi
+
+# Lower the scanner's CPU and IO priority inside the container
+PRIORITY_WRAPPER=()
+if [ -n "$SCAN_NICE" ] || [ -n "$SCAN_IONICE_CLASS" ]; then
+    PRIORITY_WRAPPER=(/bin/sh -c 'if [ -n "$SCAN_IONICE_CLASS" ]; then ionice -c "$SCAN_IONICE_CLASS" -p $$ 2>/dev/null; fi; exec nice -n "${SCAN_NICE:-0}" "$@"' priority)
+fi
+
+above() {
+    awk -v value="$1" -v limit="$2" 'BEGIN { exit !(limit != "" && value > limit) }'
+}
+
+below() {
+    awk -v value="$1" -v limit="$2" 'BEGIN { exit !(limit == "" || value < limit) }'
+}
+
+# Pressure (PSI "some avg10") of the host's other tasks for a resource: the
+# host-wide value less the scan container's own, if its cgroup reports one
+other_pressure() {
+    local host="/proc/pressure/$2" own="$1/$2.pressure"
+    if [ ! -r "$host" ]; then
+        return
+    fi
+    if [ -z "$1" ] || [ ! -r "$own" ]; then
+        own=/dev/null
+    fi
+    awk '/^some/ { split($2, a, "="); if (FILENAME == host) total = a[2]; else own = a[2] }
+         END { p = total - own; print (p > 0 ? p : 0) }' host="$host" "$host" "$own"
+}
+
+# Pause the scan container while the host's other work is busy and record how
+# long the scan was paused or CPU-throttled in throttle.log. The container's own
+# CPU use and pressure are left out, so the scan does not pause itself.
+monitor_load() {
+    local paused=0 paused_seconds=0 pauses=0 throttled_usec=0
+    local cores load pressure id cgroup dir usec usage now last_usage="" last_time="" own_cpus
+    cores=$(nproc)
+    trap 'if [ "$paused" = 1 ]; then docker unpause clamav-manual >/dev/null 2>&1; fi
+          printf "profile=%s\npaused_seconds=%s\npause_count=%s\ncpu_throttled_seconds=%s\n" \
+              "$SCAN_PROFILE" "$paused_seconds" "$pauses" "$((throttled_usec / 1000000))" > "$LOG_DIR/throttle.log"
+          exit 0' TERM
+    while true; do
+        sleep "$LOAD_CHECK_INTERVAL" &
+        wait $!
+        id=$(docker inspect -f '{{.Id}}' clamav-manual 2>/dev/null) || continue
+
+        # CPU time the container used and lost to its --cpus quota (cgroup v2, then v1)
+        cgroup=""
+        for dir in "/sys/fs/cgroup/system.slice/docker-$id.scope" \
+                   "/sys/fs/cgroup/cpu,cpuacct/docker/$id"; do
+            if [ -r "$dir/cpu.stat" ]; then
+                cgroup=$dir
+                break
+            fi
+        done
+        usage=""
+        if [ -n "$cgroup" ]; then
+            usec=$(awk '$1 == "throttled_usec" { print $2 } $1 == "throttled_time" { print int($2 / 1000) }' "$cgroup/cpu.stat")
+            throttled_usec=${usec:-$throttled_usec}
+            usage=$(awk '$1 == "usage_usec" { print $2 }' "$cgroup/cpu.stat")
+            if [ -z "$usage" ] && [ -r "$cgroup/cpuacct.usage" ]; then
+                usage=$(awk '{ print int($1 / 1000) }' "$cgroup/cpuacct.usage")
+            fi
+        fi
+        # CPUs the container kept busy since the last check
+        now=$(date +%s.%N)
+        own_cpus=$(awk -v a="$last_usage" -v b="$usage" -v s="$last_time" -v t="$now" \
+            'BEGIN { c = (a != "" && b != "" && t > s) ? (b - a) / ((t - s) * 1000000) : 0; print (c > 0 ? c : 0) }')
+        last_usage=$usage
+        last_time=$now
+
+        if [ -z "$SCAN_PAUSE_LOAD" ] && [ -z "$SCAN_PAUSE_PRESSURE" ]; then
+            continue
+        fi
+        load=$(awk -v n="$cores" -v own="$own_cpus" '{ l = $1 - own; print (l > 0 ? l : 0) / n }' /proc/loadavg)
+        pressure=$( { other_pressure "$cgroup" cpu; other_pressure "$cgroup" io; } \
+            | awk '$1 > max { max = $1 } END { print max + 0 }')
+        if [ "$paused" = 1 ]; then
+            paused_seconds=$((paused_seconds + LOAD_CHECK_INTERVAL))
+            if { below "$load" "${SCAN_RESUME_LOAD:-$SCAN_PAUSE_LOAD}" && below "$pressure" "${SCAN_RESUME_PRESSURE:-$SCAN_PAUSE_PRESSURE}"; } \
+                || above "$paused_seconds" "$SCAN_MAX_PAUSE_SECONDS"; then
+                docker unpause clamav-manual >/dev/null 2>&1 && paused=0
+            fi
+        elif { above "$load" "$SCAN_PAUSE_LOAD" || above "$pressure" "$SCAN_PAUSE_PRESSURE"; } \
+            && ! above "$paused_seconds" "$SCAN_MAX_PAUSE_SECONDS"; then
+            docker pause clamav-manual >/dev/null 2>&1 && paused=1 && pauses=$((pauses + 1))
+        fi
+    done
+}
+
+# Manifest of the regular files a scan covers, sorted by path:
+# path, size, mtime, inode
+build_manifest() {
+    local prune=() dir
+    for dir in $EXCLUDE_DIRS; do
+        if [ ${#prune[@]} -gt 0 ]; then
+            prune+=(-o)
+        fi
+        prune+=(-path "$dir")
+    done
+    find / \( "${prune[@]}" \) -prune -o -type f ! -name '*.log' ! -name '*.gz' \
+        -printf '%p\t%s\t%T@\t%i\n' 2>/dev/null | sort
+}
+
+# Decide which files to scan. Writes the files to scan to $WORK_DIR/files and
+# the new manifest (path, size, mtime, inode, hash) to $WORK_DIR/manifest.new,
+# and sets SCAN_TYPE, FULL_REASON and the file counters.
+plan_scan() {
+    local previous="$INPUT_DIR/manifest.tsv.gz"
+    local known_clean="$INPUT_DIR/known-clean.txt.gz"
+    local incremental=0 use_cache=0
+    build_manifest > "$WORK_DIR/manifest.current"
+    if [ "$SCAN_INCREMENTAL" = "1" ] && [ -s "$previous" ]; then
+        zcat "$previous" | tail -n +2 | sort > "$WORK_DIR/manifest.previous"
+    else
+        : > "$WORK_DIR/manifest.previous"
+    fi
+
+    if [ "$SCAN_INCREMENTAL" != "1" ]; then
+        FULL_REASON=""
+    elif [ "$SCAN_FULL" = "1" ]; then
+        FULL_REASON="requested"
+    elif [ ! -s "$previous" ]; then
+        FULL_REASON="no previous manifest"
+    elif [ -z "$DB_VERSION" ]; then
+        FULL_REASON="signature database version unknown"
+    elif [ "$(zcat "$previous" | head -n 1)" != "# db_version=$DB_VERSION" ]; then
+        FULL_REASON="signature database changed"
+    else
+        SCAN_TYPE="incremental"
+        incremental=1
+    fi
+    # The fleet cache only applies to the signature database it was built with
+    if [ "$SCAN_KNOWN_CLEAN" = "1" ] && [ -n "$DB_VERSION" ] && [ -s "$known_clean" ] \
+        && [ "$(zcat "$known_clean" | head -n 1)" = "# db_version=$DB_VERSION" ]; then
+        use_cache=1
+    fi
+
+    # path, size, mtime, inode, previous hash, changed since the previous manifest
+    join -t "$TAB" -a 1 -e '-' -o '1.1,1.2,1.3,1.4,2.2,2.3,2.4,2.5' \
+        "$WORK_DIR/manifest.current" "$WORK_DIR/manifest.previous" \
+        | awk -F "$TAB" -v OFS="$TAB" '{
+            print $1, $2, $3, $4, ($8 == "" ? "-" : $8), !($2 == $5 && $3 == $6 && $4 == $7) }' \
+        > "$WORK_DIR/joined"
+
+    # Hash the files that may be scanned and have no current hash yet
+    if [ "$SCAN_HASH" = "1" ] || [ "$SCAN_KNOWN_CLEAN" = "1" ]; then
+        awk -F "$TAB" -v incremental="$incremental" '$6 == 1 || (!incremental && $5 == "-") { print $1 }' \
+            "$WORK_DIR/joined" | tr '\n' '\0' | xargs -0 -r sha256sum 2>/dev/null \
+            | awk -v OFS="$TAB" '{ hash = $1; sub(/^[0-9a-f]+  /, ""); print $0, hash }' \
+            | sort > "$WORK_DIR/hashes"
+    else
+        : > "$WORK_DIR/hashes"
+    fi
+    join -t "$TAB" -a 1 -e '-' -o '1.1,1.2,1.3,1.4,1.5,1.6,2.2' "$WORK_DIR/joined" "$WORK_DIR/hashes" \
+        | awk -F "$TAB" -v OFS="$TAB" -v incremental="$incremental" \
+            -v manifest="$WORK_DIR/manifest.new" -v candidates="$WORK_DIR/candidates" '{
+            hash = $7 != "-" ? $7 : ($6 == 1 ? "-" : $5)
+            print $1, $2, $3, $4, hash > manifest
+            if (incremental && $6 == 0) next
+            # Metadata changed but the content did not
+            if (incremental && $7 != "-" && $7 == $5) next
+            print hash, $1, $2 > candidates
+        }'
+    touch "$WORK_DIR/manifest.new" "$WORK_DIR/candidates"
+
+    # Skip files the fleet has already scanned clean with this signature database
+    CACHE_HITS=0
+    CACHE_BYTES_SKIPPED=0
+    if [ "$use_cache" = "1" ]; then
+        zcat "$known_clean" | tail -n +2 | sort -u > "$WORK_DIR/known-clean"
+        sort "$WORK_DIR/candidates" > "$WORK_DIR/candidates.sorted"
+        join -t "$TAB" -o '1.1,1.2,1.3' "$WORK_DIR/candidates.sorted" "$WORK_DIR/known-clean" > "$WORK_DIR/cache-hits"
+        join -t "$TAB" -v 1 -o '1.1,1.2,1.3' "$WORK_DIR/candidates.sorted" "$WORK_DIR/known-clean" > "$WORK_DIR/candidates"
+        CACHE_HITS=$(wc -l < "$WORK_DIR/cache-hits")
+        CACHE_BYTES_SKIPPED=$(awk -F "$TAB" '{ total += $3 } END { printf "%d", total }' "$WORK_DIR/cache-hits")
+    fi
+
+    FILES_TOTAL=$(wc -l < "$WORK_DIR/manifest.current")
+    FILES_SCANNED=$(wc -l < "$WORK_DIR/candidates")
+    # A plain full scan walks the tree itself; everything else scans a file list
+    if [ "$incremental" = "1" ] || [ "$use_cache" = "1" ]; then
+        awk -F "$TAB" '{ print "/host" $2 }' "$WORK_DIR/candidates" > "$WORK_DIR/files"
+    fi
+}
+
+# Reorder $WORK_DIR/files by priority tier, keeping the order within each tier
+prioritize_files() {
+    awk -F "$TAB" -v tiers="$SCAN_PRIORITY_TIERS" '
+        BEGIN { count = split(tiers, tier, ";") }
+        {
+            path = substr($0, 6)
+            rank = count + 1
+            for (i = 1; i <= count && rank > count; i++) {
+                n = split(tier[i], prefixes, " ")
+                for (j = 1; j <= n; j++) {
+                    if (path == prefixes[j] || index(path, prefixes[j] "/") == 1) {
+                        rank = i
+                        break
+                    }
+                }
+            }
+            print rank "\t" $0
+        }' "$WORK_DIR/files" | sort -s -t "$TAB" -k1,1n | cut -f2- > "$WORK_DIR/files.ordered"
+    mv "$WORK_DIR/files.ordered" "$WORK_DIR/files"
+}
+
+stage_scan_assets() {
+    if [ -n "$SCAN_IMAGE_ID" ]; then
+        # Skip the pull when the host already has the pinned image
+        if sudo docker image inspect "$SCAN_IMAGE_ID" >/dev/null 2>&1; then
+            IMAGE_SOURCE="cached"
+        elif [ -n "$SCAN_IMAGE_ARCHIVE" ] && [ -s "$IMAGE_DIR/$SCAN_IMAGE_ARCHIVE" ] \
+            && gunzip -c "$IMAGE_DIR/$SCAN_IMAGE_ARCHIVE" | sudo docker load -q >/dev/null; then
+            IMAGE_SOURCE="shipped"
+        else
+            sudo docker pull -q "$SCAN_IMAGE" >/dev/null
+            IMAGE_SOURCE="pulled"
+        fi
+        # Registries may report a different local ID; the pinned digest works either way
+        if sudo docker image inspect "$SCAN_IMAGE_ID" >/dev/null 2>&1; then
+            SCAN_IMAGE="$SCAN_IMAGE_ID"
+            rm -rf "$IMAGE_DIR"
+        fi
+    fi
+
+    if [ -n "$SCAN_DB_VERSION" ]; then
+        local db_dir="$STAGE_CACHE_DIR/clamav-db/$SCAN_DB_VERSION"
+        if ! sudo test -f "$db_dir/.complete" && [ -s "$INPUT_DIR/clamav-db.tar.gz" ]; then
+            sudo rm -rf "$db_dir"
+            sudo mkdir -p "$db_dir"
+            sudo tar -xzf "$INPUT_DIR/clamav-db.tar.gz" -C "$db_dir" && sudo touch "$db_dir/.complete"
+        fi
+        if sudo test -f "$db_dir/.complete"; then
+            # Only the snapshot in use is kept
+            sudo find "$STAGE_CACHE_DIR/clamav-db" -mindepth 1 -maxdepth 1 ! -name "$SCAN_DB_VERSION" -exec rm -rf {} +
+            DB_SNAPSHOT="$SCAN_DB_VERSION"
+            DB_MOUNT=(-v "$db_dir":/var/lib/clamav:ro)
+        fi
+    fi
+}
+
+SCAN_STARTED=$(date +%s)
 
 # Create logs directory with proper ownership
-sudo mkdir -p "$TARGET_HOME/clamav-logs"
-sudo docker run --rm \\
-    --name clamav-manual \\
-    -v /:/host:ro \\
-    -v "$TARGET_HOME/clamav-logs":/logs \\
-    clamav/clamav:latest \\
-    clamscan --stdout -r /host \\
-        --max-filesize=100M \\
-        --max-scansize=100M \\
-        --exclude-dir="^/host/proc" \\
-        --exclude-dir="^/host/sys" \\
-        --exclude-dir="^/host/dev" \\
-        --exclude-dir="^/host/usr/src/linux-gcp-fips-headers-5.15.0-1071" \\
-        --exclude-dir="^/host/var/cache" \\
-        --exclude-dir="^/host/var/lib/docker" \\
-        --exclude-dir="^/host/var/lib/containerd" \\
-        --exclude-dir="^/host/run" \\
-        --exclude-dir="^/host/tmp" \\
-        --exclude-dir="^/host/var/tmp" \\
-        --exclude-dir="^/host/boot" \\
-        --exclude="\\.log$" \\
-        --exclude="\\.gz$" \\
-        > "$TARGET_HOME/clamav-logs/scan.log" 2>&1
-
-# Extract important findings and fix permissions
-sudo grep -E "FOUND|Infected files" "$TARGET_HOME/clamav-logs/scan.log" > "$TARGET_HOME/clamav-logs/findings.log"
-sudo chown -R $(stat -c '%U:%G' "$TARGET_HOME") "$TARGET_HOME/clamav-logs/"
+sudo rm -rf "$ARCHIVE_DIR" "$LOG_DIR.fetched"
+sudo mkdir -p "$LOG_DIR" "$WORK_DIR"
+sudo rm -f "$LOG_DIR/findings.live"
+echo "$EXCLUDE_DIRS" | tr ' ' '\n' > "$WORK_DIR/exclude-dirs"
+
+IMAGE_SOURCE=""
+DB_SNAPSHOT=""
+DB_MOUNT=()
+stage_scan_assets
+
+# Signature database version, from "ClamAV <engine>/<db version>/<db date>"
+DB_VERSION=$(sudo docker run --rm "${DB_MOUNT[@]}" "$SCAN_IMAGE" clamscan --version 2>/dev/null | cut -d/ -f2)
+
+SCAN_TYPE="full"
+FULL_REASON=""
+if [ "$SCAN_INCREMENTAL" = "1" ] || [ "$SCAN_KNOWN_CLEAN" = "1" ]; then
+    plan_scan
+fi
+if [ -n "$SCAN_PRIORITY_TIERS" ]; then
+    # Ordering needs a file list, even for a plain full scan
+    if [ ! -f "$WORK_DIR/files" ]; then
+        build_manifest | cut -f1 | sed 's|^|/host|' > "$WORK_DIR/files"
+    fi
+    prioritize_files
+fi
+
+if [ "$SCAN_STREAM_FINDINGS" = "1" ]; then
+    touch "$LOG_DIR/findings.live"
+    if [ "$SCAN_MODE" != "sharded" ]; then
+        # Sharded scans append to findings.live from inside the container
+        tail -n +1 -F --pid=$$ "$LOG_DIR/scan.log" 2>/dev/null \
+            | grep --line-buffered ' FOUND$' >> "$LOG_DIR/findings.live" &
+        FOLLOW_PID=$!
+    fi
+fi
+
+if [ "$SCAN_PROFILE" != "unrestricted" ]; then
+    monitor_load &
+    MONITOR_PID=$!
+fi
+
+if [ -f "$WORK_DIR/files" ] && [ ! -s "$WORK_DIR/files" ]; then
+    # Nothing changed since the last scan, or everything was known clean
+    printf '\n----------- SCAN SUMMARY -----------\nScanned files: 0\nInfected files: 0\n' > "$LOG_DIR/scan.log"
+elif [ "$SCAN_MODE" = "single" ]; then
+    if [ -f "$WORK_DIR/files" ]; then
+        SCAN_TARGET=(--file-list=/work/files)
+    else
+        SCAN_TARGET=(-r /host)
+    fi
+    EXCLUDES=()
+    for dir in $EXCLUDE_DIRS; do
+        EXCLUDES+=(--exclude-dir="^/host$dir")
+    done
+    sudo docker run --rm \
+        --name clamav-manual \
+        "${DOCKER_LIMITS[@]}" \
+        -e SCAN_NICE="$SCAN_NICE" \
+        -e SCAN_IONICE_CLASS="$SCAN_IONICE_CLASS" \
+        -v /:/host:ro \
+        -v "$LOG_DIR":/logs \
+        -v "$WORK_DIR":/work:ro \
+        "${DB_MOUNT[@]}" \
+        "$SCAN_IMAGE" \
+        "${PRIORITY_WRAPPER[@]}" \
+        clamscan --stdout "${SCAN_TARGET[@]}" \
+            --max-filesize=100M \
+            --max-scansize=100M \
+            "${EXCLUDES[@]}" \
+            --exclude="\.log$" \
+            --exclude="\.gz$" \
+            > "$LOG_DIR/scan.log" 2>&1
+else
+    # Multi-core scan, run inside the container. Output keeps clamscan's
+    # "path: result" lines followed by a single SCAN SUMMARY block.
+    sudo tee "$WORK_DIR/scan.sh" > /dev/null <<'CONTAINER_SCRIPT'
+#!/bin/sh
+MODE="$1"
+
+# Lower CPU and IO priority; clamd and the clamscan workers inherit both
+if [ -n "$SCAN_IONICE_CLASS" ]; then
+    ionice -c "$SCAN_IONICE_CLASS" -p $$ 2>/dev/null
+fi
+if [ -n "$SCAN_NICE" ]; then
+    renice -n "$SCAN_NICE" -p $$ >/dev/null 2>&1
+fi
+
+if [ "$MODE" = "multiscan" ]; then
+    # One clamd with a shared signature database, scanning with SCAN_WORKERS threads
+    {
+        echo "LocalSocket /tmp/clamd.sock"
+        echo "DatabaseDirectory /var/lib/clamav"
+        echo "MaxThreads $SCAN_WORKERS"
+        echo "MaxFileSize 100M"
+        echo "MaxScanSize 100M"
+        while read -r dir; do
+            echo "ExcludePath ^/host$dir"
+        done < /work/exclude-dirs
+        echo 'ExcludePath \.log$'
+        echo 'ExcludePath \.gz$'
+    } > /tmp/clamd.conf
+    clamd --config-file=/tmp/clamd.conf
+    waited=0
+    while [ ! -S /tmp/clamd.sock ] && [ "$waited" -lt 600 ]; do
+        sleep 1
+        waited=$((waited + 1))
+    done
+    if [ -f /work/files ]; then
+        exec clamdscan --config-file=/tmp/clamd.conf --multiscan --fdpass --stdout --file-list=/work/files
+    fi
+    exec clamdscan --config-file=/tmp/clamd.conf --multiscan --fdpass --stdout /host
+fi
+
+# Sharded: split the file list round-robin across SCAN_WORKERS clamscan processes
+set --
+while read -r dir; do
+    if [ $# -gt 0 ]; then
+        set -- "$@" -o
+    fi
+    set -- "$@" -path "/host$dir"
+done < /work/exclude-dirs
+if [ -f /work/files ]; then
+    cat /work/files
+else
+    find /host \( "$@" \) -prune -o -type f ! -name '*.log' ! -name '*.gz' -print 2>/dev/null
+fi | awk -v n="$SCAN_WORKERS" '{ print > ("/tmp/shard." (NR % n)) }'
+
+start=$(date +%s)
+start_date=$(date '+%Y:%m:%d %H:%M:%S')
+for shard in /tmp/shard.*; do
+    [ -f "$shard" ] || continue
+    if [ "$SCAN_STREAM_FINDINGS" = "1" ]; then
+        clamscan --stdout --max-filesize=100M --max-scansize=100M --file-list="$shard" 2>&1 \
+            | tee "$shard.log" | while read -r line; do
+                case "$line" in
+                    *" FOUND") echo "$line" >> /logs/findings.live ;;
+                esac
+            done &
+    else
+        clamscan --stdout --max-filesize=100M --max-scansize=100M \
+            --file-list="$shard" > "$shard.log" 2>&1 &
+    fi
+done
+wait
+end=$(date +%s)
+
+cat /tmp/shard.*.log 2>/dev/null | awk -v start="$start" -v end="$end" \
+    -v start_date="$start_date" -v end_date="$(date '+%Y:%m:%d %H:%M:%S')" '
+    function mb(value, unit) {
+        if (unit ~ /^T/) return value * 1048576
+        if (unit ~ /^G/) return value * 1024
+        if (unit ~ /^K/) return value / 1024
+        if (unit ~ /^B/) return value / 1048576
+        return value
+    }
+    /^----------- SCAN SUMMARY -----------$/ { summary = 1; next }
+    summary && /^Known viruses:/ { known = $3 }
+    summary && /^Engine version:/ { engine = $3 }
+    summary && /^Scanned directories:/ { dirs += $3 }
+    summary && /^Scanned files:/ { files += $3 }
+    summary && /^Infected files:/ { infected += $3 }
+    summary && /^Data scanned:/ { scanned += mb($3, $4) }
+    summary && /^Data read:/ { read += mb($3, $4) }
+    summary && /^End Date:/ { summary = 0; next }
+    summary || /^$/ { next }
+    { print }
+    END {
+        seconds = end - start
+        print ""
+        print "----------- SCAN SUMMARY -----------"
+        print "Known viruses: " known
+        print "Engine version: " engine
+        print "Scanned directories: " dirs + 0
+        print "Scanned files: " files + 0
+        print "Infected files: " infected + 0
+        printf "Data scanned: %.2f MB\n", scanned
+        printf "Data read: %.2f MB\n", read
+        printf "Time: %.3f sec (%d m %d s)\n", seconds, seconds / 60, seconds % 60
+        print "Start Date: " start_date
+        print "End Date:   " end_date
+    }'
+CONTAINER_SCRIPT
+
+    sudo docker run --rm \
+        --name clamav-manual \
+        "${DOCKER_LIMITS[@]}" \
+        -e SCAN_WORKERS="$SCAN_WORKERS" \
+        -e SCAN_STREAM_FINDINGS="$SCAN_STREAM_FINDINGS" \
+        -e SCAN_NICE="$SCAN_NICE" \
+        -e SCAN_IONICE_CLASS="$SCAN_IONICE_CLASS" \
+        -v /:/host:ro \
+        -v "$LOG_DIR":/logs \
+        -v "$WORK_DIR":/work:ro \
+        "${DB_MOUNT[@]}" \
+        --entrypoint /bin/sh \
+        "$SCAN_IMAGE" \
+        /work/scan.sh "$SCAN_MODE" \
+        > "$LOG_DIR/scan.log" 2>&1
+fi
+
+if [ -n "$MONITOR_PID" ]; then
+    kill -TERM "$MONITOR_PID"
+    wait "$MONITOR_PID"
+fi
+if [ -n "$FOLLOW_PID" ]; then
+    # tail -F checks for new lines once a second; let it pass on the last ones
+    sleep 2
+    pkill -P $$ -x tail
+    wait "$FOLLOW_PID"
+fi
+
+# Paths of infected files, relative to the instance root
+grep ' FOUND$' "$LOG_DIR/scan.log" | sed 's|^/host||; s|: [^:]* FOUND$||' > "$WORK_DIR/infected"
+
+# Keep the manifest for the next incremental scan if this one completed.
+# Infected files are left out so they are scanned again next time.
+if [ "$SCAN_INCREMENTAL" = "1" ] && grep -q "^----------- SCAN SUMMARY" "$LOG_DIR/scan.log"; then
+    {
+        echo "# db_version=$DB_VERSION"
+        awk -F "$TAB" -v infected="$WORK_DIR/infected" '
+            FILENAME == infected { found[$0] = 1; next }
+            !($1 in found)' "$WORK_DIR/infected" "$WORK_DIR/manifest.new"
+    } | gzip > "$LOG_DIR/manifest.tsv.gz"
+fi
+
+# Report the hashes of files scanned clean so the fleet cache can grow
+if [ "$SCAN_KNOWN_CLEAN" = "1" ] && [ -n "$DB_VERSION" ] && grep -q "^----------- SCAN SUMMARY" "$LOG_DIR/scan.log"; then
+    {
+        echo "# db_version=$DB_VERSION"
+        awk -F "$TAB" -v OFS="$TAB" -v infected="$WORK_DIR/infected" '
+            FILENAME == infected { found[$0] = 1; next }
+            $1 != "-" && !($2 in found) { print $1, $3 }' "$WORK_DIR/infected" "$WORK_DIR/candidates"
+    } | gzip > "$LOG_DIR/clean_hashes.tsv.gz"
+fi
+
+{
+    echo "scan_type=$SCAN_TYPE"
+    echo "full_reason=$FULL_REASON"
+    echo "db_version=$DB_VERSION"
+    echo "db_snapshot=$DB_SNAPSHOT"
+    echo "image=$SCAN_IMAGE"
+    echo "image_source=$IMAGE_SOURCE"
+    echo "files_total=$FILES_TOTAL"
+    echo "files_scanned=$FILES_SCANNED"
+    echo "cache_hits=$CACHE_HITS"
+    echo "cache_bytes_skipped=$CACHE_BYTES_SKIPPED"
+    echo "scan_seconds=$(( $(date +%s) - SCAN_STARTED ))"
+} > "$LOG_DIR/scan_info.log"
+sudo rm -rf "$WORK_DIR"
+
+# Compact JSON summary for the orchestrator: findings, the SCAN SUMMARY block,
+# duration and database version. The full log is compressed and only
+# transferred when there are findings or it is asked for.
+awk -v db_version="$DB_VERSION" -v scan_type="$SCAN_TYPE" -v scan_mode="$SCAN_MODE" \
+    -v duration="$(( $(date +%s) - SCAN_STARTED ))" '
+    function json(value) {
+        gsub(/\\/, "&&", value)
+        gsub(/"/, "\\\"", value)
+        gsub(/[[:cntrl:]]/, "?", value)
+        return "\"" value "\""
+    }
+    / FOUND$/ && match($0, /: [^ ]+ FOUND$/) {
+        path = substr($0, 1, RSTART - 1)
+        sub(/^\/host/, "", path)
+        findings = findings (findings == "" ? "" : ",\n    ") \
+            "{\"path\": " json(path) ", \"signature\": " json(substr($0, RSTART + 2, RLENGTH - 8)) "}"
+        next
+    }
+    /^----------- SCAN SUMMARY -----------$/ { in_summary = 1; complete = 1; next }
+    in_summary && index($0, ": ") {
+        name = tolower(substr($0, 1, index($0, ": ") - 1))
+        gsub(/ /, "_", name)
+        value = substr($0, index($0, ": ") + 2)
+        sub(/^ +/, "", value)
+        stats = stats (stats == "" ? "" : ",\n    ") json(name) ": " (value ~ /^[0-9]+$/ ? value : json(value))
+    }
+    END {
+        print "{"
+        print "  \"complete\": " (complete ? "true" : "false") ","
+        print "  \"scan_type\": " json(scan_type) ","
+        print "  \"scan_mode\": " json(scan_mode) ","
+        print "  \"db_version\": " json(db_version) ","
+        print "  \"duration_seconds\": " duration ","
+        print "  \"summary\": {" (stats == "" ? "" : "\n    " stats "\n  ") "},"
+        print "  \"findings\": [" (findings == "" ? "" : "\n    " findings "\n  ") "]"
+        print "}"
+    }' "$LOG_DIR/scan.log" > "$LOG_DIR/summary.json"
+gzip -f "$LOG_DIR/scan.log"
+
+# Fix permissions
+sudo chown -R $(stat -c '%U:%G' "$TARGET_HOME") "$LOG_DIR/"
 '''
 
 # Write the script locally
@@ -56,273 +944,2621 @@ with open(SCAN_SCRIPT_PATH, "w") as f:
     f.write(SCAN_SCRIPT_CONTENT)
 os.chmod(SCAN_SCRIPT_PATH, 0o755)  # Make executable
 
+# Remote commands for single-session transfer. The deploy command unpacks the
+# script and its inputs from a tar.gz on stdin and detaches the scan so the ssh
+# session returns at once. The fetch command writes the logs as a tar.gz to
+# stdout and, once tar has succeeded, moves them to ~/clamav-logs.fetched.
+CLEANUP_COMMAND = 'sudo rm -rf ~/clamav-logs ~/clamav-logs.fetched ~/clamav-inputs ~/run_clamav_scan.sh'
+DEPLOY_COMMAND = (
+    'rm -rf ~/clamav-inputs && tar -xzf - -C ~ && chmod +x ~/run_clamav_scan.sh && '
+    'export TARGET_HOME=$HOME {scan_environment} && '
+    '(setsid nohup sudo -E bash ~/run_clamav_scan.sh "$TARGET_HOME" </dev/null >/dev/null 2>&1 &) && '
+    # Report used bytes on local filesystems so the scheduler can estimate scan time
+    'df -B1 --output=used --total -x tmpfs -x devtmpfs -x overlay -x squashfs | tail -n 1'
+)
+# Resumable upload of a tunnelled scan image to ~/clamav-image. The offset
+# command removes stale uploads and prints "complete" or the bytes received so
+# far; the append command sends the rest and renames the upload once whole.
+IMAGE_OFFSET_COMMAND = (
+    'mkdir -p ~/clamav-image && cd ~/clamav-image && '
+    'find . -maxdepth 1 -type f ! -name {name} ! -name {name}.partial -delete && '
+    'if [ -f {name} ]; then echo complete; else stat -c %s {name}.partial 2>/dev/null || echo 0; fi'
+)
+IMAGE_APPEND_COMMAND = (
+    'cd ~/clamav-image && touch {name}.partial && truncate -s {offset} {name}.partial && '
+    'cat >> {name}.partial && [ "$(stat -c %s {name}.partial)" = {size} ] && mv {name}.partial {name}'
+)
+# Prints nothing once the scan container has exited and the scan script has
+# finished post-processing its logs.
+STATUS_COMMAND = (
+    'sudo docker ps | grep "clamav-manual"; '
+    'pgrep -fa "[r]un_clamav_scan[.]sh"; true'
+)
+# Prints running, finished or idle: whether a scan is still going, has left its
+# results in ~/clamav-logs, or neither
+PROBE_COMMAND = (
+    'if sudo docker ps | grep -q "clamav-manual" || pgrep -f "[r]un_clamav_scan[.]sh" >/dev/null; '
+    'then echo running; elif [ -f ~/clamav-logs/summary.json ]; then echo finished; else echo idle; fi'
+)
+# Blocks until the scan finishes or the timeout passes, then reports like STATUS_COMMAND
+LONG_POLL_COMMAND = (
+    'timeout {timeout} sudo docker wait clamav-manual >/dev/null 2>&1; '
+    'timeout {timeout} sh -c \'while pgrep -f "[r]un_clamav_scan[.]sh" >/dev/null; do sleep 2; done\'; '
+    + STATUS_COMMAND
+)
+# Succeeds in ~/clamav-logs when the full scan log should be transferred
+FULL_LOG_WANTED = {
+    'always': 'true',
+    'findings': 'grep -q "\\"path\\"" summary.json',
+    'never': 'false'
+}
+# Moves the compressed full log aside unless it is wanted, so it can be fetched later
+KEEP_FULL_LOG_COMMAND = (
+    '{{ {full_log_wanted} || {{ mkdir -p ~/clamav-archive && '
+    '{{ [ ! -f scan.log.gz ] || mv -f scan.log.gz ~/clamav-archive/; }}; }}; }}'
+)
+# Safe to retry: a retry after the logs were moved aside archives them from
+# ~/clamav-logs.fetched instead (moving the full log aside is idempotent)
+FETCH_RESULTS_COMMAND = (
+    'if [ -d ~/clamav-logs ]; then cd ~/clamav-logs; else cd ~/clamav-logs.fetched; fi && '
+    '{keep_full_log} && tar -czf - . && '
+    'if [ -d ~/clamav-logs ]; then sudo rm -rf ~/clamav-logs.fetched && mv ~/clamav-logs ~/clamav-logs.fetched; fi'
+)
+
+FETCH_FULL_LOG_COMMAND = 'cat ~/clamav-archive/scan.log.gz'
+# With STREAM_FINDINGS: optionally blocks for up to {timeout} seconds until the
+# scan ends or findings.live has more than {seen} lines, reports like
+# STATUS_COMMAND, then prints the findings after the first {seen}, each
+# prefixed with LIVE_FINDING_PREFIX
+STREAM_WAIT_COMMAND = (
+    'timeout {timeout} sh -c \'while {{ sudo docker ps | grep -q "clamav-manual" || pgrep -f "[r]un_clamav_scan[.]sh" >/dev/null; }} '
+    '&& [ "$(cat ~/clamav-logs/findings.live 2>/dev/null | wc -l)" -le {seen} ]; do sleep 5; done\'; '
+)
+STREAM_STATUS_COMMAND = (
+    STATUS_COMMAND + '; awk \'NR > {seen} {{ print "LIVE " $0 }}\' ~/clamav-logs/findings.live 2>/dev/null; true'
+)
+LIVE_FINDING_PREFIX = 'LIVE '
+
+def keep_full_log_command() -> str:
+    """KEEP_FULL_LOG_COMMAND for the configured FULL_LOG_TRANSFER."""
+    if FULL_LOG_TRANSFER not in FULL_LOG_WANTED:
+        raise ValueError(f"Unknown FULL_LOG_TRANSFER: {FULL_LOG_TRANSFER}")
+    return KEEP_FULL_LOG_COMMAND.format(full_log_wanted=FULL_LOG_WANTED[FULL_LOG_TRANSFER])
+
+class ConcurrencyLimiter:
+    """Bounds the number of in-flight gcloud operations globally, per project and per zone of a project."""
+
+    def __init__(self, global_limit: int, project_limit: int, zone_limit: int):
+        self._global = threading.BoundedSemaphore(global_limit)
+        self._project_limit = project_limit
+        self._zone_limit = zone_limit
+        self._projects = {}
+        self._zones = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, pool: Dict, key, limit: int) -> threading.BoundedSemaphore:
+        with self._lock:
+            if key not in pool:
+                pool[key] = threading.BoundedSemaphore(limit)
+            return pool[key]
+
+    @contextmanager
+    def slot(self, project_id: str, zone: str):
+        """Hold one operation slot for the given project and zone."""
+        # Acquire the narrowest limit first so a thread queued behind a busy
+        # zone does not sit on a project-wide or global slot.
+        zone_sem = self._semaphore(self._zones, (project_id, zone), self._zone_limit)
+        project_sem = self._semaphore(self._projects, project_id, self._project_limit)
+        with zone_sem, project_sem, self._global:
+            yield
+
+def run_for_instances(func, instances: List[tuple]) -> List:
+    """Run func(project_id, zone, instance) for every instance on a thread pool.
+    Returns the results in the same order as instances; a task that raises returns None."""
+    if not instances:
+        return []
+
+    def task(target):
+        project_id, zone, instance = target
+        try:
+            return func(project_id, zone, instance)
+        except Exception as e:
+            print(f"Unexpected error processing {instance} (Project: {project_id}, Zone: {zone}): {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(len(instances), MAX_WORKER_THREADS)) as executor:
+        return list(executor.map(task, instances))
+
+# Failure classes of gcloud/ssh/scp calls, matched against stderr in this order.
+# Calls that exit 255 without a recognised message failed to connect (ssh).
+FAILURE_PATTERNS = [
+    ('auth', re.compile(r'Permission denied|publickey|not authorized|PERMISSION_DENIED|\b4033\b', re.I)),
+    ('not_found', re.compile(r'was not found|notFound|NOT_FOUND', re.I)),
+    ('quota', re.compile(r'Quota exceeded|rateLimitExceeded|RESOURCE_EXHAUSTED|\b429\b', re.I)),
+    ('unreachable', re.compile(r'Connection (closed|refused|reset|timed out)|failed to connect to backend|'
+                               r'\b4003\b|did not accept connections|Broken pipe|Network is unreachable', re.I))
+]
+# Failures worth retrying, and the ones that count towards a zone's circuit breaker
+TRANSIENT_FAILURES = ('unreachable', 'timeout', 'quota')
+BREAKER_FAILURES = ('unreachable', 'timeout')
+
+def classify_failure(returncode: int, stderr) -> str:
+    """Failure class of a call that exited with returncode: auth, not_found, quota,
+    unreachable or command (the remote command itself failed)."""
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode(errors='replace')
+    for failure, pattern in FAILURE_PATTERNS:
+        if stderr and pattern.search(stderr):
+            return failure
+    return 'unreachable' if returncode == 255 else 'command'
+
+class CallFailed(subprocess.CalledProcessError):
+    """A gcloud/ssh/scp call that failed after its retries, with its failure class.
+    Besides the classes of classify_failure, timeout (the deadline passed) and
+    circuit_open (not run, the zone's circuit breaker is open)."""
+
+    def __init__(self, result: subprocess.CompletedProcess, failure: str):
+        super().__init__(result.returncode, result.args, result.stdout, result.stderr)
+        self.failure = failure
+
+    def __str__(self):
+        if self.failure == 'timeout':
+            return f"Command '{self.cmd}' did not finish before its deadline"
+        if self.failure == 'circuit_open':
+            return "Call not run: the circuit breaker for its zone is open"
+        return f"{super().__str__()} ({self.failure})"
+
+class CircuitBreakers:
+    """Connection failures in a row per (project, zone).
+
+    A zone's breaker opens at failure_threshold, refuses calls for cooldown
+    seconds and then lets one trial call through: the zone closes again if it
+    succeeds and stays open for another cooldown if it fails."""
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._zones = {}
+        self._lock = threading.Lock()
+        self.times_opened = Counter()
+
+    def allow(self, key: tuple) -> bool:
+        """Whether a call to the zone may go ahead."""
+        with self._lock:
+            zone = self._zones.get(key)
+            if zone is None or zone['opened_at'] is None:
+                return True
+            if zone['trial'] or time.time() - zone['opened_at'] < self.cooldown:
+                return False
+            zone['trial'] = True
+            return True
+
+    def record(self, key: tuple, failure: Optional[str]) -> None:
+        """Outcome of a call to the zone: None if it succeeded, otherwise its failure class."""
+        with self._lock:
+            zone = self._zones.setdefault(key, {'failures': 0, 'opened_at': None, 'trial': False})
+            if failure not in BREAKER_FAILURES:
+                # The zone answered, even if the call itself failed
+                if zone['opened_at'] is not None:
+                    print(f"Circuit breaker closed for {'/'.join(filter(None, key))}")
+                zone.update(failures=0, opened_at=None, trial=False)
+                return
+            zone['failures'] += 1
+            if zone['trial'] or (zone['opened_at'] is None and zone['failures'] >= self.failure_threshold):
+                if zone['opened_at'] is None:
+                    print(f"Circuit breaker opened for {'/'.join(filter(None, key))} "
+                          f"after {zone['failures']} connection failures")
+                    self.times_opened[key] += 1
+                zone.update(opened_at=time.time(), trial=False)
+
+    def open_zones(self) -> List[tuple]:
+        with self._lock:
+            return sorted(key for key, zone in self._zones.items() if zone['opened_at'] is not None)
+
+# Set by main()
+BREAKERS = None
+
+def guarded_call(zone_key: tuple, operation: str, call, check: bool = False,
+                 timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+    """Run call(seconds_left) -> CompletedProcess, one attempt without check, under
+    the deadline for operation (or timeout) and the circuit breaker of zone_key,
+    retrying transient failures with full-jitter exponential backoff.
+    The result has a failure attribute: None, or the failure class of the last
+    attempt. With check, a failed call raises CallFailed instead."""
+    deadline = time.time() + (timeout or CALL_DEADLINES.get(operation, CALL_DEADLINES['default']))
+    attempts = CALL_ATTEMPTS if operation in RETRIED_OPERATIONS else 1
+    for attempt in range(attempts):
+        if BREAKERS is not None and not BREAKERS.allow(zone_key):
+            result, failure = subprocess.CompletedProcess(operation, 255, None, None), 'circuit_open'
+            break
+        try:
+            result = call(max(deadline - time.time(), 1))
+            failure = classify_failure(result.returncode, result.stderr) if result.returncode != 0 else None
+        except subprocess.TimeoutExpired as e:
+            result, failure = subprocess.CompletedProcess(e.cmd, -9, e.output, e.stderr), 'timeout'
+        except subprocess.CalledProcessError as e:
+            # The connection pool raises when a tunnel cannot be opened
+            result = subprocess.CompletedProcess(e.cmd, e.returncode, e.output, e.stderr)
+            failure = classify_failure(e.returncode, e.stderr)
+        if BREAKERS is not None:
+            BREAKERS.record(zone_key, failure)
+        if failure not in TRANSIENT_FAILURES or attempt == attempts - 1:
+            break
+        backoff = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        if time.time() + backoff >= deadline:
+            break
+        time.sleep(backoff)
+        if METRICS is not None:
+            METRICS.record_retry()
+    result.failure = failure
+    if failure is not None:
+        if METRICS is not None:
+            METRICS.record_failure(failure)
+        if check:
+            raise CallFailed(result, failure)
+    return result
+
+class ConnectionPool:
+    """Keeps one IAP tunnel and SSH ControlMaster connection open per instance.
+
+    Tunnels are opened on first use, shared by concurrent callers, closed after
+    TUNNEL_IDLE_TIMEOUT seconds without use, and capped at MAX_OPEN_TUNNELS."""
+
+    def __init__(self, max_tunnels: int = MAX_OPEN_TUNNELS, idle_timeout: int = TUNNEL_IDLE_TIMEOUT):
+        self.max_tunnels = max_tunnels
+        self.idle_timeout = idle_timeout
+        self._tunnels = {}
+        self._provisioned = set()
+        self._control_dir = tempfile.mkdtemp(prefix="ishield-ssh-")
+        self._condition = threading.Condition()
+
+    def _free_port(self) -> int:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('localhost', 0))
+            return sock.getsockname()[1]
+
+    def _wait_for_port(self, tunnel: Dict) -> bool:
+        deadline = time.time() + TUNNEL_START_TIMEOUT
+        while time.time() < deadline:
+            if tunnel['process'].poll() is not None:
+                return False
+            try:
+                with socket.create_connection(('localhost', tunnel['port']), timeout=1):
+                    return True
+            except OSError:
+                time.sleep(0.5)
+        return False
+
+    def _open(self, key: tuple) -> Dict:
+        project_id, zone, instance = key
+        port = self._free_port()
+        process = subprocess.Popen(
+            ['gcloud', 'compute', 'start-iap-tunnel', instance, '22',
+             f'--local-host-port=localhost:{port}',
+             f'--project={project_id}',
+             f'--zone={zone}'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        return {
+            'process': process,
+            'port': port,
+            'control_path': os.path.join(self._control_dir, str(port)),
+            'last_used': time.time(),
+            'users': 0,
+            'ready': threading.Event(),
+            'ok': False
+        }
+
+    def _close(self, key: tuple) -> None:
+        tunnel = self._tunnels.pop(key)
+        subprocess.run(
+            ['ssh', '-o', f"ControlPath={tunnel['control_path']}", '-O', 'exit', f'{SSH_USER}@localhost'],
+            stdin=subprocess.DEVNULL,
+            capture_output=True
+        )
+        tunnel['process'].terminate()
+
+    def _evict(self) -> None:
+        """Close idle tunnels, then least recently used ones while over the cap. Caller holds the lock."""
+        now = time.time()
+        idle = [key for key, tunnel in self._tunnels.items() if tunnel['users'] == 0]
+        for key in idle:
+            if now - self._tunnels[key]['last_used'] > self.idle_timeout:
+                self._close(key)
+        idle = sorted((key for key in idle if key in self._tunnels), key=lambda k: self._tunnels[k]['last_used'])
+        while len(self._tunnels) >= self.max_tunnels and idle:
+            self._close(idle.pop(0))
+
+    def _acquire(self, key: tuple) -> Dict:
+        opener = False
+        with self._condition:
+            while True:
+                tunnel = self._tunnels.get(key)
+                if tunnel is not None and tunnel['ready'].is_set() and tunnel['process'].poll() is not None:
+                    self._close(key)
+                    tunnel = None
+                if tunnel is not None:
+                    break
+                self._evict()
+                if len(self._tunnels) < self.max_tunnels:
+                    tunnel = self._tunnels[key] = self._open(key)
+                    opener = True
+                    break
+                self._condition.wait()
+            tunnel['users'] += 1
+
+        # Only the caller that opened the tunnel waits for it to come up; everyone else waits on it
+        if opener:
+            tunnel['ok'] = self._wait_for_port(tunnel)
+            tunnel['ready'].set()
+        else:
+            tunnel['ready'].wait()
+        if not tunnel['ok']:
+            self._release(key, tunnel)
+            raise subprocess.CalledProcessError(
+                1, 'gcloud compute start-iap-tunnel',
+                stderr=f"IAP tunnel to {key[2]} did not accept connections"
+            )
+        return tunnel
+
+    def _release(self, key: tuple, tunnel: Dict) -> None:
+        with self._condition:
+            tunnel['users'] -= 1
+            tunnel['last_used'] = time.time()
+            if not tunnel['ok'] and tunnel['users'] == 0 and self._tunnels.get(key) is tunnel:
+                self._close(key)
+            self._condition.notify_all()
+
+    def _ssh_options(self, tunnel: Dict) -> List[str]:
+        return [
+            '-i', str(SSH_KEY_FILE),
+            '-o', 'ControlMaster=auto',
+            '-o', f"ControlPath={tunnel['control_path']}",
+            '-o', f'ControlPersist={self.idle_timeout}',
+            # The IAP tunnel already authenticates the endpoint and local ports are reused
+            '-o', 'StrictHostKeyChecking=no',
+            '-o', 'UserKnownHostsFile=/dev/null',
+            '-o', 'LogLevel=ERROR',
+            '-o', 'BatchMode=yes'
+        ]
+
+    def _run(self, key: tuple, build, **kwargs) -> subprocess.CompletedProcess:
+        tunnel = self._acquire(key)
+        try:
+            result = run_command(build(tunnel), **dict(kwargs, check=False))
+            if result.returncode == 255 and key not in self._provisioned:
+                # ssh could not authenticate; let gcloud push our key to the instance once and retry
+                self._provisioned.add(key)
+                run_command(build_ssh_command(*key, 'true'), stdin=subprocess.DEVNULL, capture_output=True,
+                            timeout=kwargs.get('timeout'))
+                if METRICS is not None:
+                    METRICS.record_retry()
+                result = run_command(build(tunnel), **dict(kwargs, check=False))
+            self._provisioned.add(key)
+        finally:
+            self._release(key, tunnel)
+        if kwargs.get('check') and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+        return result
+
+    def run_ssh(self, project_id: str, zone: str, instance: str, command: str, **kwargs) -> subprocess.CompletedProcess:
+        """Run command on the instance over its pooled connection."""
+        return self._run(
+            (project_id, zone, instance),
+            lambda tunnel: ['ssh', '-p', str(tunnel['port'])] + self._ssh_options(tunnel) + [f'{SSH_USER}@localhost', command],
+            **kwargs
+        )
+
+    def run_scp(self, project_id: str, zone: str, instance: str, source: str, destination: str, **kwargs) -> subprocess.CompletedProcess:
+        """Copy files over the instance's pooled connection. Remote paths use the instance:path form."""
+        remote = f'{SSH_USER}@localhost:'
+        source = source.replace(f'{instance}:', remote, 1) if source.startswith(f'{instance}:') else source
+        destination = destination.replace(f'{instance}:', remote, 1) if destination.startswith(f'{instance}:') else destination
+        return self._run(
+            (project_id, zone, instance),
+            lambda tunnel: ['scp', '-P', str(tunnel['port'])] + self._ssh_options(tunnel) + [source, destination],
+            **kwargs
+        )
+
+    def close_all(self) -> None:
+        """Close every open tunnel and control connection."""
+        with self._condition:
+            for key in list(self._tunnels):
+                self._close(key)
+        shutil.rmtree(self._control_dir, ignore_errors=True)
+
+# Set by main() when USE_CONNECTION_POOL is enabled, and always in daemon mode
+CONNECTION_POOL = None
+
+@contextmanager
+def locked_json(path: Path):
+    """The JSON object in path, re-read under an exclusive lock and written back atomically
+    when the block exits, so processes sharing the file, such as the workers of a
+    coordinated run, apply their updates to each other's rather than overwrite them."""
+    with open(path.with_name(f".{path.name}.lock"), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                data = json.loads(path.read_text())
+            except FileNotFoundError:
+                data = {}
+            except (OSError, ValueError) as e:
+                print(f"Warning: Replacing unreadable {path}: {e}")
+                data = {}
+            yield data
+            tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+            tmp_path.write_text(json.dumps(data, indent=2))
+            os.replace(tmp_path, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+class ScanHistory:
+    """Previous scan durations and filesystem sizes per instance, persisted as JSON."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            self._entries = json.loads(path.read_text())
+        except (OSError, ValueError):
+            self._entries = {}
+
+    @contextmanager
+    def _updating(self, project_id: str, instance: str):
+        """The instance's entry in the file's current content, saved when the block exits."""
+        with self._lock, locked_json(self.path) as entries:
+            yield entries.setdefault(f"{project_id}/{instance}", {'durations': []})
+            self._entries = entries
+
+    def record_filesystem_size(self, project_id: str, instance: str, used_bytes: int) -> None:
+        with self._updating(project_id, instance) as entry:
+            entry['used_bytes'] = used_bytes
+
+    def record_duration(self, project_id: str, instance: str, seconds: float) -> None:
+        with self._updating(project_id, instance) as entry:
+            entry['durations'] = (entry['durations'] + [round(seconds)])[-SCAN_HISTORY_LENGTH:]
+
+    def expected_duration(self, project_id: str, instance: str) -> float:
+        """Expected scan time in seconds: median of previous runs, else estimated from size."""
+        with self._lock:
+            entry = self._entries.get(f"{project_id}/{instance}", {})
+        if entry.get('durations'):
+            return statistics.median(entry['durations'])
+        if entry.get('used_bytes'):
+            return entry['used_bytes'] / ASSUMED_SCAN_BYTES_PER_SECOND
+        return DEFAULT_EXPECTED_SCAN_SECONDS
+
+class CompletionScheduler:
+    """Priority queue of the next time each running scan should be checked."""
+
+    def __init__(self, history: ScanHistory):
+        self.history = history
+        self._queue = []
+        self._started = {}
+        self._failed_checks = {}
+        self._sequence = 0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _push(self, target: tuple, due: float) -> None:
+        self._sequence += 1
+        heapq.heappush(self._queue, (due, self._sequence, target))
+
+    def _remaining(self, target: tuple, now: float) -> float:
+        """Seconds until the scan of target is expected to end; negative once overdue."""
+        project_id, _, instance = target
+        return self.history.expected_duration(project_id, instance) - (now - self._started[target])
+
+    def next_delay(self, target: tuple, now: float) -> float:
+        """Seconds until target should be checked again."""
+        remaining = self._remaining(target, now)
+        if remaining > 0:
+            # Check when the scan is expected to end (minus the long-poll window),
+            # however far off that is
+            delay = max(remaining - LONG_POLL_TIMEOUT, MIN_CHECK_INTERVAL)
+        else:
+            # Overdue: back off in proportion to how far past the estimate we are
+            delay = min(max(-remaining / 4, MIN_CHECK_INTERVAL), MAX_CHECK_INTERVAL)
+        if STREAM_FINDINGS:
+            # Collect streamed findings while the scan runs
+            delay = max(min(delay, FINDINGS_POLL_INTERVAL), MIN_CHECK_INTERVAL)
+        return delay
+
+    def long_poll_timeout(self, target: tuple, now: float) -> int:
+        """LONG_POLL_TIMEOUT once the scan of target is due to end within it, otherwise 0,
+        so checks before then are quick and do not hold a session and a concurrency slot."""
+        return LONG_POLL_TIMEOUT if self._remaining(target, now) <= LONG_POLL_TIMEOUT else 0
+
+    def add(self, target: tuple, started_at: float) -> None:
+        self._started[target] = started_at
+        self._push(target, started_at + self.next_delay(target, started_at))
+
+    def reschedule(self, target: tuple) -> None:
+        now = time.time()
+        failed = self._failed_checks.get(target, 0)
+        if failed:
+            # The last check failed: back off exponentially rather than by the estimate
+            self._push(target, now + min(MIN_CHECK_INTERVAL * 2 ** (failed - 1), MAX_CHECK_INTERVAL))
+        else:
+            self._push(target, now + self.next_delay(target, now))
+
+    def check_failed(self, target: tuple) -> int:
+        """Count a failed status check of target. Returns the failed checks in a row."""
+        self._failed_checks[target] = self._failed_checks.get(target, 0) + 1
+        return self._failed_checks[target]
+
+    def check_succeeded(self, target: tuple) -> None:
+        self._failed_checks.pop(target, None)
+
+    def complete(self, target: tuple) -> float:
+        """Record and return the observed duration of a finished scan."""
+        project_id, _, instance = target
+        self._failed_checks.pop(target, None)
+        seconds = time.time() - self._started.pop(target)
+        self.history.record_duration(project_id, instance, seconds)
+        return seconds
+
+    def abandon(self, target: tuple) -> None:
+        """Stop tracking a scan whose completion could not be determined."""
+        self._failed_checks.pop(target, None)
+        self._started.pop(target, None)
+
+    def pop_due(self, now: float) -> List[tuple]:
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            due.append(heapq.heappop(self._queue)[2])
+        return due
+
+    def seconds_until_next(self, now: float) -> Optional[float]:
+        return max(self._queue[0][0] - now, 0) if self._queue else None
+
+class RollingSchedule:
+    """Rolling rescans for daemon mode, handed out like the leases of a WorkQueue.
+
+    Each instance is due at its slot once per DAEMON_SCAN_PERIOD. Instances are
+    handed out one report window at a time: lease() returns nothing once the
+    window has ended, and the window is drained at its end. Scans still running
+    then are carried over and handed out first in the next window, to reattach.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            self._state = json.loads(path.read_text())
+        except (OSError, ValueError):
+            # Instances are first due at their slot after the daemon first started
+            self._state = {'created_at': time.time(), 'instances': {}}
+        # Scans left running by an earlier daemon process, reattached first
+        self._orphans = {tuple(key.split('/')) for key, entry in self._state['instances'].items()
+                         if entry.get('running')}
+        self._running = set()
+        # Instances whose scan could not be started in the current window
+        self._failed = set()
+        self._offsets = {}
+        self.instances = []
+        self.window_end = 0
+
+    def _save(self) -> None:
+        tmp_path = self.path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self._state, indent=2))
+        os.replace(tmp_path, self.path)
+
+    def start_window(self, instances: List[tuple], window_end: float) -> None:
+        """Hand out the due ones of instances until window_end."""
+        self.instances = instances
+        self.window_end = window_end
+        self._failed.clear()
+        zones = {}
+        for target in instances:
+            zones.setdefault(target[:2], []).append(target)
+        self._offsets = {}
+        for zone, targets in zones.items():
+            # Stable order within the zone, so offsets only shift when instances come or go
+            targets.sort(key=lambda target: zlib.crc32('/'.join(target).encode()))
+            phase = zlib.crc32('/'.join(zone).encode()) / 2 ** 32
+            for rank, target in enumerate(targets):
+                self._offsets[target] = (rank + phase) / len(targets) * DAEMON_SCAN_PERIOD
+
+    def _due_since(self, target: tuple, now: float) -> Optional[float]:
+        """Start of the instance's latest slot, if it has not been scanned since."""
+        slot = now - (now - self._offsets[target]) % DAEMON_SCAN_PERIOD
+        entry = self._state['instances'].get('/'.join(target), {})
+        return slot if slot > entry.get('last_started', self._state['created_at']) else None
+
+    def lease(self, worker: str, count: int, lease_seconds: float, max_leases: int) -> List[tuple]:
+        """Up to count due instances as (target, leases) pairs, within the limit of instances
+        scanning at once. Scans left running by an earlier process come with leases 2."""
+        now = time.time()
+        if now >= self.window_end:
+            return []
+        with self._lock:
+            leased = [(target, 2) for target in sorted(self._orphans) if target in self._offsets][:count]
+            limit = max(1, int(DAEMON_MAX_SCANNING_FRACTION * len(self.instances)))
+            due = sorted((slot, target) for target in self.instances
+                         if target not in self._running and target not in self._orphans
+                         and target not in self._failed
+                         for slot in [self._due_since(target, now)] if slot is not None)
+            room = min(count - len(leased), limit - len(self._running) - len(leased))
+            leased += [(target, 1) for _, target in due[:max(room, 0)]]
+            for target, _ in leased:
+                self._orphans.discard(target)
+                self._running.add(target)
+                self._state['instances'].setdefault('/'.join(target), {})['running'] = True
+            if leased:
+                self._save()
+        return leased
+
+    def started(self, target: tuple, at: float) -> None:
+        """Record that the instance's scan started at at. Only started scans count as done
+        for their slot, so one whose deploy failed is due again in the next window."""
+        with self._lock:
+            self._state['instances'].setdefault('/'.join(target), {})['last_started'] = at
+            self._save()
+
+    def heartbeat(self, worker: str, targets: List[tuple], lease_seconds: float) -> List[tuple]:
+        return []
+
+    def started_at(self, target: tuple) -> float:
+        """When the instance's current or last scan was handed out."""
+        with self._lock:
+            return self._state['instances'].get('/'.join(target), {}).get('last_started', time.time())
+
+    def carry_over(self) -> List[tuple]:
+        """End the window's hold on the scans still running, so the next window reattaches
+        to them first. Returns them."""
+        with self._lock:
+            running = sorted(self._running)
+            self._orphans.update(running)
+            self._running.clear()
+        return running
+
+    def finish(self, worker: str, target: tuple, ok: bool, fragment: Optional[Dict] = None,
+               metrics: Optional[Dict] = None) -> bool:
+        with self._lock:
+            self._running.discard(target)
+            if not ok:
+                self._failed.add(target)
+            self._state['instances'].setdefault('/'.join(target), {})['running'] = False
+            self._save()
+        return True
+
+    def release(self, worker: str) -> int:
+        # Running scans stay marked running and are reattached after a restart
+        return 0
+
+    def drained(self) -> bool:
+        return time.time() >= self.window_end
+
+class KnownCleanCache:
+    """SQLite store of file hashes scanned clean, keyed by signature database version."""
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS known_clean ('
+            ' db_version INTEGER NOT NULL,'
+            ' hash TEXT NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' seen INTEGER NOT NULL DEFAULT 1,'
+            ' PRIMARY KEY (db_version, hash))'
+        )
+        self._db.commit()
+
+    def add_scan_results(self, clean_hashes_path: Path) -> int:
+        """Merge a clean_hashes.tsv.gz written by run_clamav_scan.sh. Returns the number of hashes read."""
+        with gzip.open(clean_hashes_path, 'rt') as f:
+            header = f.readline().strip()
+            if not header.startswith('# db_version=') or not header.split('=', 1)[1].isdigit():
+                return 0
+            db_version = int(header.split('=', 1)[1])
+            rows = []
+            for line in f:
+                file_hash, _, size = line.rstrip('\n').partition('\t')
+                if len(file_hash) == 64 and size.isdigit():
+                    rows.append((db_version, file_hash, int(size)))
+        with self._lock:
+            self._db.executemany(
+                'INSERT INTO known_clean (db_version, hash, size) VALUES (?, ?, ?) '
+                'ON CONFLICT (db_version, hash) DO UPDATE SET seen = seen + 1',
+                rows
+            )
+            self._db.commit()
+        return len(rows)
+
+    def export(self, path: Path) -> bool:
+        """Write the most frequently seen hashes for the newest signature database to path.
+        Older database versions beyond KNOWN_CLEAN_DB_VERSIONS_KEPT are evicted first.
+        Returns False if there is nothing to ship."""
+        with self._lock:
+            versions = [row[0] for row in self._db.execute(
+                'SELECT DISTINCT db_version FROM known_clean ORDER BY db_version DESC')]
+            for old_version in versions[KNOWN_CLEAN_DB_VERSIONS_KEPT:]:
+                self._db.execute('DELETE FROM known_clean WHERE db_version = ?', (old_version,))
+            self._db.commit()
+            if not versions:
+                return False
+            hashes = self._db.execute(
+                'SELECT hash FROM known_clean WHERE db_version = ? AND seen >= ? ORDER BY seen DESC LIMIT ?',
+                (versions[0], KNOWN_CLEAN_MIN_SEEN, KNOWN_CLEAN_MAX_ENTRIES)
+            )
+            # Replaced atomically, as other processes may be shipping the current file
+            tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            with gzip.open(tmp_path, 'wt') as f:
+                f.write(f"# db_version={versions[0]}\n")
+                count = 0
+                for (file_hash,) in hashes:
+                    f.write(file_hash + '\n')
+                    count += 1
+            os.replace(tmp_path, path)
+        print(f"Known-clean cache: shipping {count} hashes for signature database {versions[0]}")
+        return count > 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+class ScanStaging:
+    """Pinned scan image and signature database snapshot, resolved once on the orchestrator.
+
+    Remembers which instances already hold the staged image and snapshot so they
+    are only shipped to instances that need them.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.image_ref = None      # repository@sha256 digest, used for pulls
+        self.image_id = None       # Local image ID, unchanged by docker save/load
+        self.image_archive = None
+        self.db_version = None
+        self.db_archive = None
+        self._lock = threading.Lock()
+        self._hosts_path = directory / "hosts.json"
+        self._hosts = {}
+        if self._hosts_path.exists():
+            try:
+                self._hosts = json.loads(self._hosts_path.read_text())
+            except (OSError, ValueError) as e:
+                print(f"Warning: Ignoring unreadable staging state {self._hosts_path}: {e}")
+
+    def stage(self) -> bool:
+        """Pull and pin SCAN_IMAGE and prepare the signature database. Returns False on failure."""
+        print(f"\nStaging {SCAN_IMAGE} for {STAGING_PLATFORM}...")
+        try:
+            self._docker('pull', '--quiet', f'--platform={STAGING_PLATFORM}', SCAN_IMAGE)
+            image_id, repo_digest = self._docker(
+                'image', 'inspect', '--format', '{{.Id}} {{index .RepoDigests 0}}', SCAN_IMAGE
+            ).split()
+            self.image_id = image_id
+            self.image_ref = repo_digest
+            if STAGE_IMAGE_TRANSFER == 'tunnel':
+                self.image_archive = self._save_image()
+            if REFRESH_SIGNATURES:
+                self.db_archive, self.db_version = self._signature_snapshot()
+            else:
+                # "ClamAV <engine>/<db version>/<db date>"
+                version = self._docker('run', '--rm', f'--platform={STAGING_PLATFORM}', self.image_id,
+                                       'clamscan', '--version')
+                self.db_version = version.split('/')[1] if version.count('/') >= 2 else None
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError, ValueError) as e:
+            print(f"Error staging scan image: {e}")
+            return False
+        print(f"Staged {self.image_ref} with signature database {self.db_version}")
+        return True
+
+    def _docker(self, *args: str) -> str:
+        result = subprocess.run(['docker', *args], capture_output=True, text=True, check=True, timeout=1800)
+        return result.stdout.strip()
+
+    def _save_image(self) -> Path:
+        """gzip'd docker save of the pinned image, reused while the digest is unchanged."""
+        archive = self.directory / f"image-{self.image_id.split(':')[-1][:12]}.tar.gz"
+        if archive.exists():
+            return archive
+        partial = archive.with_suffix('.partial')
+        # By ID, as SCAN_IMAGE may have been retagged since it was pinned
+        with subprocess.Popen(['docker', 'save', self.image_id], stdout=subprocess.PIPE) as process:
+            with gzip.open(partial, 'wb', compresslevel=6) as f:
+                shutil.copyfileobj(process.stdout, f)
+        if process.returncode != 0:
+            partial.unlink()
+            raise subprocess.CalledProcessError(process.returncode, 'docker save')
+        os.replace(partial, archive)
+        for old in self.directory.glob('image-*.tar.gz'):
+            if old != archive:
+                old.unlink()
+        return archive
+
+    def _signature_snapshot(self):
+        """Newest signature database snapshot as (archive, version), running freshclam if it is too old."""
+        snapshots = sorted(self.directory.glob('clamav-db-*.tar.gz'), key=lambda path: path.stat().st_mtime)
+        if snapshots and time.time() - snapshots[-1].stat().st_mtime < SIGNATURE_SNAPSHOT_MAX_AGE:
+            return snapshots[-1], snapshots[-1].name[len('clamav-db-'):-len('.tar.gz')]
+
+        print("Updating signature database with freshclam...")
+        partial = self.directory / "clamav-db.partial"
+        with open(partial, 'wb') as f:
+            subprocess.run(
+                ['docker', 'run', '--rm', f'--platform={STAGING_PLATFORM}', '--entrypoint', '/bin/sh', self.image_id,
+                 '-c', 'freshclam --stdout >&2 && tar -czf - -C /var/lib/clamav .'],
+                stdout=f, stderr=subprocess.PIPE, check=True, timeout=1800
+            )
+        # The daily database header is "ClamAV-VDB:<build time>:<version>:..."
+        with tarfile.open(partial, 'r:gz') as snapshot:
+            member = next(m for m in snapshot.getmembers()
+                          if os.path.basename(m.name) in ('daily.cvd', 'daily.cld'))
+            version = snapshot.extractfile(member).read(512).decode(errors='replace').split(':')[2]
+        if not version.isdigit():
+            raise ValueError(f"Unexpected daily database header version: {version}")
+        archive = self.directory / f"clamav-db-{version}.tar.gz"
+        os.replace(partial, archive)
+        for old in snapshots:
+            if old != archive:
+                old.unlink()
+        return archive, version
+
+    def state(self) -> Dict[str, Optional[str]]:
+        """What stage() resolved, for the workers of a coordinated run to restore()."""
+        return {
+            'image_ref': self.image_ref,
+            'image_id': self.image_id,
+            'image_archive': self.image_archive.name if self.image_archive else None,
+            'db_version': self.db_version,
+            'db_archive': self.db_archive.name if self.db_archive else None
+        }
+
+    def restore(self, state: Dict[str, Optional[str]]) -> bool:
+        """Use the assets staged by another process from state(), instead of staging again.
+        Returns False if a staged file is missing from the staging directory."""
+        archives = {name: self.directory / state[name] if state[name] else None
+                    for name in ('image_archive', 'db_archive')}
+        missing = [path.name for path in archives.values() if path is not None and not path.exists()]
+        if missing:
+            print(f"Staged files missing from {self.directory}: {', '.join(missing)}")
+            return False
+        self.image_ref = state['image_ref']
+        self.image_id = state['image_id']
+        self.image_archive = archives['image_archive']
+        self.db_version = state['db_version']
+        self.db_archive = archives['db_archive']
+        print(f"Using {self.image_ref} with signature database {self.db_version}, staged by the coordinator")
+        return True
+
+    def environment(self) -> Dict[str, str]:
+        """Settings telling run_clamav_scan.sh which image and snapshot to use."""
+        return {
+            'SCAN_IMAGE': self.image_ref,
+            'SCAN_IMAGE_ID': self.image_id,
+            'SCAN_IMAGE_ARCHIVE': self.image_archive.name if self.image_archive else '',
+            'SCAN_DB_VERSION': self.db_version if self.db_archive else ''
+        }
+
+    def needs_image(self, project_id: str, instance: str) -> bool:
+        """Whether the saved image must be uploaded to the instance (see ship_image)."""
+        with self._lock:
+            host = self._hosts.get(f"{project_id}/{instance}", {})
+        return bool(self.image_archive) and host.get('image') != self.image_id
+
+    def inputs(self, project_id: str, instance: str) -> Dict[str, Path]:
+        """Staged files the instance does not have yet, other than the image."""
+        with self._lock:
+            host = self._hosts.get(f"{project_id}/{instance}", {})
+        inputs = {}
+        if self.db_archive and host.get('db_snapshot') != self.db_version:
+            inputs['clamav-db.tar.gz'] = self.db_archive
+        return inputs
+
+    def record_host(self, project_id: str, instance: str, scan_info: Dict[str, str]) -> None:
+        """Remember the image and snapshot an instance held for its last scan."""
+        with self._lock, locked_json(self._hosts_path) as hosts:
+            hosts[f"{project_id}/{instance}"] = {
+                'image': scan_info.get('image', ''),
+                'db_snapshot': scan_info.get('db_snapshot', '')
+            }
+            self._hosts = hosts
+
+# Set by run_scans() from SCRIPT_DIR / "scan_history.json"
+SCAN_HISTORY = None
+# Set by run_scans() when KNOWN_CLEAN_CACHE is enabled
+KNOWN_CLEAN = None
+# Set by run_scans() when STAGE_SCAN_ASSETS is enabled and staging succeeded
+STAGING = None
+# Set by run_scans() from RESULTS_INDEX_PATH
+RESULTS_INDEX = None
+# Set by run_scans(); report fragments of instances whose results were retrieved
+REPORT_FRAGMENTS = None
+# Set by run_scans(); phase timings and call counters of the current run
+METRICS = None
+# Set by run_scans() from RUN_JOURNAL_PATH
+JOURNAL = None
+# Set by run_scans(); findings streamed from scans still running
+LIVE_FINDINGS = None
+# Set by run_scans() from ARCHIVE_DIR when ARCHIVE_RESULTS is enabled
+ARCHIVE = None
+
+@contextmanager
+def timed_phase(project_id: str, zone: str, instance: str, phase: str):
+    """Time a lifecycle phase for the run metrics and the results index. The phase
+    counts as failed if it raises or a gcloud/ssh call made in it fails after its
+    retries; the yielded record's 'ok' and 'failure' class say which once the
+    block has exited."""
+    record = None
+    try:
+        with METRICS.phase(project_id, zone, instance, phase) as record:
+            yield record
+    finally:
+        if RESULTS_INDEX is not None and instance and record is not None:
+            RESULTS_INDEX.record_phase(project_id, instance, phase, record['started_at'],
+                                       record['finished_at'], record['ok'], record['failure'])
+
+def _local_size(path: str) -> int:
+    """Size of a local file or the files in a local directory; 0 for remote or missing paths."""
+    target = Path(path)
+    if target.is_file():
+        return target.stat().st_size
+    if target.is_dir():
+        return sum(child.stat().st_size for child in target.iterdir() if child.is_file())
+    return 0
+
+def run_command(args: List[str], **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run for gcloud/ssh/scp calls, counting the call, its bytes on
+    stdin/stdout and whether it failed towards the current phase's metrics."""
+    if METRICS is None:
+        return subprocess.run(args, **kwargs)
+    sent = kwargs.get('input') or b''
+    try:
+        result = subprocess.run(args, **kwargs)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        METRICS.record_call(False, len(sent), len(e.stdout or b''))
+        raise
+    METRICS.record_call(result.returncode == 0, len(sent), len(result.stdout or b''))
+    return result
+
+def priority_tiers() -> str:
+    """PRIORITY_TIERS in the form run_clamav_scan.sh expects: tiers separated by ";", paths by spaces."""
+    for path in (path for tier in PRIORITY_TIERS for path in tier):
+        if not path.startswith('/') or re.search(r'[\s;]', path):
+            raise ValueError(f"Invalid path in PRIORITY_TIERS: {path!r}")
+    return ';'.join(' '.join(path.rstrip('/') or '/' for path in tier) for tier in PRIORITY_TIERS)
+
+def scan_environment() -> str:
+    """Scan settings passed to run_clamav_scan.sh, as NAME=value pairs for a shell export."""
+    if SCAN_MODE not in ('single', 'multiscan', 'sharded'):
+        raise ValueError(f"Unknown SCAN_MODE: {SCAN_MODE}")
+    if SCAN_PROFILE not in SCAN_PROFILES:
+        raise ValueError(f"Unknown SCAN_PROFILE: {SCAN_PROFILE}")
+    settings = {
+        'SCAN_MODE': SCAN_MODE,
+        'SCAN_WORKERS': SCAN_WORKERS,
+        'SCAN_PROFILE': SCAN_PROFILE,
+        'SCAN_INCREMENTAL': int(INCREMENTAL_SCAN),
+        'SCAN_FULL': int(FORCE_FULL_SCAN),
+        'SCAN_HASH': int(MANIFEST_CONTENT_HASH),
+        'SCAN_KNOWN_CLEAN': int(KNOWN_CLEAN_CACHE),
+        'SCAN_IMAGE': SCAN_IMAGE,
+        'SCAN_PRIORITY_TIERS': priority_tiers() if PRIORITY_SCAN else '',
+        'SCAN_STREAM_FINDINGS': int(STREAM_FINDINGS)
+    }
+    for name, value in SCAN_PROFILES[SCAN_PROFILE].items():
+        settings[f"SCAN_{name.upper()}"] = value
+    if STAGING is not None:
+        settings.update(STAGING.environment())
+    return ' '.join(f"{name}={shlex.quote(str(value))}" for name, value in settings.items())
+
+def manifest_path(project_id: str, instance: str) -> Path:
+    """Local copy of the instance's file manifest from its last completed scan."""
+    return MANIFEST_DIR / project_id / f"{instance}.tsv.gz"
+
+def scan_inputs(project_id: str, instance: str) -> Dict[str, Path]:
+    """Files shipped to ~/clamav-inputs on the instance alongside the scan script."""
+    inputs = {}
+    if INCREMENTAL_SCAN and manifest_path(project_id, instance).exists():
+        inputs['manifest.tsv.gz'] = manifest_path(project_id, instance)
+    if KNOWN_CLEAN_CACHE and KNOWN_CLEAN_EXPORT_PATH.exists():
+        inputs['known-clean.txt.gz'] = KNOWN_CLEAN_EXPORT_PATH
+    if STAGING is not None:
+        inputs.update(STAGING.inputs(project_id, instance))
+    return inputs
+
+def build_deploy_bundle(project_id: str, instance: str) -> bytes:
+    """tar.gz of the scan script and its inputs, unpacked into the home directory on the instance."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as bundle:
+        script = SCAN_SCRIPT_CONTENT.encode()
+        info = tarfile.TarInfo('run_clamav_scan.sh')
+        info.size = len(script)
+        info.mode = 0o755
+        info.mtime = int(time.time())
+        bundle.addfile(info, io.BytesIO(script))
+        for name, path in scan_inputs(project_id, instance).items():
+            bundle.add(str(path), arcname=f'clamav-inputs/{name}')
+    return buffer.getvalue()
+
+def build_ssh_command(project_id: str, zone: str, instance: str, command: str) -> List[str]:
+    """Build a gcloud compute ssh command that runs command on the instance over IAP."""
+    return [
+        'gcloud', 'compute', 'ssh',
+        f'--project={project_id}',
+        f'--zone={zone}',
+        instance,
+        '--command', command,
+        '--quiet',
+        '--tunnel-through-iap'
+    ]
+
+def build_scp_command(project_id: str, zone: str, source: str, destination: str) -> List[str]:
+    """Build a gcloud compute scp command that copies over IAP."""
+    return [
+        'gcloud', 'compute', 'scp',
+        f'--project={project_id}',
+        f'--zone={zone}',
+        '--quiet',
+        '--tunnel-through-iap',
+        source,
+        destination
+    ]
+
+def run_ssh(project_id: str, zone: str, instance: str, command: str, operation: str = 'default',
+            check: bool = False, timeout: Optional[float] = None, **kwargs) -> subprocess.CompletedProcess:
+    """Run command on the instance, reusing its pooled connection when the pool is enabled.
+    The call is guarded by the deadline and retries for operation (see guarded_call).
+    Other keyword arguments are passed to subprocess.run."""
+    def attempt(seconds_left):
+        if CONNECTION_POOL is not None:
+            return CONNECTION_POOL.run_ssh(project_id, zone, instance, command, timeout=seconds_left, **kwargs)
+        return run_command(build_ssh_command(project_id, zone, instance, command), timeout=seconds_left, **kwargs)
+    return guarded_call((project_id, zone), operation, attempt, check, timeout)
+
+def run_scp(project_id: str, zone: str, instance: str, source: str, destination: str, operation: str = 'default',
+            check: bool = False, timeout: Optional[float] = None, **kwargs) -> subprocess.CompletedProcess:
+    """Copy files to or from the instance (remote paths as instance:path), guarded like run_ssh.
+    Other keyword arguments are passed to subprocess.run."""
+    def attempt(seconds_left):
+        if CONNECTION_POOL is not None:
+            return CONNECTION_POOL.run_scp(project_id, zone, instance, source, destination,
+                                           timeout=seconds_left, **kwargs)
+        return run_command(build_scp_command(project_id, zone, source, destination), timeout=seconds_left, **kwargs)
+
+    # scp output is not the transferred data, so count local file sizes instead
+    before = _local_size(destination)
+    result = guarded_call((project_id, zone), operation, attempt, check, timeout)
+    if METRICS is not None:
+        METRICS.record_transfer(_local_size(source), max(_local_size(destination) - before, 0))
+    return result
+
 def get_projects() -> List[str]:
     """Get list of hardcoded GCP projects."""
     return PROJECTS
 
-def get_instances(project_id: str) -> List[Dict]:
-    """Get list of compute instances in a project."""
+def glob_to_regex(pattern: str) -> str:
+    """Anchored regular expression for a glob, without backslashes so it survives
+    gcloud filter quoting. Instance names only use [a-z0-9-]."""
+    regex = ''
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        end = pattern.find(']', position + 2)
+        if char == '[' and end != -1:
+            body = pattern[position + 1:end]
+            regex += '[' + ('^' + body[1:] if body.startswith('!') else body) + ']'
+            position = end + 1
+            continue
+        if char == '*':
+            regex += '.*'
+        elif char == '?':
+            regex += '.'
+        else:
+            regex += char if char.isalnum() or char == '-' else f'[{char}]'
+        position += 1
+    return f'^{regex}$'
+
+def instance_filter() -> str:
+    """gcloud --filter expression for INSTANCE_FILTERS, INSTANCE_STATUSES and INSTANCE_LABELS."""
+    terms = []
+    names = [pattern[3:] if pattern.startswith('re:') else glob_to_regex(pattern) for pattern in INSTANCE_FILTERS]
+    if names:
+        terms.append('(' + ' OR '.join('name ~ "{}"'.format(name.replace('"', '\\"')) for name in names) + ')')
+    if INSTANCE_STATUSES:
+        terms.append('(' + ' OR '.join(f'status={status}' for status in INSTANCE_STATUSES) + ')')
+    terms.extend(f'labels.{key}={value}' for key, value in sorted(INSTANCE_LABELS.items()))
+    return ' AND '.join(terms)
+
+def instance_matches(instance: Dict) -> bool:
+    """Whether a listed instance passes INSTANCE_FILTERS, INSTANCE_STATUSES and INSTANCE_LABELS."""
+    name = instance.get('name', '')
+    if not any(
+            re.search(pattern[3:], name) if pattern.startswith('re:') else fnmatch.fnmatchcase(name, pattern)
+            for pattern in INSTANCE_FILTERS):
+        return False
+    if INSTANCE_STATUSES and instance.get('status') not in INSTANCE_STATUSES:
+        return False
+    labels = instance.get('labels') or {}
+    return all(labels.get(key) == value for key, value in INSTANCE_LABELS.items())
+
+def get_instances(project_id: str, filter_expression: str = '') -> Optional[List[Dict]]:
+    """List the name, zone, status and labels of a project's instances matching
+    filter_expression. Returns None if the listing failed."""
+    command = ['gcloud', 'compute', 'instances', 'list',
+               f'--project={project_id}',
+               '--format=json(name,zone.basename(),status,labels)']
+    if filter_expression:
+        command.append(f'--filter={filter_expression}')
     try:
-        result = subprocess.run(
-            ['gcloud', 'compute', 'instances', 'list',
-             f'--project={project_id}',
-             '--format=json'],
-            capture_output=True,
-            text=True,
+        result = guarded_call(
+            (project_id, ''), 'list',
+            lambda seconds_left: run_command(command, capture_output=True, text=True, timeout=seconds_left),
             check=True
         )
         return json.loads(result.stdout)
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, ValueError) as e:
         print(f"Error getting instances for project {project_id}: {e}")
+        return None
+
+class InstanceInventory:
+    """Instance listings per project, cached as JSON for INVENTORY_CACHE_TTL seconds."""
+
+    def __init__(self, path: Path, ttl: float = INVENTORY_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        try:
+            self._entries = json.loads(path.read_text())
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def cached(self, project_id: str, filter_expression: str, max_age: Optional[float] = None) -> Optional[List[Dict]]:
+        """A cached listing made with the same filter, if younger than max_age (the TTL by default)."""
+        with self._lock:
+            entry = self._entries.get(project_id)
+        if entry is None or entry.get('filter') != filter_expression:
+            return None
+        if time.time() - entry['listed_at'] > (self.ttl if max_age is None else max_age):
+            return None
+        return entry['instances']
+
+    def listed_at(self, project_id: str) -> Optional[float]:
+        with self._lock:
+            return self._entries.get(project_id, {}).get('listed_at')
+
+    def store(self, project_id: str, filter_expression: str, instances: List[Dict]) -> None:
+        with self._lock:
+            self._entries[project_id] = {'filter': filter_expression, 'listed_at': time.time(), 'instances': instances}
+            tmp_path = self.path.with_suffix('.tmp')
+            tmp_path.write_text(json.dumps(self._entries))
+            os.replace(tmp_path, self.path)
+
+    def list(self, project_id: str, filter_expression: str, refresh: bool = False) -> List[Dict]:
+        """A project's instances, from the cache when it is fresh. A failed listing
+        falls back to the last cached one, however old."""
+        if not refresh and self.ttl > 0:
+            instances = self.cached(project_id, filter_expression)
+            if instances is not None:
+                print(f"Using cached inventory of {project_id} ({len(instances)} instances)")
+                return instances
+        instances = get_instances(project_id, filter_expression)
+        if instances is not None:
+            self.store(project_id, filter_expression, instances)
+            return instances
+        instances = self.cached(project_id, filter_expression, max_age=float('inf'))
+        if instances is None:
+            return []
+        age = (time.time() - self.listed_at(project_id)) / 60
+        print(f"Warning: Using the inventory of {project_id} cached {age:.0f} minutes ago")
+        return instances
+
+def discover_instances(projects: List[str], refresh: bool = False) -> List[tuple]:
+    """(project, zone, instance) of every instance to scan, listing projects in parallel."""
+    if not INSTANCE_FILTERS:
+        print("Warning: INSTANCE_FILTERS is empty, no instances to scan (use ['*'] to scan all)")
         return []
+    inventory = InstanceInventory(INVENTORY_CACHE_PATH)
+    filter_expression = instance_filter()
+
+    def list_project(project_id):
+        print(f"\nChecking project: {project_id}")
+        with timed_phase(project_id, '', '', 'list'):
+            return inventory.list(project_id, filter_expression, refresh)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(projects), INVENTORY_LIST_WORKERS))) as executor:
+        listings = list(executor.map(list_project, projects))
+    return [
+        (project_id, instance['zone'].split('/')[-1], instance['name'])
+        for project_id, instances in zip(projects, listings)
+        for instance in instances if instance_matches(instance)
+    ]
+
+def ship_image(project_id: str, zone: str, instance: str) -> bool:
+    """Upload the staged image archive to the instance, streamed from disk. A dropped
+    upload resumes from the bytes the instance already holds, until the 'image' deadline."""
+    archive = STAGING.image_archive
+    size = archive.stat().st_size
+    deadline = time.time() + CALL_DEADLINES['image']
+    attempt = 0
+    while True:
+        result = run_ssh(project_id, zone, instance, IMAGE_OFFSET_COMMAND.format(name=archive.name),
+                         operation='probe', stdin=subprocess.DEVNULL, capture_output=True)
+        answer = (result.stdout or b'').decode(errors='replace').strip()
+        if result.failure is None and answer == 'complete':
+            return True
+        if result.failure is None and answer.isdigit():
+            offset = int(answer) if int(answer) <= size else 0
+            print(f"Uploading scan image to {instance} ({format_bytes(size - offset)}"
+                  f"{f', resuming at {format_bytes(offset)}' if offset else ''})")
+            with open(archive, 'rb') as f:
+                f.seek(offset)
+                result = run_ssh(project_id, zone, instance,
+                                 IMAGE_APPEND_COMMAND.format(name=archive.name, offset=offset, size=size),
+                                 operation='image', timeout=max(deadline - time.time(), 1),
+                                 stdin=f, capture_output=True)
+                sent = f.tell() - offset
+            if METRICS is not None:
+                METRICS.record_transfer(sent, 0)
+            if result.failure is None:
+                return True
+        failure = result.failure or 'error'
+        attempt += 1
+        backoff = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        if failure not in TRANSIENT_FAILURES or time.time() + backoff >= deadline:
+            print(f"Error uploading scan image to {instance}: {failure}")
+            return False
+        time.sleep(backoff)
 
 def deploy_and_start_scan(project_id: str, zone: str, instance: str) -> None:
     print(f"\nDeploying ClamAV scan to {instance} (Project: {project_id}, Zone: {zone})")
+    if STAGING is not None and STAGING.needs_image(project_id, instance) and not ship_image(project_id, zone, instance):
+        print(f"{instance} will pull the scan image instead")
+    if SINGLE_SESSION_TRANSFER:
+        stream_and_start_scan(project_id, zone, instance)
+        return
+
     try:
         # Copy script to instance
-        scp_command = [
-            'gcloud', 'compute', 'scp',
-            f'--project={project_id}',
-            f'--zone={zone}',
-            '--quiet',
-            '--tunnel-through-iap',
-            str(SCAN_SCRIPT_PATH),
-            f'{instance}:~/run_clamav_scan.sh'
-        ]
-        subprocess.run(scp_command, check=True)
+        run_scp(project_id, zone, instance, str(SCAN_SCRIPT_PATH), f'{instance}:~/run_clamav_scan.sh',
+                operation='deploy', check=True)
 
         # First SSH command: Make script executable
-        chmod_command = [
-            'gcloud', 'compute', 'ssh',
-            f'--project={project_id}',
-            f'--zone={zone}',
-            instance,
-            '--command', 'chmod +x ~/run_clamav_scan.sh',
-            '--quiet',
-            '--tunnel-through-iap'
-        ]
-        subprocess.run(chmod_command, check=True)
-
-        # Second SSH command: Start the scan in background
-        start_scan_command = [
-            'gcloud', 'compute', 'ssh',
-            f'--project={project_id}',
-            f'--zone={zone}',
-            instance,
-            '--command', 'export TARGET_HOME=$HOME && nohup sudo -E bash ~/run_clamav_scan.sh "$TARGET_HOME" </dev/null >/dev/null 2>&1',
-            '--quiet',
-            '--tunnel-through-iap'
-        ]
-        process = subprocess.Popen(
-            start_scan_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
+        run_ssh(project_id, zone, instance, 'chmod +x ~/run_clamav_scan.sh && rm -rf ~/clamav-inputs && mkdir ~/clamav-inputs',
+                operation='deploy', check=True)
+
+        # Copy the scan inputs (such as the previous file manifest)
+        for name, path in scan_inputs(project_id, instance).items():
+            run_scp(project_id, zone, instance, str(path), f'{instance}:~/clamav-inputs/{name}',
+                    operation='deploy', check=True)
+
+        # Second SSH command: Start the scan detached in the background, so the session returns at once
+        run_ssh(
+            project_id, zone, instance,
+            f'export TARGET_HOME=$HOME {scan_environment()} && '
+            '(setsid nohup sudo -E bash ~/run_clamav_scan.sh "$TARGET_HOME" </dev/null >/dev/null 2>&1 &)',
+            operation='deploy',
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            check=True
         )
-        
-        # Wait a short time for immediate errors
-        try:
-            stdout, stderr = process.communicate(timeout=10)
-            if process.returncode == 0:
-                print(f"Scan started successfully on {instance}")
-            else:
-                print(f"Warning: Scan start may have failed on {instance}")
-                print(f"stderr: {stderr}")
-        except subprocess.TimeoutExpired:
-            # If it times out, assume the scan started successfully
-            print(f"Scan appears to be running on {instance}")
-            process.kill()
+        print(f"Scan started successfully on {instance}")
 
     except subprocess.CalledProcessError as e:
         print(f"Error during deployment: {e}")
         print(f"Error output: {e.stderr if hasattr(e, 'stderr') else 'No error output available'}")
 
+def stream_and_start_scan(project_id: str, zone: str, instance: str) -> None:
+    """Upload the scan script and its inputs over stdin and start the scan detached, in one ssh session."""
+    try:
+        result = run_ssh(
+            project_id, zone, instance, DEPLOY_COMMAND.format(scan_environment=scan_environment()),
+            operation='deploy',
+            input=build_deploy_bundle(project_id, instance),
+            capture_output=True,
+            check=True
+        )
+        print(f"Scan started successfully on {instance}")
+        used_bytes = result.stdout.decode(errors='replace').strip().split('\n')[-1].split()[-1:]
+        if SCAN_HISTORY is not None and used_bytes and used_bytes[0].isdigit():
+            SCAN_HISTORY.record_filesystem_size(project_id, instance, int(used_bytes[0]))
+    except subprocess.CalledProcessError as e:
+        print(f"Error during deployment: {e}")
+        print(f"Error output: {e.stderr if e.stderr else 'No error output available'}")
+
+def incoming_results_dir(project_id: str, instance: str) -> Path:
+    """An empty directory next to the instance's results directory to retrieve its results into."""
+    incoming = SCRIPT_DIR / "results" / project_id / f".{instance}.incoming"
+    shutil.rmtree(incoming, ignore_errors=True)
+    incoming.mkdir(parents=True)
+    return incoming
+
+def install_results_dir(project_id: str, instance: str, incoming: Path) -> Path:
+    """Replace the instance's results directory by the completely retrieved incoming one,
+    so no file of an earlier run is mixed into the new results. Returns the results directory."""
+    results_dir = SCRIPT_DIR / "results" / project_id / instance
+    previous = incoming.with_name(f".{instance}.previous")
+    shutil.rmtree(previous, ignore_errors=True)
+    if results_dir.exists():
+        os.replace(results_dir, previous)
+    os.replace(incoming, results_dir)
+    shutil.rmtree(previous, ignore_errors=True)
+    return results_dir
+
 def retrieve_scan_results(project_id: str, zone: str, instance: str) -> None:
     """Retrieve scan results from the instance."""
     print(f"\nRetrieving results from {instance} (Project: {project_id}, Zone: {zone})")
+    incoming = incoming_results_dir(project_id, instance)
     try:
-        # Create local results directory
-        results_dir = SCRIPT_DIR / "results" / project_id / instance
-        results_dir.mkdir(parents=True, exist_ok=True)
-
-        # Copy results back
-        scp_results_command = [
-            'gcloud', 'compute', 'scp',
-            f'--project={project_id}',
-            f'--zone={zone}',
-            '--quiet',
-            '--tunnel-through-iap',
-            f'{instance}:~/clamav-logs/*.log',
-            str(results_dir)
-        ]
-        subprocess.run(scp_results_command, check=True)
-
-        # Print findings
-        findings_file = results_dir / "findings.log"
-        if findings_file.exists():
-            print("\nScan Findings:")
-            print(findings_file.read_text())
-        else:
-            print("\nNo findings file found. Scan might still be running.")
+        # Copy results back, leaving the full log on the instance unless it is wanted
+        run_ssh(project_id, zone, instance, f'cd ~/clamav-logs && {keep_full_log_command()}',
+                operation='fetch', stdin=subprocess.DEVNULL, check=True)
+        run_scp(project_id, zone, instance, f'{instance}:~/clamav-logs/*', str(incoming),
+                operation='fetch', check=True)
 
     except subprocess.CalledProcessError as e:
         print(f"Error retrieving results: {e}")
         print(f"Error output: {e.stderr if hasattr(e, 'stderr') else 'No error output available'}")
+        shutil.rmtree(incoming, ignore_errors=True)
+        return
+    process_retrieved_results(project_id, zone, instance, install_results_dir(project_id, instance, incoming))
+
+def fetch_results(project_id: str, zone: str, instance: str) -> None:
+    """Retrieve scan results as a single archive, in one ssh session that also moves
+    them aside on the instance, so no separate cleanup call is needed. A damaged
+    archive is fetched again; if it stays damaged, the fetch phase fails as 'corrupt'."""
+    print(f"\nRetrieving results from {instance} (Project: {project_id}, Zone: {zone})")
+    for attempt in range(CALL_ATTEMPTS):
+        incoming = incoming_results_dir(project_id, instance)
+        try:
+            result = run_ssh(
+                project_id, zone, instance, FETCH_RESULTS_COMMAND.format(keep_full_log=keep_full_log_command()),
+                operation='fetch',
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                check=True
+            )
+            with tarfile.open(fileobj=io.BytesIO(result.stdout), mode='r:gz') as archive:
+                for member in archive.getmembers():
+                    if not member.isfile():
+                        continue
+                    # Only keep the file name so a hostile archive cannot write outside the directory
+                    (incoming / Path(member.name).name).write_bytes(archive.extractfile(member).read())
+            break
+        except subprocess.CalledProcessError as e:
+            print(f"Error retrieving results: {e}")
+            if e.stderr:
+                print(f"Error output: {e.stderr.decode(errors='replace')}")
+            shutil.rmtree(incoming, ignore_errors=True)
+            return
+        except (tarfile.TarError, EOFError, zlib.error) as e:
+            # The results are still on the instance, so the fetch is safe to repeat
+            print(f"Error unpacking results from {instance}: {e}")
+            shutil.rmtree(incoming, ignore_errors=True)
+            if attempt == CALL_ATTEMPTS - 1:
+                if METRICS is not None:
+                    METRICS.record_failure('corrupt')
+                return
+            time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+    process_retrieved_results(project_id, zone, instance, install_results_dir(project_id, instance, incoming))
+
+def process_retrieved_results(project_id: str, zone: str, instance: str, results_dir: Path) -> None:
+    """Handle the files retrieved into results_dir: keep the new manifest, index the
+    results, build the instance's report fragment, archive the files and print findings."""
+    new_manifest = results_dir / "manifest.tsv.gz"
+    archived = [path for path in results_dir.iterdir() if path.is_file() and path.name != "report_fragment.json"]
+    if new_manifest.exists():
+        manifest_path(project_id, instance).parent.mkdir(parents=True, exist_ok=True)
+        os.replace(new_manifest, manifest_path(project_id, instance))
+        archived[archived.index(new_manifest)] = manifest_path(project_id, instance)
+    clean_hashes = results_dir / "clean_hashes.tsv.gz"
+    if clean_hashes.exists():
+        if KNOWN_CLEAN is not None:
+            KNOWN_CLEAN.add_scan_results(clean_hashes)
+        clean_hashes.unlink()
+    scan_info = read_key_values(results_dir / "scan_info.log")
+    if STAGING is not None and scan_info.get('image_source'):
+        STAGING.record_host(project_id, instance, scan_info)
+    if METRICS is not None and scan_info.get('scan_seconds', '').isdigit():
+        METRICS.record_scan(project_id, zone, instance, host_seconds=int(scan_info['scan_seconds']))
+    results = load_instance_results(results_dir)
+    if RESULTS_INDEX is not None and results is not None:
+        RESULTS_INDEX.complete_instance(project_id, instance, results, scan_info)
+    if REPORT_FRAGMENTS is not None:
+        REPORT_FRAGMENTS.add(report_fragment(project_id, zone, instance, results, scan_info))
+    if ARCHIVE is not None:
+        archive_results(project_id, zone, instance, archived)
+    print_findings(results)
+
+def archive_results(project_id: str, zone: str, instance: str, paths: List[Path]) -> None:
+    """Add the files of the instance retrieved in this run to the archive, under their file names."""
+    for path in paths:
+        try:
+            if path.exists():
+                ARCHIVE.add_file(RESULTS_INDEX.run_id, project_id, zone, instance, path.name, path)
+        except (OSError, EOFError, zlib.error, sqlite3.Error) as e:
+            print(f"Warning: Could not archive {path.name} of {instance}: {e}")
+
+def read_key_values(path: Path) -> Dict[str, str]:
+    """Read a name=value per line file written by run_clamav_scan.sh. Returns {} if missing."""
+    if not path.exists():
+        return {}
+    return parse_key_values(path.read_text().splitlines())
+
+def parse_key_values(lines) -> Dict[str, str]:
+    values = {}
+    for line in lines:
+        name, sep, value = line.partition('=')
+        if sep:
+            values[name.strip()] = value.strip()
+    return values
+
+def read_archived_key_values(run_id: int, project_id: str, instance: str, name: str) -> Dict[str, str]:
+    """read_key_values() of a file archived in run run_id. Returns {} if not archived."""
+    return parse_key_values(ARCHIVE.open_text(run_id, project_id, instance, name) or [])
+
+def format_bytes(size: float) -> str:
+    """Human-readable byte count."""
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+def format_scan_stats(summary: ScanSummary) -> str:
+    """"1234 files, 5.6 GB in 1 h 2 m" from a clamscan summary."""
+    text = f"{summary.scanned_files} files"
+    if summary.data_scanned_mb is not None:
+        text += f", {format_bytes(summary.data_scanned_mb * 1048576)}"
+    if summary.seconds is not None:
+        minutes, seconds = divmod(int(summary.seconds), 60)
+        text += f" in {minutes // 60} h {minutes % 60} m" if minutes >= 60 else f" in {minutes} m {seconds} s"
+    return text
+
+def cache_hit_rate(scan_info: Dict[str, str]) -> Optional[float]:
+    """Fraction of files to scan that the known-clean cache skipped, or None without cache data."""
+    if not scan_info.get('cache_hits'):
+        return None
+    hits = int(scan_info['cache_hits'])
+    scanned = int(scan_info.get('files_scanned') or 0)
+    return hits / (hits + scanned) if hits + scanned else None
+
+def load_instance_results(results_dir: Path) -> Optional[InstanceResults]:
+    """Scan records retrieved into results_dir, from the full log when it was transferred
+    and from summary.json otherwise. None if neither is present or readable."""
+    full_log = results_dir / "scan.log.gz"
+    try:
+        if full_log.exists():
+            return InstanceResults(parse_scan_log(open_scan_log(full_log)))
+        return InstanceResults(records_from_summary(json.loads((results_dir / "summary.json").read_text())))
+    except (OSError, EOFError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f"Warning: Could not read scan results in {results_dir}: {e}")
+        return None
+
+def load_archived_results(run_id: int, project_id: str, instance: str) -> Optional[InstanceResults]:
+    """load_instance_results() of the files archived in run run_id, streamed from the archive."""
+    try:
+        full_log = ARCHIVE.open_text(run_id, project_id, instance, "scan.log.gz")
+        if full_log is not None:
+            return InstanceResults(parse_scan_log(full_log))
+        summary = ARCHIVE.read_json(run_id, project_id, instance, "summary.json")
+        return InstanceResults(records_from_summary(summary)) if summary is not None else None
+    except (OSError, zlib.error) as e:
+        print(f"Warning: Could not read the archived results of {instance} in run {run_id}: {e}")
+        return None
+
+def print_findings(results: Optional[InstanceResults]) -> None:
+    """Print the findings of an instance's scan records."""
+    if results is None:
+        print("\nNo scan summary found. Scan might still be running.")
+        return
+    print("\nScan Findings:")
+    for finding in results.findings:
+        print(f"{finding.path}: {finding.signature} FOUND")
+    print(f"Infected files: {len(results.findings)}")
+
+def fetch_full_log(project_id: str, zone: str, instance: str) -> Optional[Path]:
+    """Download the compressed full log of the instance's last scan, if it was left on the instance."""
+    results_dir = SCRIPT_DIR / "results" / project_id / instance
+    results_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        result = run_ssh(
+            project_id, zone, instance, FETCH_FULL_LOG_COMMAND,
+            operation='fetch',
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            check=True
+        )
+    except subprocess.CalledProcessError as e:
+        print(f"Error fetching full log from {instance}: {e}")
+        if e.stderr:
+            print(f"Error output: {e.stderr.decode(errors='replace')}")
+        return None
+    log_path = results_dir / "scan.log.gz"
+    log_path.write_bytes(result.stdout)
+    print(f"Full scan log saved to {log_path}")
+    if ARCHIVE_RESULTS:
+        # The log belongs to the instance's last scan, the latest run it has files archived in
+        archive = LogArchive(ARCHIVE_DIR)
+        try:
+            run_id = archive.latest_run(project_id, instance)
+            if run_id is not None:
+                archive.add_file(run_id, project_id, zone, instance, log_path.name, log_path)
+                print(f"Full scan log added to archived run {run_id}")
+        finally:
+            archive.close()
+    return log_path
 
 def cleanup_instance(project_id: str, zone: str, instance: str) -> None:
     """Clean up all artifacts from the instance after scan completion."""
     print(f"\nCleaning up {instance} (Project: {project_id}, Zone: {zone})")
-    cleanup_command = [
-        'gcloud', 'compute', 'ssh',
-        f'--project={project_id}',
-        f'--zone={zone}',
-        instance,
-        '--command',
-        'sudo rm -rf ~/clamav-logs ~/run_clamav_scan.sh',
-        '--quiet',
-        '--tunnel-through-iap'
-    ]
     try:
-        subprocess.run(cleanup_command, check=True)
+        run_ssh(project_id, zone, instance, CLEANUP_COMMAND, operation='cleanup', stdin=subprocess.DEVNULL, check=True)
         print(f"Cleanup completed on {instance}")
     except subprocess.CalledProcessError as e:
         print(f"Error during cleanup: {e}")
         print(f"Error output: {e.stderr if hasattr(e, 'stderr') else 'No error output available'}")
 
-def check_scan_status(project_id: str, zone: str, instance: str) -> bool:
+def check_scan_status(project_id: str, zone: str, instance: str, wait_timeout: int = 0) -> Optional[bool]:
     """Check if the ClamAV scan is still running on the instance.
-    Returns True if scan is complete, False if still running."""
+    With wait_timeout, block on the instance for up to that many seconds until the scan ends
+    (or, with STREAM_FINDINGS, reports a new finding). New streamed findings are collected.
+    Returns True if scan is complete, False if still running, None if the check failed."""
+    if STREAM_FINDINGS:
+        seen = LIVE_FINDINGS.seen(project_id, instance) if LIVE_FINDINGS is not None else 0
+        command = STREAM_STATUS_COMMAND.format(seen=seen)
+        if wait_timeout:
+            command = STREAM_WAIT_COMMAND.format(timeout=wait_timeout, seen=seen) + command
+    else:
+        command = LONG_POLL_COMMAND.format(timeout=wait_timeout) if wait_timeout else STATUS_COMMAND
     try:
-        check_command = [
-            'gcloud', 'compute', 'ssh',
-            f'--project={project_id}',
-            f'--zone={zone}',
-            instance,
-            '--command', 'sudo docker ps | grep "clamav-manual" || true',
-            '--quiet',
-            '--tunnel-through-iap'
-        ]
-        result = subprocess.run(check_command, capture_output=True, text=True, check=True)
-        return len(result.stdout.strip()) == 0  # True if container not found (scan complete)
+        result = run_ssh(
+            project_id, zone, instance, command,
+            operation='status',
+            # The long poll blocks twice for up to wait_timeout: on the container, then the script
+            timeout=CALL_DEADLINES['status'] + 2 * wait_timeout,
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            check=True
+        )
     except subprocess.CalledProcessError as e:
         print(f"Error checking scan status on {instance}: {e}")
-        return True  # Assume complete on error to avoid infinite loops
-    
-def generate_report(instances_checked: List[tuple]) -> None:
-    """Generate a comprehensive markdown report of all scan results."""
-    report_time = time.strftime("%Y-%m-%d_%H-%M-%S")
-    report_path = SCRIPT_DIR / f"InterstellarShield_Scan_Report_{report_time}.md"
+        return None
+    lines = result.stdout.splitlines()
+    live = [line[len(LIVE_FINDING_PREFIX):] for line in lines if line.startswith(LIVE_FINDING_PREFIX)]
+    if live and LIVE_FINDINGS is not None:
+        new = LIVE_FINDINGS.add(project_id, instance, live)
+        for finding in new:
+            print(f"Finding on {instance} while its scan runs: {finding.path}: {finding.signature} FOUND")
+        if new and RESULTS_INDEX is not None:
+            RESULTS_INDEX.record_live_findings(project_id, instance, [(f.path, f.signature) for f in new], time.time())
+    # Complete if neither container nor script was found
+    return not any(line.strip() for line in lines if not line.startswith(LIVE_FINDING_PREFIX))
     
-    print(f"\nGenerating report at: {report_path}")
+def probe_scan(project_id: str, zone: str, instance: str) -> Optional[str]:
+    """'running', 'finished' or 'idle' for the scan on the instance, or None if it could not be reached."""
+    try:
+        result = run_ssh(
+            project_id, zone, instance, PROBE_COMMAND,
+            operation='probe',
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+    except subprocess.CalledProcessError as e:
+        print(f"Error probing scan on {instance}: {e}")
+        return None
+    state = result.stdout.strip().split('\n')[-1]
+    return state if state in ('running', 'finished', 'idle') else None
+
+def changes_section(index: ResultsIndex, run_id: Optional[int] = None) -> Dict:
+    """Findings of run run_id (by default the index's current run) that are new, resolved
+    or persistent compared with each instance's previous scan."""
+    new = index.new_findings(run_id)
+    resolved = index.resolved_findings(run_id)
+    persistent = index.persistent_findings(run_id)
+    return {
+        'heading': "Changes Since Last Run",
+        'bullets': [
+            f"New findings: {len(new)}",
+            f"Resolved findings: {len(resolved)}",
+            f"Persistent findings: {len(persistent)}"
+        ],
+        'blocks': [
+            (f"{title} findings", [f"{project_id}/{instance}: {path}: {signature}"
+                                   for project_id, instance, path, signature in findings])
+            for title, findings in (("New", new), ("Resolved", resolved)) if findings
+        ]
+    }
+
+def format_seconds(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    return f"{seconds:.1f}s" if seconds < 120 else f"{seconds / 60:.1f}m"
+
+def metrics_section(metrics: RunMetrics) -> Dict:
+    """Run totals, a per-phase timing table and the slowest instances."""
+    phases = metrics.phase_table()
+    timeline = metrics.timeline()
+    scans = [scan for scan in timeline['scans'] if 'host_seconds' in scan]
+    bullets = [
+        f"Run time: {format_seconds((metrics.finished_at or time.time()) - metrics.started_at)}",
+        f"gcloud/ssh calls: {sum(row['calls'] for row in phases)} "
+        f"({sum(row['failures'] for row in phases)} failed, {sum(row['retries'] for row in phases)} retried)",
+        f"Transferred: {format_bytes(sum(row['bytes_sent'] for row in phases))} sent, "
+        f"{format_bytes(sum(row['bytes_received'] for row in phases))} received"
+    ]
+    failure_classes = metrics.failure_classes()
+    if failure_classes:
+        bullets.append("Failed calls by class: " + ", ".join(
+            f"{failure} ({count})" for failure, count in sorted(failure_classes.items(), key=lambda item: -item[1])))
+    if BREAKERS is not None and BREAKERS.times_opened:
+        bullets.append("Zones whose circuit breaker opened: " + ", ".join(
+            f"{'/'.join(filter(None, key))} ({count}x)" for key, count in sorted(BREAKERS.times_opened.items())))
+    if scans:
+        bullets.append(f"Median scan time on the instances: "
+                       f"{format_seconds(statistics.median(scan['host_seconds'] for scan in scans))}")
+        overheads = [scan['observed_seconds'] - scan['host_seconds'] for scan in scans if 'observed_seconds' in scan]
+        if overheads:
+            bullets.append(f"Median delay between scan end and its detection: "
+                           f"{format_seconds(max(statistics.median(overheads), 0))}")
+    first_detections = [scan['first_detection_seconds'] for scan in timeline['scans'] if 'first_detection_seconds' in scan]
+    if first_detections:
+        bullets.append(f"Instances with findings reported while their scan ran: {len(first_detections)} "
+                       f"(median {format_seconds(statistics.median(first_detections))} after deployment)")
+
+    phase_rows = [
+        [row['phase'], row['count'], row['failed'], format_seconds(row['total_seconds']),
+         format_seconds(row['mean_seconds']), format_seconds(row['p95_seconds']), format_seconds(row['max_seconds']),
+         row['calls'], row['retries'], format_bytes(row['bytes_sent']), format_bytes(row['bytes_received'])]
+        for row in phases
+    ]
+    host_rows = [
+        [f"{host['project']}/{host['instance']}", format_seconds(host['total_seconds'])]
+        + [format_seconds(host['phases'].get(phase)) for phase in ('deploy', 'status', 'fetch')]
+        + [format_seconds(host.get('host_seconds')), format_seconds(host.get('observed_seconds'))]
+        for host in metrics.slowest_hosts(SLOWEST_HOSTS_IN_REPORT)
+    ]
+    return {
+        'heading': "Run Metrics",
+        'bullets': bullets,
+        'tables': [
+            ("Time per phase",
+             ["Phase", "Count", "Failed", "Total", "Mean", "p95", "Max", "Calls", "Retries", "Sent", "Received"],
+             phase_rows),
+            ("Slowest instances",
+             ["Instance", "Total", "Deploy", "Status", "Fetch", "Scan", "Detected after"],
+             host_rows)
+        ]
+    }
+
+def instance_report(project_id: str, zone: str, instance: str, results: Optional[InstanceResults],
+                    archived_run: Optional[int] = None, scan_running: bool = False) -> Dict:
+    """Report entry for one instance, as used by reportgen. With archived_run, the
+    entry describes the instance's files in that run of the archive. With
+    scan_running, results are those of the previous scan while a new one runs."""
+    results_dir = SCRIPT_DIR / "results" / project_id / instance
+    fields = [("Project", project_id), ("Zone", zone)]
+    if scan_running:
+        fields.append(("Scan status", "running; results below are from the previous scan"))
+
+    if archived_run is None:
+        scan_info = read_key_values(results_dir / "scan_info.log")
+        throttle = read_key_values(results_dir / "throttle.log")
+    else:
+        scan_info = read_archived_key_values(archived_run, project_id, instance, "scan_info.log")
+        throttle = read_archived_key_values(archived_run, project_id, instance, "throttle.log")
+    if scan_info.get('scan_type') == 'incremental':
+        fields.append(("Scan type", f"incremental ({scan_info.get('files_scanned')} of "
+                                    f"{scan_info.get('files_total')} files new or changed)"))
+    elif scan_info.get('full_reason'):
+        fields.append(("Scan type", f"full ({scan_info['full_reason']})"))
+    if scan_info.get('db_version'):
+        db_note = ""
+        if STAGING is not None and scan_info['db_version'] != STAGING.db_version:
+            db_note = f" (expected {STAGING.db_version})"
+        fields.append(("Signature database", f"version {scan_info['db_version']}{db_note}"))
+    hit_rate = cache_hit_rate(scan_info)
+    if KNOWN_CLEAN_CACHE and hit_rate is not None:
+        fields.append(("Known-clean cache", f"{scan_info.get('cache_hits')} files skipped "
+                       f"({hit_rate:.1%}, {format_bytes(int(scan_info.get('cache_bytes_skipped') or 0))})"))
+
+    if throttle:
+        fields.append(("Scan profile", f"{throttle.get('profile')} "
+                       f"(paused {throttle.get('paused_seconds', 0)}s in {throttle.get('pause_count', 0)} pauses, "
+                       f"CPU-throttled {throttle.get('cpu_throttled_seconds', 0)}s)"))
+
+    failures = METRICS.instance_failures(project_id, instance) if METRICS is not None else []
+    if failures:
+        fields.append(("Failed calls", ", ".join(f"{phase}: {failure}" for phase, failure in failures)))
+
+    entry = {'name': instance, 'fields': fields, 'findings': None, 'note': None}
+    if results is None:
+        live = LIVE_FINDINGS.findings(project_id, instance) if LIVE_FINDINGS is not None else []
+        if live:
+            # No results retrieved (yet), but the scan already reported these
+            entry['findings'] = [f"{finding.path}: {finding.signature} FOUND" for finding in live]
+            entry['findings'].append(f"Infected files so far: {len(live)}")
+            entry['note'] = "Reported while the scan was running; the scan's results have not been retrieved."
+        return entry
+    if results.summary is not None and results.summary.scanned_files is not None:
+        fields.append(("Scanned", format_scan_stats(results.summary)))
+    if results.errors:
+        fields.append(("Scan errors", f"{results.errors} files could not be scanned"))
+    entry['findings'] = [f"{finding.path}: {finding.signature} FOUND" for finding in results.findings]
+    if results.findings:
+        entry['findings'].append(f"Infected files: {len(results.findings)}")
+        # Add the log path information when malware is detected
+        if archived_run is not None:
+            if ARCHIVE.has(archived_run, project_id, instance, "scan.log.gz"):
+                entry['note'] = ("Please review the full logs for more details: "
+                                 f"`python ishield.py --archived-log {archived_run}/{project_id}/{instance}`")
+            else:
+                entry['note'] = "The full log was left on the instance and is not in the archive."
+        elif (results_dir / "scan.log.gz").exists():
+            entry['note'] = f"Please review the full logs for more details: ./results/{project_id}/{instance}/scan.log.gz"
+        else:
+            entry['note'] = ("The full log was left on the instance. Fetch it with: "
+                             f"`python ishield.py --fetch-full-log {project_id}/{zone}/{instance}`")
+    return entry
+
+def report_fragment(project_id: str, zone: str, instance: str,
+                    results: Optional[InstanceResults], scan_info: Dict[str, str],
+                    archived_run: Optional[int] = None, scan_running: bool = False) -> Dict:
+    """Report entry, its markdown and the statistics the report summary needs, for one instance."""
+    entry = instance_report(project_id, zone, instance, results, archived_run, scan_running)
+    summary = results.summary if results is not None else None
+    return {
+        'project': project_id,
+        'zone': zone,
+        'instance': instance,
+        'entry': entry,
+        'markdown': instance_markdown(entry),
+        'stats': {
+            'complete': summary is not None,
+            'scanned_files': summary.scanned_files if summary else None,
+            'data_scanned_mb': summary.data_scanned_mb if summary else None,
+            'findings': len(results.findings) if results is not None else 0,
+            'signatures': dict(results.signatures) if results is not None else {},
+            'db_version': scan_info.get('db_version', ''),
+            'cache_hits': scan_info.get('cache_hits', ''),
+            'files_scanned': scan_info.get('files_scanned', ''),
+            'cache_bytes_skipped': scan_info.get('cache_bytes_skipped', '')
+        }
+    }
+
+class ReportFragments:
+    """Report fragments of the current run, also saved next to each instance's results."""
+
+    def __init__(self):
+        # Reentrant so a SIGUSR1 report in the main thread cannot deadlock with itself
+        self._lock = threading.RLock()
+        self._fragments = {}
+        self.version = 0
+
+    def add(self, fragment: Dict) -> None:
+        path = SCRIPT_DIR / "results" / fragment['project'] / fragment['instance'] / "report_fragment.json"
+        path.write_text(json.dumps(fragment))
+        with self._lock:
+            self._fragments[(fragment['project'], fragment['instance'])] = fragment
+            self.version += 1
+
+    def get(self, project_id: str, instance: str) -> Optional[Dict]:
+        with self._lock:
+            return self._fragments.get((project_id, instance))
+
+    def put(self, fragment: Dict) -> None:
+        """Take a fragment built by another process, such as a worker of a coordinated run."""
+        with self._lock:
+            self._fragments[(fragment['project'], fragment['instance'])] = fragment
+            self.version += 1
+
+    def restore(self, project_id: str, instance: str) -> bool:
+        """Load a fragment saved by an earlier process of the same run, such as before --resume."""
+        path = SCRIPT_DIR / "results" / project_id / instance / "report_fragment.json"
+        try:
+            fragment = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return False
+        with self._lock:
+            self._fragments[(project_id, instance)] = fragment
+            self.version += 1
+        return True
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._fragments)
+
+class LiveFindings:
+    """Findings streamed from each instance's findings.live while its scan runs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._instances = {}
+        self.version = 0
+
+    def seen(self, project_id: str, instance: str) -> int:
+        """Lines of the instance's findings.live read so far."""
+        with self._lock:
+            return self._instances.get((project_id, instance), {}).get('lines', 0)
+
+    def add(self, project_id: str, instance: str, lines: List[str]) -> List[FileResult]:
+        """Take the lines of findings.live after those already seen, stopping at a
+        line still being written. Returns the findings not reported before."""
+        complete = []
+        for line in lines:
+            records = list(parse_scan_log([line]))
+            if len(records) != 1 or not isinstance(records[0], FileResult) or records[0].status != 'FOUND':
+                break
+            complete.append(records[0])
+        now = time.time()
+        with self._lock:
+            state = self._instances.setdefault((project_id, instance),
+                                               {'lines': 0, 'findings': [], 'first_detected_at': None})
+            state['lines'] += len(complete)
+            new = [finding for finding in dict.fromkeys(complete) if finding not in state['findings']]
+            if new:
+                state['findings'].extend(new)
+                state['first_detected_at'] = state['first_detected_at'] or now
+                self.version += 1
+        return new
+
+    def findings(self, project_id: str, instance: str) -> List[FileResult]:
+        with self._lock:
+            return list(self._instances.get((project_id, instance), {}).get('findings', []))
+
+    def first_detected_at(self, project_id: str, instance: str) -> Optional[float]:
+        with self._lock:
+            return self._instances.get((project_id, instance), {}).get('first_detected_at')
+
+def generate_report(instances_checked: List[tuple], partial: bool = False,
+                    archived_run: Optional[int] = None, running: Collection[tuple] = ()) -> None:
+    """Assemble the markdown and PDF report from the instances' report fragments.
+
+    With partial, writes a provisional report of the instances finished so far
+    (markdown only unless partial == 'pdf') under PARTIAL_REPORT_NAME.
+    With archived_run, reports that run from the files in ARCHIVE instead.
+    Instances in running, whose scans are still going, are reported as running
+    with their previous results.
+    """
+    if partial:
+        report_name = PARTIAL_REPORT_NAME
+    elif archived_run is not None:
+        report_name = f"InterstellarShield_Run_{archived_run}_Report_{time.strftime('%Y-%m-%d_%H-%M-%S')}"
+    else:
+        report_name = f"InterstellarShield_Scan_Report_{time.strftime('%Y-%m-%d_%H-%M-%S')}"
+    report_path = SCRIPT_DIR / f"{report_name}.md"
     
-    with open(report_path, "w") as report:
-        # Add InterstellarShield logo
-        report.write("<p align=\"center\">\n")
-        report.write("  <img width=\"300\" src=\"./img/interstellarshield.png\" alt=\"InterstellarShield Icon\">\n")
-        report.write("</p>\n\n")
-
-        report.write("<h1 align=\"center\">Generated by InterstellarShield</h1>\n\n")
-        
-        # Write header
-        report.write("## Manual ClamAV Scan Results Report\n\n")
-        report.write(f"Report generated: {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-        
-        # Summary section
-        report.write("### Summary\n\n")
-        report.write(f"- Total projects scanned: {len(set(inst[0] for inst in instances_checked))}\n")
-        report.write(f"- Total instances scanned: {len(instances_checked)}\n\n")
-        
-        # Results by instance
-        report.write("### Detailed Results\n\n")
-        
-        for project_id, zone, instance in instances_checked:
-            report.write(f"#### Instance: {instance}\n")
-            report.write(f"- **Project**: {project_id}\n")
-            report.write(f"- **Zone**: {zone}\n")
-            
-            # Check for scan results
+    print(f"\nGenerating {'provisional ' if partial else ''}report at: {report_path}")
+
+    fragments = []
+    live_findings = 0
+    for project_id, zone, instance in instances_checked:
+        fragment = REPORT_FRAGMENTS.get(project_id, instance) if REPORT_FRAGMENTS is not None else None
+        if fragment is None and LIVE_FINDINGS is not None:
+            live_findings += len(LIVE_FINDINGS.findings(project_id, instance))
+        if fragment is None and archived_run is not None:
+            fragment = report_fragment(project_id, zone, instance,
+                                       load_archived_results(archived_run, project_id, instance),
+                                       read_archived_key_values(archived_run, project_id, instance, "scan_info.log"),
+                                       archived_run)
+        elif fragment is None:
             results_dir = SCRIPT_DIR / "results" / project_id / instance
-            findings_file = results_dir / "findings.log"
-            scan_log_file = results_dir / "scan.log"
-            
-            if findings_file.exists():
-                report.write("\n**Findings:**\n")
-                findings = findings_file.read_text().strip()
-                if findings:
-                    report.write(findings + "\n")
-                    # Add the log path information when malware is detected
-                    report.write(f"\nPlease review the full logs for more details: ./results/{project_id}/{instance}/scan.log\n")
-                else:
-                    report.write("No malware detected.\n")
+            if partial:
+                # Still running: leave out results of earlier runs
+                fragment = report_fragment(project_id, zone, instance, None, {})
             else:
-                report.write("\n**Status**: No results file found. Scan may have failed or still be running.\n")
-            
-            report.write("\n---\n\n")
-    
+                fragment = report_fragment(project_id, zone, instance, load_instance_results(results_dir),
+                                           read_key_values(results_dir / "scan_info.log"),
+                                           scan_running=(project_id, zone, instance) in running)
+        fragments.append(fragment)
+    stats = [fragment['stats'] for fragment in fragments]
+    completed = [stat for stat in stats if stat['complete']]
+    signatures = Counter()
+    for stat in stats:
+        signatures.update(stat['signatures'])
+
+    # Summary section
+    summary = []
+    if archived_run is not None:
+        summary.append(f"Archived run {archived_run}")
+    if partial:
+        summary.append(f"Provisional report: results retrieved from {len(REPORT_FRAGMENTS or [])} "
+                       f"of {len(instances_checked)} instances")
+    summary.extend([
+        f"Total projects scanned: {len(set(inst[0] for inst in instances_checked))}",
+        f"Total instances scanned: {len(instances_checked)}",
+        f"Instances with complete results: {len(completed)}",
+        f"Files scanned: {sum(stat['scanned_files'] or 0 for stat in completed)}",
+        f"Data scanned: {format_bytes(sum(stat['data_scanned_mb'] or 0 for stat in completed) * 1048576)}",
+        f"Infected files: {sum(stat['findings'] for stat in stats)}"
+    ])
+    if live_findings:
+        summary.append(f"Infected files reported by scans whose results were not retrieved: {live_findings}")
+    if signatures:
+        summary.append("Detections by signature: " + ", ".join(
+            f"{signature} ({count})" for signature, count in signatures.most_common()))
+    if KNOWN_CLEAN_CACHE:
+        cache_stats = [stat for stat in stats if stat['cache_hits']]
+        cache_hits = sum(int(stat['cache_hits']) for stat in cache_stats)
+        files_scanned = sum(int(stat['files_scanned'] or 0) for stat in cache_stats)
+        if cache_hits + files_scanned:
+            skipped = sum(int(stat['cache_bytes_skipped'] or 0) for stat in cache_stats)
+            summary.append(
+                f"Known-clean cache hit rate: {cache_hits / (cache_hits + files_scanned):.1%} "
+                f"({cache_hits} files, {format_bytes(skipped)} skipped)"
+            )
+    db_versions = sorted({stat['db_version'] for stat in stats} - {None, ''})
+    if db_versions:
+        summary.append(f"Signature database versions: {', '.join(db_versions)}")
+    if STAGING is not None:
+        summary.append(f"Staged scan image: {STAGING.image_ref} (signature database {STAGING.db_version})")
+
+    sections = [{'heading': "Summary", 'bullets': summary}]
+    if RESULTS_INDEX is not None:
+        sections.append(changes_section(RESULTS_INDEX, archived_run))
+    if METRICS is not None:
+        sections.append(metrics_section(METRICS))
+
+    report = {
+        'title': "Generated by InterstellarShield",
+        'generated': f"Report generated: {time.strftime('%Y-%m-%d %H:%M:%S')}",
+        'sections': sections,
+        'instances': [dict(fragment['entry'], markdown=fragment['markdown']) for fragment in fragments]
+    }
+
+    write_markdown_report(report, str(report_path))
     print(f"Report generated successfully at: {report_path}")
 
-    # Convert the markdown report to PDF
-    pdf_path = SCRIPT_DIR / f"InterstellarShield_Scan_Report_{report_time}.pdf"
-    convert_markdown_to_pdf(str(report_path), str(pdf_path))
+    if partial and partial != 'pdf':
+        return
+    # Render the PDF from the same structured report
+    pdf_path = SCRIPT_DIR / f"{report_name}.pdf"
+    write_pdf_report(report, str(pdf_path))
     print(f"PDF report generated successfully at: {pdf_path}")
 
-def main():
-    projects = get_projects()
-    print(f"Processing {len(projects)} projects...")
+def print_new_findings_since(timestamp: float) -> None:
+    """Print findings from the results index that were first reported at or after timestamp."""
+    index = ResultsIndex(RESULTS_INDEX_PATH)
+    try:
+        findings = index.new_findings_since(timestamp)
+    finally:
+        index.close()
+    print(f"New findings since {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))}: {len(findings)}")
+    for project_id, instance, path, signature, first_seen in findings:
+        print(f"{time.strftime('%Y-%m-%d', time.localtime(first_seen))} {project_id}/{instance}: {path}: {signature}")
+
+def report_archived_run(run_id: int) -> None:
+    """Write the markdown and PDF report of an archived run, streaming its logs from the archive."""
+    global ARCHIVE, RESULTS_INDEX
+    ARCHIVE = LogArchive(ARCHIVE_DIR)
+    RESULTS_INDEX = ResultsIndex(RESULTS_INDEX_PATH)
+    try:
+        instances = ARCHIVE.instances(run_id)
+        if not instances:
+            runs = ARCHIVE.runs()
+            print(f"Run {run_id} is not in the archive {ARCHIVE_DIR}; archived runs: "
+                  f"{', '.join(str(run[0]) for run in runs) or 'none'}")
+            return
+        generate_report(instances, archived_run=run_id)
+    finally:
+        RESULTS_INDEX.close()
+        RESULTS_INDEX = None
+        ARCHIVE.close()
+        ARCHIVE = None
+
+def print_archived_log(run_id: int, project_id: str, instance: str) -> bool:
+    """Write the uncompressed full log of an instance in an archived run to stdout.
+    False if it is not in the archive."""
+    archive = LogArchive(ARCHIVE_DIR)
+    try:
+        stream = archive.open(run_id, project_id, instance, "scan.log.gz")
+        if stream is None:
+            return False
+        with stream:
+            sys.stdout.flush()
+            shutil.copyfileobj(stream, sys.stdout.buffer)
+        return True
+    finally:
+        archive.close()
+
+def enforce_archive_retention(archive: LogArchive) -> None:
+    """Apply ARCHIVE_KEEP_RUNS and ARCHIVE_MAX_BYTES and print what the archive holds."""
+    try:
+        freed = archive.enforce_retention(ARCHIVE_KEEP_RUNS, ARCHIVE_MAX_BYTES)
+        stats = archive.stats()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warning: Could not apply the archive retention policy: {e}")
+        return
+    print(f"Archive: {stats['runs']} runs, {format_bytes(stats['archived_bytes'])} of results stored in "
+          f"{format_bytes(stats['stored_bytes'])}" + (f" ({format_bytes(freed)} evicted)" if freed else ""))
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Run manual ClamAV scans on GCP instances over IAP.')
+    parser.add_argument(
+        '--fetch-full-log', metavar='PROJECT/ZONE/INSTANCE',
+        help='download the compressed full log kept on an instance after its last scan, then exit'
+    )
+    parser.add_argument(
+        '--refresh-inventory', action='store_true',
+        help='list instances again instead of using the cached inventory'
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='continue an interrupted run from the run journal instead of starting a new one'
+    )
+    parser.add_argument(
+        '--coordinate', action='store_true',
+        help='queue the discovered instances for workers started with --work, wait for them and write the report '
+             '(with --resume, wait for the run already queued)'
+    )
+    parser.add_argument(
+        '--work', action='store_true',
+        help='lease instances from the work queue of a coordinated run and scan them until the queue is drained'
+    )
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='keep running, rescan every instance once per DAEMON_SCAN_PERIOD and write a report '
+             'every DAEMON_REPORT_INTERVAL'
+    )
+    parser.add_argument(
+        '--report-run', metavar='RUN_ID', type=int,
+        help='write the report of a run from the results archive, then exit'
+    )
+    parser.add_argument(
+        '--archived-log', metavar='RUN_ID/PROJECT/INSTANCE',
+        help='print the full log of an instance in a run from the results archive, then exit'
+    )
+    parser.add_argument(
+        '--new-findings-since', metavar='DAYS', type=float,
+        help='list findings first reported in the last DAYS days from the results index, then exit'
+    )
+    args = parser.parse_args(argv)
+    if args.work and (args.resume or args.coordinate):
+        parser.error('--work cannot be combined with --resume or --coordinate; workers take over expired leases instead')
+    if args.daemon and (args.resume or args.coordinate or args.work):
+        parser.error('--daemon cannot be combined with --resume, --coordinate or --work')
+
+    if args.new_findings_since is not None:
+        print_new_findings_since(time.time() - args.new_findings_since * 86400)
+        return
+    if args.report_run is not None:
+        report_archived_run(args.report_run)
+        return
+    if args.archived_log:
+        target = args.archived_log.split('/')
+        if len(target) != 3 or not target[0].isdigit():
+            parser.error('--archived-log expects RUN_ID/PROJECT/INSTANCE')
+        if not print_archived_log(int(target[0]), target[1], target[2]):
+            print(f"No full log of {target[2]} in archived run {target[0]}")
+        return
+
+    global CONNECTION_POOL, BREAKERS
+    BREAKERS = CircuitBreakers()
+    # The daemon always pools connections, as it keeps returning to the same instances
+    if USE_CONNECTION_POOL or args.daemon:
+        CONNECTION_POOL = ConnectionPool()
+    try:
+        if args.fetch_full_log:
+            target = args.fetch_full_log.split('/')
+            if len(target) != 3:
+                parser.error('--fetch-full-log expects PROJECT/ZONE/INSTANCE')
+            fetch_full_log(*target)
+            return
+        if args.coordinate:
+            coordinate_run(args.refresh_inventory, args.resume)
+            return
+        if args.work:
+            work(f"{socket.gethostname()}-{os.getpid()}")
+            return
+        if args.daemon:
+            run_daemon(args.refresh_inventory)
+            return
+        run_scans(args.refresh_inventory, args.resume)
+    finally:
+        if CONNECTION_POOL is not None:
+            CONNECTION_POOL.close_all()
+            CONNECTION_POOL = None
+
+def coordinate_run(refresh_inventory: bool = False, resume: bool = False) -> None:
+    """Queue the discovered instances in the work queue, wait until workers have processed
+    them all and write the report from the report fragments they left in the queue.
+    With resume, wait for the run already in the queue instead of starting a new one.
+    Scan assets are staged here once for all workers, and the metrics each worker
+    recorded for an instance are merged into the run's metrics when it finishes."""
+    global METRICS, RESULTS_INDEX, REPORT_FRAGMENTS
+    METRICS = RunMetrics()
+    queue = WorkQueue(WORK_QUEUE_PATH)
+    RESULTS_INDEX = ResultsIndex(RESULTS_INDEX_PATH)
+    REPORT_FRAGMENTS = ReportFragments()
+    try:
+        queued_run = queue.run() if resume else None
+        if queued_run is not None:
+            RESULTS_INDEX.attach_run(queued_run['run_id'])
+            instances = queue.targets()
+            print(f"Waiting for the run queued {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(queued_run['created_at']))} "
+                  f"({len(instances)} instances)...")
+        elif resume:
+            print(f"No coordinated run to resume in {WORK_QUEUE_PATH}")
+            return
+        else:
+            projects = get_projects()
+            print(f"Processing {len(projects)} projects...")
+            instances = discover_instances(projects, refresh_inventory)
+            RESULTS_INDEX.start_run()
+            queue.fill(RESULTS_INDEX.run_id, instances, stage_for_workers())
+            print(f"Queued {len(instances)} instances in {WORK_QUEUE_PATH}; "
+                  f"start workers with: python3 ishield.py --work")
+
+        merged = 0
+        reported = {'version': 0, 'at': time.time()}
+        while True:
+            drained = queue.drained()
+            fragments, instance_metrics, merged = queue.fragments(merged)
+            for fragment in fragments:
+                REPORT_FRAGMENTS.put(fragment)
+            for metrics in instance_metrics:
+                METRICS.merge_instance(metrics)
+            if drained:
+                break
+            counts = queue.counts()
+            print(f"{counts['done'] + counts['failed']} of {len(instances)} instances finished, "
+                  f"{counts['leased']} leased by {counts['workers']} workers, {counts['pending']} waiting")
+            if (REPORT_FRAGMENTS.version != reported['version']
+                    and time.time() - reported['at'] >= PARTIAL_REPORT_INTERVAL):
+                generate_report(instances, partial=True)
+                reported.update(version=REPORT_FRAGMENTS.version, at=time.time())
+            time.sleep(QUEUE_POLL_INTERVAL)
+
+        counts = queue.counts()
+        print(f"\nAll {len(instances)} instances processed ({counts['failed']} failed)")
+        RESULTS_INDEX.finish_run()
+        METRICS.finish()
+        METRICS.write_timeline(METRICS_DIR / f"timeline_{time.strftime('%Y-%m-%d_%H-%M-%S')}.json")
+        METRICS.write_prometheus(PROMETHEUS_TEXTFILE_PATH)
+        generate_report(instances)
+        for suffix in ('.md', '.pdf'):
+            (SCRIPT_DIR / f"{PARTIAL_REPORT_NAME}{suffix}").unlink(missing_ok=True)
+        if ARCHIVE_RESULTS:
+            # The workers have archived their results; none of them adds to the archive any more
+            archive = LogArchive(ARCHIVE_DIR)
+            try:
+                enforce_archive_retention(archive)
+            finally:
+                archive.close()
+    finally:
+        REPORT_FRAGMENTS = None
+        METRICS = None
+        RESULTS_INDEX.close()
+        RESULTS_INDEX = None
+        queue.close()
+
+def stage_for_workers() -> Optional[Dict]:
+    """Stage the scan assets for a coordinated run when STAGE_SCAN_ASSETS is enabled.
+    Returns the staged state for the work queue, or None."""
+    if not STAGE_SCAN_ASSETS:
+        return None
+    if STAGE_IMAGE_TRANSFER not in ('pull', 'tunnel'):
+        raise ValueError(f"Unknown STAGE_IMAGE_TRANSFER: {STAGE_IMAGE_TRANSFER}")
+    staging = ScanStaging(STAGING_DIR)
+    if not staging.stage():
+        print("Warning: Staging failed, instances will use their own copy of the scan image")
+        return None
+    return staging.state()
+
+def work(worker: str) -> None:
+    """Process instances of the coordinated run in the work queue as the worker named worker."""
+    queue = WorkQueue(WORK_QUEUE_PATH)
+    try:
+        run_scans(queue=queue, worker=worker)
+    finally:
+        # Interrupted: hand the remaining leases to other workers right away
+        released = queue.release(worker)
+        if released:
+            print(f"Returned {released} leased instances to the work queue")
+        queue.close()
+
+def run_daemon(refresh_inventory: bool = False) -> None:
+    """Rescan the fleet on a rolling schedule until interrupted, one report window after another.
+    The connection pool and circuit breakers set up by main() stay warm across windows."""
+    schedule = RollingSchedule(DAEMON_STATE_PATH)
+    try:
+        while True:
+            run_scans(refresh_inventory, queue=schedule, worker='daemon')
+            refresh_inventory = False
+    except KeyboardInterrupt:
+        print("\nDaemon stopped; scans still running are reattached when it starts again")
+
+def run_scans(refresh_inventory: bool = False, resume: bool = False,
+              queue: Optional[Union[WorkQueue, RollingSchedule]] = None, worker: Optional[str] = None):
+    """Discover instances, run the scan lifecycle on each of them and generate the report.
+    With refresh_inventory, projects are listed again even if their cached listing is fresh.
+    With resume, continue the interrupted run in the run journal instead: reattach to
+    scans still running, collect finished ones and only deploy where nothing ran.
+    With queue, work as the worker named worker of a coordinated run instead: lease
+    instances from the queue until it is drained and leave the report to the coordinator.
+    A RollingSchedule as queue runs one report window of daemon mode: instances are
+    scanned as they come due and the window ends on time with a report of the whole
+    fleet; scans still running then are reattached by the next window."""
+    journal_run = None
+    if resume:
+        journal_run = read_journal(RUN_JOURNAL_PATH)
+        if journal_run is None or journal_run['finished']:
+            print(f"No interrupted run to resume in {RUN_JOURNAL_PATH}")
+            return
+
+    global METRICS, JOURNAL
+    METRICS = RunMetrics()
+    limiter = ConcurrencyLimiter(
+        MAX_CONCURRENT_OPERATIONS,
+        MAX_CONCURRENT_PER_PROJECT,
+        MAX_CONCURRENT_PER_ZONE
+    )
 
     # Track instances for result retrieval
-    instances_to_check = []
+    rolling = isinstance(queue, RollingSchedule)
+    queued_run = None
+    if rolling:
+        projects = get_projects()
+        print(f"Processing {len(projects)} projects...")
+        queue.start_window(discover_instances(projects, refresh_inventory), time.time() + DAEMON_REPORT_INTERVAL)
+        # Instances whose scan started in this window
+        instances_to_check = []
+    elif queue is not None:
+        queued_run = queue.run()
+        while queued_run is None:
+            print(f"Waiting for a coordinator to fill the work queue {WORK_QUEUE_PATH}...")
+            time.sleep(QUEUE_POLL_INTERVAL)
+            queued_run = queue.run()
+        # Instances leased by this worker
+        instances_to_check = []
+    elif journal_run is not None:
+        instances_to_check = journal_run['instances']
+        print(f"Resuming the run started {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(journal_run['started_at']))} "
+              f"({len(instances_to_check)} instances)...")
+    else:
+        projects = get_projects()
+        print(f"Processing {len(projects)} projects...")
+        instances_to_check = discover_instances(projects, refresh_inventory)
 
-    # First phase: Deploy and start scans
-    for project_id in projects:
-        print(f"\nChecking project: {project_id}")
-        instances = get_instances(project_id)
-        
-        if not instances:
-            continue
+    global SCAN_HISTORY, KNOWN_CLEAN, STAGING, RESULTS_INDEX, REPORT_FRAGMENTS, LIVE_FINDINGS, ARCHIVE
+    SCAN_HISTORY = ScanHistory(SCRIPT_DIR / "scan_history.json")
+    REPORT_FRAGMENTS = ReportFragments()
+    LIVE_FINDINGS = LiveFindings()
+    RESULTS_INDEX = ResultsIndex(RESULTS_INDEX_PATH)
+    # Workers journal their own transitions; the queue's leases stand in for --resume
+    journal_path = RUN_JOURNAL_PATH if queue is None else RUN_JOURNAL_PATH.with_name(f"run_journal_{worker}.jsonl")
+    JOURNAL = RunJournal(journal_path, append=journal_run is not None)
+    if queued_run is not None:
+        RESULTS_INDEX.attach_run(queued_run['run_id'])
+        JOURNAL.start(RESULTS_INDEX.run_id, [])
+    elif rolling:
+        RESULTS_INDEX.start_run()
+        JOURNAL.start(RESULTS_INDEX.run_id, [])
+    elif journal_run is None:
+        RESULTS_INDEX.start_run()
+        JOURNAL.start(RESULTS_INDEX.run_id, instances_to_check)
+    else:
+        if not RESULTS_INDEX.resume_run(journal_run['run_id']):
+            RESULTS_INDEX.start_run()
+        JOURNAL.resumed(RESULTS_INDEX.run_id)
+    if STAGE_SCAN_ASSETS:
+        if STAGE_IMAGE_TRANSFER not in ('pull', 'tunnel'):
+            raise ValueError(f"Unknown STAGE_IMAGE_TRANSFER: {STAGE_IMAGE_TRANSFER}")
+        STAGING = ScanStaging(STAGING_DIR)
+        if queued_run is not None:
+            # The coordinator staged the assets once for all of its workers
+            staged = queued_run['staging'] is not None and STAGING.restore(queued_run['staging'])
+        else:
+            staged = STAGING.stage()
+        if not staged:
+            print("Warning: Staging failed, instances will use their own copy of the scan image")
+            STAGING = None
+    if KNOWN_CLEAN_CACHE:
+        KNOWN_CLEAN = KnownCleanCache(SCRIPT_DIR / "known_clean.db")
+        if not KNOWN_CLEAN.export(KNOWN_CLEAN_EXPORT_PATH) and KNOWN_CLEAN_EXPORT_PATH.exists():
+            KNOWN_CLEAN_EXPORT_PATH.unlink()
+    if ARCHIVE_RESULTS:
+        ARCHIVE = LogArchive(ARCHIVE_DIR)
+    scheduler = CompletionScheduler(SCAN_HISTORY)
 
-        filtered_instances = []
-        for instance in instances:
-            if any(filter_pattern.replace('*', '') in instance['name'] 
-                  for filter_pattern in INSTANCE_FILTERS):
-                filtered_instances.append(instance)
-
-        for instance in filtered_instances:
-            deploy_and_start_scan(
-                project_id,
-                instance['zone'].split('/')[-1],
-                instance['name']
-            )
-            instances_to_check.append((
-                project_id,
-                instance['zone'].split('/')[-1],
-                instance['name']
-            ))
-
-    # Second phase: Check status and retrieve results
-    instances_pending = instances_to_check.copy()
-    check_interval = 300  # 5 minutes in seconds
-
-    while instances_pending:
-        print(f"\nChecking scan status for {len(instances_pending)} instances...")
-        still_running = []
-
-        for project_id, zone, instance in instances_pending:
-            if check_scan_status(project_id, zone, instance):
-                print(f"Scan complete on {instance}, retrieving results...")
+    # Worker: the instances this worker holds leases on, handed back to the queue
+    # once their lifecycle ends
+    held = set()
+
+    def finished(target, ok):
+        if queue is None:
+            return
+        held.discard(target)
+        fragment = REPORT_FRAGMENTS.get(target[0], target[2]) or report_fragment(*target, None, {})
+        # A coordinator merges the instance's metrics into the run's; the daemon keeps its own
+        metrics = METRICS.instance_metrics(*target) if not rolling else None
+        if not queue.finish(worker, target, ok, fragment, metrics):
+            print(f"Lease on {target[2]} passed to another worker before it finished here")
+
+    def tracked(target):
+        return queue is None or target in held
+
+    # First phase: Deploy and start scans on every instance concurrently
+    def deploy(project_id, zone, instance):
+        RESULTS_INDEX.start_instance(project_id, zone, instance)
+        with limiter.slot(project_id, zone), timed_phase(project_id, zone, instance, 'deploy') as phase:
+            deploy_and_start_scan(project_id, zone, instance)
+        if not phase['ok']:
+            print(f"Scan not started on {instance} ({phase['failure'] or 'error'}), skipping it")
+            finished((project_id, zone, instance), False)
+            return
+        JOURNAL.record((project_id, zone, instance), 'deployed')
+        if rolling:
+            queue.started((project_id, zone, instance), time.time())
+        scheduler.add((project_id, zone, instance), time.time())
+
+    def cleanup(project_id, zone, instance):
+        with limiter.slot(project_id, zone), timed_phase(project_id, zone, instance, 'cleanup') as phase:
+            cleanup_instance(project_id, zone, instance)
+        if phase['ok']:
+            JOURNAL.record((project_id, zone, instance), 'cleaned')
+
+    def collect(project_id, zone, instance):
+        target = (project_id, zone, instance)
+        with limiter.slot(project_id, zone), timed_phase(project_id, zone, instance, 'fetch') as phase:
+            if SINGLE_SESSION_TRANSFER:
+                fetch_results(project_id, zone, instance)
+            else:
                 retrieve_scan_results(project_id, zone, instance)
-                cleanup_instance(project_id, zone, instance)
+        if not phase['ok']:
+            # Nothing usable was retrieved; leave the results on the instance
+            print(f"Results of {instance} not retrieved ({phase['failure'] or 'error'}), they are left on the instance")
+            finished(target, False)
+            return
+        JOURNAL.record(target, 'retrieved')
+        # fetch_results() already moved the results aside on the instance
+        if not SINGLE_SESSION_TRANSFER:
+            cleanup(project_id, zone, instance)
+        finished(target, True)
+
+    # Pick up an instance whose scan may have been started by an earlier process
+    def reattach(project_id, zone, instance, deployed, deployed_at):
+        target = (project_id, zone, instance)
+        with limiter.slot(project_id, zone), timed_phase(project_id, zone, instance, 'probe'):
+            scan = probe_scan(project_id, zone, instance)
+        if scan is None and deployed:
+            # Unreachable: assume the scan it was given is still going rather than start another
+            scan = 'running'
+        if scan == 'running':
+            print(f"Reattaching to the scan running on {instance}")
+            RESULTS_INDEX.start_instance(project_id, zone, instance)
+            scheduler.add(target, deployed_at)
+        elif scan == 'finished':
+            print(f"Scan already finished on {instance}, retrieving results...")
+            RESULTS_INDEX.start_instance(project_id, zone, instance)
+            collect(project_id, zone, instance)
+        else:
+            deploy(project_id, zone, instance)
+
+    # On resume, pick each instance up where the journal left it
+    def resume_instance(project_id, zone, instance):
+        target = (project_id, zone, instance)
+        state = journal_run['states'].get(target, 'discovered')
+        if state == 'cleaned':
+            REPORT_FRAGMENTS.restore(project_id, instance)
+            return
+        if state == 'retrieved':
+            REPORT_FRAGMENTS.restore(project_id, instance)
+            if not SINGLE_SESSION_TRANSFER:
+                cleanup(project_id, zone, instance)
+            return
+        reattach(project_id, zone, instance, state != 'discovered',
+                 journal_run['deployed_at'].get(target, time.time()))
+
+    # Worker: a lease held before by another worker means that worker may have started the scan
+    def start_leased(target, leases):
+        if leases == 1:
+            deploy(*target)
+        else:
+            if rolling:
+                print(f"Picking up the scan left running on {target[2]} by an earlier window or daemon process")
             else:
-                print(f"Scan still running on {instance}")
-                still_running.append((project_id, zone, instance))
+                print(f"Picking up {target[2]}, whose scan an earlier process may have started")
+            reattach(*target, True, queue.started_at(target) if rolling else time.time())
 
-        instances_pending = still_running
-        if instances_pending:
-            print(f"\nWaiting {check_interval/60} minutes before next check...")
-            time.sleep(check_interval)
-    
-    # Generate the final report
-    generate_report(instances_to_check)
+    if rolling:
+        print(f"\nScanning instances as they come due until "
+              f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(queue.window_end))}...")
+    elif queue is not None:
+        print(f"\nWorker {worker} leasing instances from {WORK_QUEUE_PATH}...")
+    elif journal_run is not None:
+        print(f"\nResuming {len(instances_to_check)} instances...")
+        run_for_instances(resume_instance, instances_to_check)
+    else:
+        print(f"\nDeploying scans to {len(instances_to_check)} instances...")
+        run_for_instances(deploy, instances_to_check)
+
+    # Second phase: Check each instance when its scan is due and retrieve results as soon as it ends
+    reported_running = set()
+
+    def poll_and_collect(project_id, zone, instance):
+        target = (project_id, zone, instance)
+        with limiter.slot(project_id, zone), timed_phase(project_id, zone, instance, 'status'):
+            complete = check_scan_status(project_id, zone, instance,
+                                         scheduler.long_poll_timeout(target, time.time()))
+        if complete is None:
+            failed = scheduler.check_failed(target)
+            if failed < MAX_STATUS_FAILURES:
+                return False
+            print(f"Giving up on {instance} after {failed} failed status checks, its scan is left on the instance")
+            scheduler.abandon(target)
+            finished(target, False)
+            return True
+        scheduler.check_succeeded(target)
+        if not complete:
+            print(f"Scan still running on {instance}")
+            if target not in reported_running:
+                reported_running.add(target)
+                JOURNAL.record(target, 'running')
+            return False
+
+        print(f"Scan complete on {instance}, retrieving results...")
+        durations = {'observed_seconds': scheduler.complete(target)}
+        first_detected_at = LIVE_FINDINGS.first_detected_at(project_id, instance)
+        if first_detected_at is not None:
+            durations['first_detection_seconds'] = durations['observed_seconds'] - (time.time() - first_detected_at)
+        METRICS.record_scan(project_id, zone, instance, **durations)
+        collect(project_id, zone, instance)
+        return True
+
+    # Provisional report of the instances finished so far, on a timer and on SIGUSR1
+    partial_report = {'version': 0, 'at': time.time(), 'writing': False}
+
+    def report_version():
+        return REPORT_FRAGMENTS.version + LIVE_FINDINGS.version
+
+    def write_partial_report(pdf=False):
+        if partial_report['writing']:
+            return
+        partial_report['writing'] = True
+        try:
+            generate_report(instances_to_check, partial='pdf' if pdf else True)
+            partial_report.update(version=report_version(), at=time.time())
+        finally:
+            partial_report['writing'] = False
+
+    previous_handler = None
+    if ((queue is None or rolling) and hasattr(signal, 'SIGUSR1')
+            and threading.current_thread() is threading.main_thread()):
+        previous_handler = signal.signal(signal.SIGUSR1, lambda signum, frame: write_partial_report(pdf=True))
+
+    # Worker: leases are requested while below WORKER_MAX_INSTANCES and the queue has work
+    queue_open = queue is not None
+    next_lease = next_heartbeat = time.time()
+
+    def renew_and_lease(executor, starting):
+        nonlocal queue_open, next_lease, next_heartbeat
+        now = time.time()
+        if held and now >= next_heartbeat:
+            for target in queue.heartbeat(worker, list(held), LEASE_SECONDS):
+                print(f"Lost the lease on {target[2]} to another worker, leaving the instance to it")
+                held.discard(target)
+            next_heartbeat = now + LEASE_HEARTBEAT_INTERVAL
+        if queue_open and now >= next_lease and len(held) < WORKER_MAX_INSTANCES:
+            leased = queue.lease(worker, min(LEASE_BATCH_SIZE, WORKER_MAX_INSTANCES - len(held)),
+                                 LEASE_SECONDS, MAX_LEASES)
+            for target, leases in leased:
+                held.add(target)
+                instances_to_check.append(target)
+                starting[executor.submit(start_leased, target, leases)] = target
+            if leased:
+                print(f"Picked up {len(leased)} instances ({len(held)} in progress)")
+            elif not held and queue.drained():
+                queue_open = False
+            else:
+                # Nothing to lease now; expired leases of other workers may turn up later
+                next_lease = now + QUEUE_POLL_INTERVAL
+
+    def seconds_until_lease_work():
+        wakes = [next_lease] if queue_open and len(held) < WORKER_MAX_INSTANCES else []
+        if held:
+            wakes.append(next_heartbeat)
+        if rolling:
+            wakes.append(queue.window_end)
+        return max(min(wakes) - time.time(), 0) if wakes else None
+
+    def window_over():
+        # A daemon window ends on time; the scans it leaves running carry over to the next
+        return rolling and time.time() >= queue.window_end
+
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKER_THREADS) as executor:
+            checking = {}
+            starting = {}
+            while checking or starting or ((scheduler or queue_open) and not window_over()):
+                if ((queue is None or rolling) and report_version() != partial_report['version']
+                        and time.time() - partial_report['at'] >= PARTIAL_REPORT_INTERVAL):
+                    write_partial_report()
+                if queue is not None:
+                    renew_and_lease(executor, starting)
+
+                for target in scheduler.pop_due(time.time()) if not window_over() else []:
+                    if tracked(target):
+                        checking[executor.submit(poll_and_collect, *target)] = target
+                    else:
+                        scheduler.abandon(target)
+
+                delays = [delay for delay in (scheduler.seconds_until_next(time.time()), seconds_until_lease_work())
+                          if delay is not None and not window_over()]
+                delay = min(delays) if delays else None
+                if not checking and not starting:
+                    if delay is None:
+                        continue
+                    if scheduler:
+                        print(f"\nNext status check in {delay:.0f} seconds ({len(scheduler)} scans running)...")
+                    time.sleep(delay)
+                    continue
+
+                done, _ = wait(list(checking) + list(starting), timeout=delay, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in starting:
+                        target = starting.pop(future)
+                        try:
+                            future.result()
+                        except Exception as e:
+                            print(f"Unexpected error starting {target[2]}: {e}")
+                            finished(target, False)
+                        continue
+                    target = checking.pop(future)
+                    try:
+                        complete = future.result()
+                    except Exception as e:
+                        print(f"Unexpected error checking {target[2]}: {e}")
+                        complete = False
+                    if not complete and tracked(target):
+                        scheduler.reschedule(target)
+                    elif not complete:
+                        scheduler.abandon(target)
+    finally:
+        if previous_handler is not None:
+            signal.signal(signal.SIGUSR1, previous_handler)
+
+    if KNOWN_CLEAN is not None:
+        KNOWN_CLEAN.close()
+        KNOWN_CLEAN = None
+
+    if queue is None or rolling:
+        RESULTS_INDEX.finish_run()
+    JOURNAL.finish()
+    JOURNAL.close()
+    JOURNAL = None
+    METRICS.finish()
+    if queue is None or rolling:
+        METRICS.write_timeline(METRICS_DIR / f"timeline_{time.strftime('%Y-%m-%d_%H-%M-%S')}.json")
+        METRICS.write_prometheus(PROMETHEUS_TEXTFILE_PATH)
+
+        # Assemble the final report and drop the provisional one. A daemon window
+        # reports the latest results of the whole fleet.
+        if rolling:
+            carried = queue.carry_over()
+            if carried:
+                print(f"\n{len(carried)} scans still running are carried over to the next window")
+            generate_report(queue.instances, running=set(carried))
+        else:
+            generate_report(instances_to_check)
+        for suffix in ('.md', '.pdf'):
+            (SCRIPT_DIR / f"{PARTIAL_REPORT_NAME}{suffix}").unlink(missing_ok=True)
+        if ARCHIVE is not None:
+            enforce_archive_retention(ARCHIVE)
+    else:
+        METRICS.write_timeline(METRICS_DIR / f"timeline_{worker}_{time.strftime('%Y-%m-%d_%H-%M-%S')}.json")
+        print(f"\nWorker {worker} processed {len(instances_to_check)} instances; the coordinator writes the report")
+    if queue is not None:
+        journal_path.unlink(missing_ok=True)
+    if ARCHIVE is not None:
+        ARCHIVE.close()
+        ARCHIVE = None
+    REPORT_FRAGMENTS = None
+    LIVE_FINDINGS = None
+    METRICS = None
+    RESULTS_INDEX.close()
+    RESULTS_INDEX = None
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,266 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+SCHEMA = '''
+-- Compressed chunk files under chunks/, named by the SHA-256 of their content
+CREATE TABLE IF NOT EXISTS chunks (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    stored_size INTEGER NOT NULL
+);
+-- Whole file contents, named by their SHA-256, as a sequence of chunks
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blob_chunks (
+    blob TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    chunk TEXT NOT NULL,
+    PRIMARY KEY (blob, seq)
+);
+CREATE INDEX IF NOT EXISTS blob_chunks_by_chunk ON blob_chunks (chunk);
+-- The files of each instance in each run
+CREATE TABLE IF NOT EXISTS files (
+    run_id INTEGER NOT NULL,
+    project TEXT NOT NULL,
+    zone TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    name TEXT NOT NULL,
+    blob TEXT NOT NULL,
+    gzipped INTEGER NOT NULL,          -- the file was gzip'd; its uncompressed content is stored
+    archived_at REAL NOT NULL,
+    PRIMARY KEY (run_id, project, instance, name)
+);
+CREATE INDEX IF NOT EXISTS files_by_blob ON files (blob);
+'''
+
+# Content-defined chunking: a chunk ends after a line whose CRC-32 has the low
+# CHUNK_BOUNDARY_MASK bits clear, once it holds at least CHUNK_MIN_SIZE bytes.
+# Boundaries follow the content, so a line inserted into a log only changes the
+# chunk it lands in. Lines are read at most CHUNK_MAX_SIZE bytes at a time.
+CHUNK_MIN_SIZE = 64 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_BOUNDARY_MASK = 0x3FF
+COMPRESSION_LEVEL = 6
+
+
+def split_chunks(stream: BinaryIO) -> Iterator[bytes]:
+    """Content-defined chunks of a binary stream, read one line at a time."""
+    buffer = bytearray()
+    while True:
+        line = stream.readline(CHUNK_MAX_SIZE)
+        if not line:
+            break
+        buffer += line
+        if len(buffer) >= CHUNK_MAX_SIZE or (len(buffer) >= CHUNK_MIN_SIZE
+                                             and zlib.crc32(line) & CHUNK_BOUNDARY_MASK == 0):
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+class ArchivedFile(io.RawIOBase):
+    """Read-only stream of an archived file, decompressing one chunk at a time."""
+
+    def __init__(self, chunk_paths: List[Path]):
+        super().__init__()
+        self._chunk_paths = iter(chunk_paths)
+        self._chunk = b''
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self._position >= len(self._chunk):
+            path = next(self._chunk_paths, None)
+            if path is None:
+                return 0
+            self._chunk = zlib.decompress(path.read_bytes())
+            self._position = 0
+        count = min(len(buffer), len(self._chunk) - self._position)
+        buffer[:count] = self._chunk[self._position:self._position + count]
+        self._position += count
+        return count
+
+
+class LogArchive:
+    """Content-addressed, chunk-deduplicated archive of the files retrieved in each run.
+
+    Files are split into content-defined chunks; each distinct chunk is stored
+    once, zlib-compressed, so the largely identical logs and manifests of
+    successive runs and of instances built from the same image share storage.
+    Gzip'd files are archived by their uncompressed content, which is what
+    dedups, and read back uncompressed.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._chunk_dir = directory / "chunks"
+        self._chunk_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(directory / "archive.db"), timeout=30, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def _chunk_path(self, chunk_hash: str) -> Path:
+        return self._chunk_dir / chunk_hash[:2] / chunk_hash
+
+    def _store_chunk(self, chunk: bytes) -> Tuple[str, int]:
+        """Write a chunk unless it is stored already. Returns its hash and stored size."""
+        chunk_hash = hashlib.sha256(chunk).hexdigest()
+        path = self._chunk_path(chunk_hash)
+        if path.exists():
+            return chunk_hash, path.stat().st_size
+        path.parent.mkdir(exist_ok=True)
+        data = zlib.compress(chunk, COMPRESSION_LEVEL)
+        tmp_path = path.with_name(f".{chunk_hash}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        return chunk_hash, len(data)
+
+    def add_file(self, run_id: int, project: str, zone: str, instance: str, name: str, path: Path) -> None:
+        """Archive the file at path as name of the instance in the run, streaming it chunk by chunk.
+        Raises OSError or EOFError if it cannot be read, such as a truncated gzip file."""
+        gzipped = path.suffix == '.gz'
+        opener = gzip.open if gzipped else open
+        digest = hashlib.sha256()
+        size = 0
+        chunks = []
+        try:
+            with opener(path, 'rb') as f:
+                for chunk in split_chunks(f):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    chunk_hash, stored_size = self._store_chunk(chunk)
+                    chunks.append((chunk_hash, len(chunk), stored_size))
+        except BaseException:
+            # Register the chunks written so far, so garbage collection removes them
+            with self._lock:
+                self._db.executemany('INSERT OR IGNORE INTO chunks (hash, size, stored_size) VALUES (?, ?, ?)', chunks)
+                self._db.commit()
+            raise
+        blob = digest.hexdigest()
+        with self._lock:
+            self._db.executemany('INSERT OR IGNORE INTO chunks (hash, size, stored_size) VALUES (?, ?, ?)', chunks)
+            if self._db.execute('INSERT OR IGNORE INTO blobs (hash, size) VALUES (?, ?)', (blob, size)).rowcount:
+                self._db.executemany('INSERT INTO blob_chunks (blob, seq, chunk) VALUES (?, ?, ?)',
+                                     ((blob, seq, chunk_hash) for seq, (chunk_hash, _, _) in enumerate(chunks)))
+            self._db.execute(
+                'INSERT OR REPLACE INTO files (run_id, project, zone, instance, name, blob, gzipped, archived_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_id, project, zone, instance, name, blob, int(gzipped), time.time())
+            )
+            self._db.commit()
+
+    def instances(self, run_id: int) -> List[Tuple[str, str, str]]:
+        """(project, zone, instance) of every instance with files archived in the run."""
+        with self._lock:
+            return self._db.execute('SELECT DISTINCT project, zone, instance FROM files WHERE run_id = ? '
+                                    'ORDER BY project, instance', (run_id,)).fetchall()
+
+    def latest_run(self, project: str, instance: str) -> Optional[int]:
+        """The last run with files of the instance archived, or None."""
+        with self._lock:
+            return self._db.execute('SELECT MAX(run_id) FROM files WHERE project = ? AND instance = ?',
+                                    (project, instance)).fetchone()[0]
+
+    def runs(self) -> List[Tuple[int, int, float]]:
+        """(run_id, instances, last archived at) of every archived run, newest first."""
+        with self._lock:
+            return self._db.execute("SELECT run_id, COUNT(DISTINCT project || '/' || instance), MAX(archived_at) "
+                                    "FROM files GROUP BY run_id ORDER BY run_id DESC").fetchall()
+
+    def has(self, run_id: int, project: str, instance: str, name: str) -> bool:
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM files WHERE run_id = ? AND project = ? AND instance = ? AND name = ?',
+                                    (run_id, project, instance, name)).fetchone() is not None
+
+    def open(self, run_id: int, project: str, instance: str, name: str) -> Optional[io.BufferedReader]:
+        """The uncompressed content of an archived file as a binary stream, or None if not archived."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT c.chunk FROM files f JOIN blob_chunks c ON c.blob = f.blob '
+                'WHERE f.run_id = ? AND f.project = ? AND f.instance = ? AND f.name = ? ORDER BY c.seq',
+                (run_id, project, instance, name)).fetchall()
+        if not rows and not self.has(run_id, project, instance, name):
+            return None
+        return io.BufferedReader(ArchivedFile([self._chunk_path(chunk_hash) for chunk_hash, in rows]))
+
+    def open_text(self, run_id: int, project: str, instance: str, name: str) -> Optional[Iterator[str]]:
+        """Lines of an archived text file, read lazily, or None if not archived."""
+        stream = self.open(run_id, project, instance, name)
+        if stream is None:
+            return None
+        return self._lines(stream)
+
+    @staticmethod
+    def _lines(stream: io.BufferedReader) -> Iterator[str]:
+        with io.TextIOWrapper(stream, encoding='utf-8', errors='replace') as f:
+            yield from f
+
+    def read_json(self, run_id: int, project: str, instance: str, name: str) -> Optional[Dict]:
+        stream = self.open(run_id, project, instance, name)
+        if stream is None:
+            return None
+        with stream:
+            try:
+                return json.load(stream)
+            except ValueError:
+                return None
+
+    def stats(self) -> Dict[str, int]:
+        """Runs, archived (uncompressed) bytes and stored bytes."""
+        with self._lock:
+            runs, = self._db.execute('SELECT COUNT(DISTINCT run_id) FROM files').fetchone()
+            logical, = self._db.execute('SELECT COALESCE(SUM(b.size), 0) FROM files f JOIN blobs b ON b.hash = f.blob').fetchone()
+            stored, = self._db.execute('SELECT COALESCE(SUM(stored_size), 0) FROM chunks').fetchone()
+        return {'runs': runs, 'archived_bytes': logical, 'stored_bytes': stored}
+
+    def _collect_garbage(self) -> int:
+        """Drop blobs no file refers to and chunks no blob refers to. Returns the bytes freed."""
+        self._db.execute('DELETE FROM blobs WHERE hash NOT IN (SELECT blob FROM files)')
+        self._db.execute('DELETE FROM blob_chunks WHERE blob NOT IN (SELECT hash FROM blobs)')
+        orphans = self._db.execute('SELECT hash, stored_size FROM chunks '
+                                   'WHERE hash NOT IN (SELECT chunk FROM blob_chunks)').fetchall()
+        self._db.executemany('DELETE FROM chunks WHERE hash = ?', ((chunk_hash,) for chunk_hash, _ in orphans))
+        self._db.commit()
+        for chunk_hash, _ in orphans:
+            self._chunk_path(chunk_hash).unlink(missing_ok=True)
+        return sum(stored_size for _, stored_size in orphans)
+
+    def enforce_retention(self, keep_runs: int, max_bytes: int) -> int:
+        """Evict each instance's files beyond its newest keep_runs runs, then whole runs,
+        oldest first, until the stored chunks fit in max_bytes. Returns the bytes freed.
+        Must not run while another process archives into the same directory."""
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM files WHERE (run_id, project, instance) IN ('
+                ' SELECT run_id, project, instance FROM ('
+                '  SELECT run_id, project, instance, DENSE_RANK() OVER ('
+                '   PARTITION BY project, instance ORDER BY run_id DESC) AS age'
+                '  FROM files) WHERE age > ?)', (keep_runs,))
+            freed = self._collect_garbage()
+            while True:
+                stored, = self._db.execute('SELECT COALESCE(SUM(stored_size), 0) FROM chunks').fetchone()
+                oldest, = self._db.execute('SELECT MIN(run_id) FROM files').fetchone()
+                if stored <= max_bytes or oldest is None:
+                    break
+                self._db.execute('DELETE FROM files WHERE run_id = ?', (oldest,))
+                freed += self._collect_garbage()
+        return freed
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -1,47 +1,39 @@
 import markdown
 from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, HRFlowable, KeepTogether, PageBreak
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, HRFlowable, KeepTogether, PageBreak, Preformatted, Table, TableStyle
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 from reportlab.lib.units import inch
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.lib import colors
 from reportlab.pdfgen import canvas
 from bs4 import BeautifulSoup
+from functools import lru_cache
+from xml.sax.saxutils import escape
+import textwrap
 import os
 
-def convert_markdown_to_pdf(md_file, pdf_file, image_path=None):
-    # Read the Markdown content with UTF-8 encoding
-    with open(md_file, 'r', encoding='utf-8') as f:
-        markdown_content = f.read()
+# Findings shown per instance in the PDF; the markdown report always lists all of them
+MAX_PDF_FINDINGS_PER_INSTANCE = 200
+# Findings lines per flowable. Lines are grouped so large lists need fewer
+# flowables, while each group stays small enough to split across pages.
+FINDINGS_LINES_PER_PARAGRAPH = 50
+# Findings are laid out as preformatted text, wrapped at this many characters,
+# which is much cheaper than word-wrapping a Paragraph
+FINDINGS_LINE_LENGTH = 60
+# Instance details are drawn as a plain-text table: no markup parsing or word
+# wrapping, and values are wrapped at this many characters instead
+INSTANCE_LABEL_WIDTH = 150
+INSTANCE_VALUE_LENGTH = 48
+PAGE_BACKGROUND = colors.HexColor('#263743')
+ACCENT_COLOR = colors.HexColor('#1abc9c')
+FINDINGS_COLOR = colors.HexColor('#b01a1a')
 
-    # Convert Markdown to HTML with extensions
-    html_content = markdown.markdown(markdown_content, extensions=['tables'])
-    
-    # Parse HTML to handle different elements
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # Get the title from the first h1 element, or use a default
-    title = "InterstellarShield Scan Report"
-
-    
-    # Create PDF document with metadata
-    doc = SimpleDocTemplate(
-        pdf_file,
-        pagesize=letter,
-        rightMargin=72,
-        leftMargin=72,
-        topMargin=50,
-        bottomMargin=50,
-        title=title,
-        author="InterstellarShield",
-        subject="Manual Malware Scan Report",
-        creator="InterstellarShield Report Generator"
-    )
-    
-    # Create styles with dark mode colors
+@lru_cache(maxsize=None)
+def report_styles():
+    """Paragraph styles shared by both PDF paths, built once per process."""
     styles = getSampleStyleSheet()
-    
-    # Add a new style for findings labels
-    findings_label_style = ParagraphStyle(
+    report = {}
+    report['findings_label'] = ParagraphStyle(
         'FindingsLabel',
         parent=styles['Normal'],
         fontSize=12,
@@ -51,8 +43,7 @@ def convert_markdown_to_pdf(md_file, pdf_file, image_path=None):
         textColor=colors.white,
         fontName='Helvetica-Bold'
     )
-
-    normal_style = ParagraphStyle(
+    report['normal'] = ParagraphStyle(
         'CustomNormal',
         parent=styles['Normal'],
         fontSize=12,
@@ -61,8 +52,7 @@ def convert_markdown_to_pdf(md_file, pdf_file, image_path=None):
         leading=14,
         textColor=colors.white
     )
-
-    title_style = ParagraphStyle(
+    report['title'] = ParagraphStyle(
         'CustomTitle',
         parent=styles['Heading1'],
         fontSize=24,
@@ -70,14 +60,20 @@ def convert_markdown_to_pdf(md_file, pdf_file, image_path=None):
         textColor=colors.white,
         alignment=1  # Center alignment
     )
-    heading_style = ParagraphStyle(
+    report['heading'] = ParagraphStyle(
         'CustomHeading',
         parent=styles['Heading2'],
         fontSize=16,
         spaceAfter=12,
         textColor=colors.white
     )
-    subheading_style = ParagraphStyle(
+    report['centered_heading'] = ParagraphStyle(
+        'CenteredHeader',
+        parent=report['heading'],
+        alignment=1,  # Center alignment
+        spaceAfter=30
+    )
+    report['subheading'] = ParagraphStyle(
         'CustomSubHeading',
         parent=styles['Heading3'],
         fontSize=14,
@@ -85,16 +81,16 @@ def convert_markdown_to_pdf(md_file, pdf_file, image_path=None):
         textColor=colors.white,
         leftIndent=20
     )
-    instance_style = ParagraphStyle(
+    report['instance'] = ParagraphStyle(
         'InstanceStyle',
         parent=styles['Heading4'],
         fontSize=14,
         spaceAfter=6,
-        textColor=colors.HexColor('#1abc9c'),
+        textColor=ACCENT_COLOR,
         leftIndent=20,
         leading=16
     )
-    bullet_style = ParagraphStyle(
+    report['bullet'] = ParagraphStyle(
         'CustomBullet',
         parent=styles['Normal'],
         fontSize=12,
@@ -104,6 +100,103 @@ def convert_markdown_to_pdf(md_file, pdf_file, image_path=None):
         bulletIndent=10,
         textColor=colors.white
     )
+    report['findings'] = ParagraphStyle(
+        'FindingsRed',
+        parent=report['normal'],
+        textColor=FINDINGS_COLOR
+    )
+    report['log_path'] = ParagraphStyle(
+        'LogPath',
+        parent=report['findings'],
+        leftIndent=60  # Increased indent for log path
+    )
+    # First column of section tables that do not fit the page; breaks anywhere,
+    # as instance names have no spaces
+    report['table_cell'] = ParagraphStyle(
+        'TableCell',
+        parent=styles['Normal'],
+        fontSize=8,
+        leading=10,
+        textColor=colors.white,
+        wordWrap='CJK'
+    )
+    return report
+
+@lru_cache(maxsize=None)
+def instance_table_style():
+    """Table style for instance details: accent-coloured name row, then bold labels and values."""
+    return TableStyle([
+        ('SPAN', (0, 0), (1, 0)),
+        ('FONTNAME', (0, 0), (0, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (0, 0), 14),
+        ('LEADING', (0, 0), (0, 0), 16),
+        ('TEXTCOLOR', (0, 0), (0, 0), ACCENT_COLOR),
+        ('BOTTOMPADDING', (0, 0), (0, 0), 6),
+        ('FONTNAME', (0, 1), (0, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 1), (-1, -1), 12),
+        ('LEADING', (0, 1), (-1, -1), 14),
+        ('TEXTCOLOR', (0, 1), (-1, -1), colors.white),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ('LEFTPADDING', (0, 0), (0, -1), 20),
+        ('LEFTPADDING', (1, 0), (1, -1), 0),
+        ('TOPPADDING', (0, 1), (-1, -1), 1),
+        ('BOTTOMPADDING', (0, 1), (-1, -1), 2),
+    ])
+
+def data_table_style():
+    """Table style for section tables: accent-coloured header row, then small white text."""
+    return TableStyle([
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('TEXTCOLOR', (0, 0), (-1, 0), ACCENT_COLOR),
+        ('LINEBELOW', (0, 0), (-1, 0), 0.5, ACCENT_COLOR),
+        ('TEXTCOLOR', (0, 1), (-1, -1), colors.white),
+        ('FONTSIZE', (0, 0), (-1, -1), 8),
+        ('LEADING', (0, 0), (-1, -1), 10),
+        ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 3),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 3),
+        ('TOPPADDING', (0, 0), (-1, -1), 1),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+    ])
+
+def convert_markdown_to_pdf(md_file, pdf_file, image_path=None):
+    # Read the Markdown content with UTF-8 encoding
+    with open(md_file, 'r', encoding='utf-8') as f:
+        markdown_content = f.read()
+
+    # Convert Markdown to HTML with extensions
+    html_content = markdown.markdown(markdown_content, extensions=['tables'])
+    
+    # Parse HTML to handle different elements
+    soup = BeautifulSoup(html_content, 'html.parser')
+    
+    # Get the title from the first h1 element, or use a default
+    title = "InterstellarShield Scan Report"
+
+    
+    # Create PDF document with metadata
+    doc = SimpleDocTemplate(
+        pdf_file,
+        pagesize=letter,
+        rightMargin=72,
+        leftMargin=72,
+        topMargin=50,
+        bottomMargin=50,
+        title=title,
+        author="InterstellarShield",
+        subject="Manual Malware Scan Report",
+        creator="InterstellarShield Report Generator"
+    )
+    
+    # Create styles with dark mode colors
+    styles = report_styles()
+    findings_label_style = styles['findings_label']
+    normal_style = styles['normal']
+    title_style = styles['title']
+    subheading_style = styles['subheading']
+    instance_style = styles['instance']
+    bullet_style = styles['bullet']
+    heading_style = styles['heading']
     
     # Build PDF content
     story = []
@@ -134,17 +227,12 @@ def convert_markdown_to_pdf(md_file, pdf_file, image_path=None):
     story.append(PageBreak())
     
     # Add centered scan results header at top of second page
-    story.append(Paragraph("Manual ClamAV Scan Results Report", ParagraphStyle(
-        'CenteredHeader',
-        parent=heading_style,
-        alignment=1,  # Center alignment
-        spaceAfter=30
-    )))
+    story.append(Paragraph("Manual ClamAV Scan Results Report", styles['centered_heading']))
 
     # Custom canvas to set background and add timestamp
     def set_background(canvas, doc):
         canvas.saveState()
-        canvas.setFillColor(colors.HexColor('#263743'))
+        canvas.setFillColor(PAGE_BACKGROUND)
         canvas.rect(0, 0, letter[0], letter[1], fill=1)
         
         # Add timestamp at bottom of first page only
@@ -196,23 +284,14 @@ def convert_markdown_to_pdf(md_file, pdf_file, image_path=None):
                     findings_text = element.text.replace('Findings:', '').strip()
                     if findings_text and findings_text != "No malware detected.":
                         # Use a red color for detected malware
-                        findings_style = ParagraphStyle(
-                            'FindingsRed',
-                            parent=normal_style,
-                            textColor=colors.HexColor('#b01a1a')
-                        )
+                        findings_style = styles['findings']
                         # Split the findings text into lines
                         findings_lines = findings_text.split('\n')
                         for line in findings_lines:
                             if line.strip():  # Only process non-empty lines
                                 if line.startswith('Please review'):
                                     # Add log path line with slightly different styling
-                                    log_style = ParagraphStyle(
-                                        'LogPath',
-                                        parent=findings_style,
-                                        leftIndent=60  # Increased indent for log path
-                                    )
-                                    content.append(Paragraph(line.strip(), log_style))
+                                    content.append(Paragraph(line.strip(), styles['log_path']))
                                 else:
                                     content.append(Paragraph(line.strip(), findings_style))
                     else:
@@ -224,7 +303,7 @@ def convert_markdown_to_pdf(md_file, pdf_file, image_path=None):
                 if current_section:
                     story.append(KeepTogether(current_section))
                     current_section = []
-                story.append(HRFlowable(width="100%", thickness=1, color=colors.HexColor('#1abc9c')))
+                story.append(HRFlowable(width="100%", thickness=1, color=ACCENT_COLOR))
                 story.append(Spacer(1, 12))
                 continue
             
@@ -249,6 +328,182 @@ def convert_markdown_to_pdf(md_file, pdf_file, image_path=None):
     except Exception as e:
         print(f"Error generating PDF: {e}")
 
+# Structured reports are plain dicts, built by ishield.py and rendered to
+# markdown and PDF here:
+#   title: str, generated: str ("Report generated: ...")
+#   sections: [{'heading': str, 'bullets': [str], 'blocks': [(label, [line])],
+#               'tables': [(label, [column], [[cell]])]}], blocks and tables optional
+#   instances: [{'name': str, 'fields': [(label, value)],
+#                'findings': [line] or None when there are no results, 'note': str or None,
+#                'markdown': str, optional, used instead of rendering instance_markdown()}]
+
+def instance_markdown(instance):
+    """Markdown for one instance of a structured report."""
+    lines = [f"#### Instance: {instance['name']}\n"]
+    lines.extend(f"- **{label}**: {value}\n" for label, value in instance['fields'])
+    if instance['findings'] is None:
+        lines.append("\n**Status**: No results file found. Scan may have failed or still be running.\n")
+    else:
+        lines.append("\n**Findings:**\n")
+        lines.extend(f"{line}\n" for line in instance['findings'])
+        if not instance['findings']:
+            lines.append("No malware detected.\n")
+    if instance.get('note'):
+        lines.append(f"\n{instance['note']}\n")
+    lines.append("\n---\n\n")
+    return ''.join(lines)
+
+def write_markdown_report(report, md_file):
+    """Write a structured report as markdown."""
+    with open(md_file, 'w', encoding='utf-8') as f:
+        # Add InterstellarShield logo
+        f.write("<p align=\"center\">\n")
+        f.write("  <img width=\"300\" src=\"./img/interstellarshield.png\" alt=\"InterstellarShield Icon\">\n")
+        f.write("</p>\n\n")
+        f.write(f"<h1 align=\"center\">{report['title']}</h1>\n\n")
+        f.write("## Manual ClamAV Scan Results Report\n\n")
+        f.write(f"{report['generated']}\n\n")
+        for section in report['sections']:
+            f.write(f"### {section['heading']}\n\n")
+            f.writelines(f"- {bullet}\n" for bullet in section['bullets'])
+            f.write("\n")
+            for label, lines in section.get('blocks', []):
+                f.write(f"**{label}:**\n")
+                f.writelines(f"{line}\n" for line in lines)
+                f.write("\n")
+            for label, columns, rows in section.get('tables', []):
+                f.write(f"**{label}:**\n\n")
+                f.write(f"| {' | '.join(columns)} |\n")
+                f.write(f"|{'---|' * len(columns)}\n")
+                f.writelines(f"| {' | '.join(str(cell) for cell in row)} |\n" for row in rows)
+                f.write("\n")
+        f.write("### Detailed Results\n\n")
+        for instance in report['instances']:
+            f.write(instance.get('markdown') or instance_markdown(instance))
+
+def _line_paragraphs(lines, style):
+    """Preformatted blocks of up to FINDINGS_LINES_PER_PARAGRAPH lines each."""
+    for start in range(0, len(lines), FINDINGS_LINES_PER_PARAGRAPH):
+        chunk = lines[start:start + FINDINGS_LINES_PER_PARAGRAPH]
+        yield Preformatted('\n'.join(chunk), style, maxLineLength=FINDINGS_LINE_LENGTH, newLineChars='    ')
+
+def data_table(columns, rows, width):
+    """A section table no wider than width. When its natural width is larger, the first
+    column (such as instance names) gets the space the other columns leave and wraps."""
+    cells = [[str(cell) for cell in row] for row in rows]
+    # Text width plus the 3pt left and right padding of data_table_style()
+    natural = [max([stringWidth(columns[column], 'Helvetica-Bold', 8)]
+                   + [stringWidth(row[column], 'Helvetica', 8) for row in cells]) + 6
+               for column in range(len(columns))]
+    if sum(natural) <= width:
+        return Table([columns] + cells, style=data_table_style(), hAlign='LEFT', repeatRows=1)
+    first_width = max(width - sum(natural[1:]), width / 4)
+    style = report_styles()['table_cell']
+    cells = [[Paragraph(escape(row[0]), style)] + row[1:] for row in cells]
+    return Table([columns] + cells, colWidths=[first_width] + natural[1:],
+                 style=data_table_style(), hAlign='LEFT', repeatRows=1)
+
+def instance_flowables(instance, max_findings=MAX_PDF_FINDINGS_PER_INSTANCE):
+    """Flowables for one instance of a structured report."""
+    styles = report_styles()
+    rows = [[instance['name'], '']]
+    rows.extend([f"{label}:", textwrap.fill(str(value), INSTANCE_VALUE_LENGTH)] for label, value in instance['fields'])
+    findings = instance['findings']
+    if findings is None:
+        rows.append(["Status:", textwrap.fill(
+            "No results file found. Scan may have failed or still be running.", INSTANCE_VALUE_LENGTH)])
+    else:
+        rows.append(["Findings:", '' if findings else "No malware detected."])
+    flowables = [Table(rows, colWidths=[INSTANCE_LABEL_WIDTH, None], style=instance_table_style(), hAlign='LEFT')]
+    if findings:
+        flowables.append(Spacer(1, 6))
+        flowables.extend(_line_paragraphs(findings[:max_findings], styles['findings']))
+        if len(findings) > max_findings:
+            flowables.append(Paragraph(
+                f"... {len(findings) - max_findings} more lines not shown; see the markdown report.",
+                styles['log_path']))
+    if instance.get('note'):
+        flowables.append(Preformatted(instance['note'], styles['log_path'],
+                                      maxLineLength=FINDINGS_LINE_LENGTH - 5, newLineChars='    '))
+    flowables.append(Spacer(1, 6))
+    flowables.append(HRFlowable(width="100%", thickness=1, color=ACCENT_COLOR))
+    flowables.append(Spacer(1, 12))
+    return flowables
+
+def write_pdf_report(report, pdf_file, image_path=None, max_findings=MAX_PDF_FINDINGS_PER_INSTANCE):
+    """Render a structured report straight to PDF flowables, without a markdown/HTML round trip."""
+    styles = report_styles()
+    doc = SimpleDocTemplate(
+        pdf_file,
+        pagesize=letter,
+        rightMargin=72,
+        leftMargin=72,
+        topMargin=50,
+        bottomMargin=50,
+        title="InterstellarShield Scan Report",
+        author="InterstellarShield",
+        subject="Manual Malware Scan Report",
+        creator="InterstellarShield Report Generator"
+    )
+
+    story = []
+    if image_path and os.path.exists(image_path):
+        try:
+            img = Image(image_path)
+            aspect = img.imageWidth / img.imageHeight
+            if aspect > 1:
+                img.drawWidth = 6 * inch
+                img.drawHeight = 6 * inch / aspect
+            else:
+                img.drawHeight = 6 * inch
+                img.drawWidth = 6 * inch * aspect
+            story.append(img)
+            story.append(Spacer(1, 24))
+        except Exception as e:
+            print(f"Warning: Could not add image: {e}")
+    story.append(Paragraph(escape(report['title']), styles['title']))
+    story.append(Spacer(1, 12))
+    story.append(PageBreak())
+    story.append(Paragraph("Manual ClamAV Scan Results Report", styles['centered_heading']))
+
+    for section in report['sections']:
+        section_flowables = [Paragraph(escape(section['heading']), styles['subheading'])]
+        section_flowables.extend(Paragraph(f"• {escape(bullet)}", styles['bullet']) for bullet in section['bullets'])
+        story.append(KeepTogether(section_flowables))
+        story.append(Spacer(1, 6))
+        for label, lines in section.get('blocks', []):
+            story.append(Paragraph(f"{escape(label)}:", styles['findings_label']))
+            story.extend(_line_paragraphs(lines[:max_findings], styles['normal']))
+            if len(lines) > max_findings:
+                story.append(Paragraph(
+                    f"... {len(lines) - max_findings} more lines not shown; see the markdown report.",
+                    styles['normal']))
+        for label, columns, rows in section.get('tables', []):
+            story.append(Paragraph(f"{escape(label)}:", styles['findings_label']))
+            story.append(data_table(columns, rows, doc.width))
+            story.append(Spacer(1, 12))
+
+    story.append(Paragraph("Detailed Results", styles['subheading']))
+    for instance in report['instances']:
+        story.extend(instance_flowables(instance, max_findings))
+
+    def set_background(canvas, doc):
+        canvas.saveState()
+        canvas.setFillColor(PAGE_BACKGROUND)
+        canvas.rect(0, 0, letter[0], letter[1], fill=1)
+        # Add timestamp at bottom of first page only
+        if doc.page == 1:
+            canvas.setFillColor(colors.white)
+            canvas.setFont('Helvetica', 14)
+            canvas.drawCentredString(letter[0]/2, 50, report['generated'])
+        canvas.restoreState()
+
+    try:
+        doc.build(story, onFirstPage=set_background, onLaterPages=set_background)
+        print(f"PDF successfully saved as {pdf_file}")
+    except Exception as e:
+        print(f"Error generating PDF: {e}")
+
 # Example usage
 if __name__ == "__main__":
     try:
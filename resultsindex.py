@@ -0,0 +1,254 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from scanlog import InstanceResults
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS instances (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    project TEXT NOT NULL,
+    zone TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    status TEXT NOT NULL,              -- running, complete or incomplete
+    scan_type TEXT,
+    db_version TEXT,
+    files_scanned INTEGER,
+    data_scanned_mb REAL,
+    scan_seconds REAL,
+    infected_files INTEGER,
+    completed_at REAL,
+    PRIMARY KEY (run_id, project, instance)
+);
+CREATE INDEX IF NOT EXISTS instances_by_host ON instances (project, instance, status, run_id);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    project TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    ok INTEGER NOT NULL,
+    failure TEXT                       -- class of the last failed call: unreachable, timeout, ...
+);
+CREATE INDEX IF NOT EXISTS phases_by_run ON phases (run_id, phase);
+CREATE TABLE IF NOT EXISTS findings (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    project TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    path TEXT NOT NULL,
+    signature TEXT NOT NULL,
+    PRIMARY KEY (run_id, project, instance, path, signature)
+);
+CREATE INDEX IF NOT EXISTS findings_by_host ON findings (project, instance, path, signature, run_id);
+-- Findings streamed from scans still running, when they were first seen
+CREATE TABLE IF NOT EXISTS live_findings (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    project TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    path TEXT NOT NULL,
+    signature TEXT NOT NULL,
+    detected_at REAL NOT NULL,
+    PRIMARY KEY (run_id, project, instance, path, signature)
+);
+'''
+
+# For every instance completed in run ?1, the most recent earlier run in which
+# it completed. Instances scanned for the first time have a NULL baseline.
+BASELINE = '''
+WITH baseline AS (
+    SELECT current.project, current.instance, MAX(previous.run_id) AS run_id
+    FROM instances current
+    LEFT JOIN instances previous
+        ON previous.project = current.project AND previous.instance = current.instance
+        AND previous.status = 'complete' AND previous.run_id < current.run_id
+    WHERE current.run_id = ?1 AND current.status = 'complete'
+    GROUP BY current.project, current.instance
+)
+'''
+
+# Findings of run ?1 absent from each instance's baseline run
+NEW_FINDINGS = BASELINE + '''
+SELECT f.project, f.instance, f.path, f.signature
+FROM findings f
+JOIN baseline b ON b.project = f.project AND b.instance = f.instance
+WHERE f.run_id = ?1 AND NOT EXISTS (
+    SELECT 1 FROM findings o
+    WHERE o.run_id = b.run_id AND o.project = f.project AND o.instance = f.instance
+        AND o.path = f.path AND o.signature = f.signature)
+ORDER BY f.project, f.instance, f.path
+'''
+
+# Baseline findings no longer present in run ?1
+RESOLVED_FINDINGS = BASELINE + '''
+SELECT o.project, o.instance, o.path, o.signature
+FROM findings o
+JOIN baseline b ON b.project = o.project AND b.instance = o.instance AND o.run_id = b.run_id
+WHERE NOT EXISTS (
+    SELECT 1 FROM findings f
+    WHERE f.run_id = ?1 AND f.project = o.project AND f.instance = o.instance
+        AND f.path = o.path AND f.signature = o.signature)
+ORDER BY o.project, o.instance, o.path
+'''
+
+# Findings of run ?1 also present in each instance's baseline run
+PERSISTENT_FINDINGS = BASELINE + '''
+SELECT f.project, f.instance, f.path, f.signature
+FROM findings f
+JOIN baseline b ON b.project = f.project AND b.instance = f.instance
+JOIN findings o ON o.run_id = b.run_id AND o.project = f.project AND o.instance = f.instance
+    AND o.path = f.path AND o.signature = f.signature
+WHERE f.run_id = ?1
+ORDER BY f.project, f.instance, f.path
+'''
+
+# Findings from runs started at or after ?1 that no completed scan of the same
+# instance reported before then
+NEW_FINDINGS_SINCE = '''
+SELECT f.project, f.instance, f.path, f.signature, MIN(r.started_at) AS first_seen
+FROM findings f
+JOIN runs r ON r.run_id = f.run_id
+WHERE r.started_at >= ?1 AND NOT EXISTS (
+    SELECT 1 FROM findings o JOIN runs p ON p.run_id = o.run_id
+    WHERE p.started_at < ?1 AND o.project = f.project AND o.instance = f.instance
+        AND o.path = f.path AND o.signature = f.signature)
+GROUP BY f.project, f.instance, f.path, f.signature
+ORDER BY f.project, f.instance, f.path
+'''
+
+Finding = Tuple[str, str, str, str]   # project, instance, path, signature
+
+
+class ResultsIndex:
+    """SQLite index of scan runs, instance results, phase timings and findings.
+
+    Rows are written as each instance progresses so an interrupted run keeps
+    everything recorded up to that point.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        # Workers of a coordinated run write to the same index
+        self._db = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        # Indexes created before phases had a failure column
+        if 'failure' not in [row[1] for row in self._db.execute('PRAGMA table_info(phases)')]:
+            self._db.execute('ALTER TABLE phases ADD COLUMN failure TEXT')
+        self._db.commit()
+        self.run_id = None
+
+    def start_run(self) -> int:
+        with self._lock:
+            cursor = self._db.execute('INSERT INTO runs (started_at) VALUES (?)', (time.time(),))
+            self._db.commit()
+            self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def resume_run(self, run_id: int) -> bool:
+        """Continue an interrupted run. False if the index has no such run."""
+        with self._lock:
+            cursor = self._db.execute('UPDATE runs SET finished_at = NULL WHERE run_id = ?', (run_id,))
+            self._db.commit()
+        if cursor.rowcount == 0:
+            return False
+        self.run_id = run_id
+        return True
+
+    def attach_run(self, run_id: int) -> None:
+        """Record into a run started by another process, such as the coordinator of the run."""
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO runs (run_id, started_at) VALUES (?, ?)', (run_id, time.time()))
+            self._db.commit()
+        self.run_id = run_id
+
+    def finish_run(self) -> None:
+        """Close the current run, marking instances that never completed as incomplete."""
+        with self._lock:
+            self._db.execute("UPDATE instances SET status = 'incomplete' WHERE run_id = ? AND status = 'running'",
+                             (self.run_id,))
+            self._db.execute('UPDATE runs SET finished_at = ? WHERE run_id = ?', (time.time(), self.run_id))
+            self._db.commit()
+
+    def start_instance(self, project: str, zone: str, instance: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO instances (run_id, project, zone, instance, status) VALUES (?, ?, ?, ?, 'running')",
+                (self.run_id, project, zone, instance)
+            )
+            self._db.commit()
+
+    def record_phase(self, project: str, instance: str, phase: str,
+                     started_at: float, finished_at: float, ok: bool, failure: Optional[str] = None) -> None:
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO phases (run_id, project, instance, phase, started_at, finished_at, ok, failure) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.run_id, project, instance, phase, started_at, finished_at, int(ok), failure)
+            )
+            self._db.commit()
+
+    def complete_instance(self, project: str, instance: str, results: InstanceResults,
+                          scan_info: Dict[str, str]) -> None:
+        """Store an instance's results. Scans without a summary block are kept as incomplete."""
+        summary = results.summary
+        with self._lock:
+            self._db.execute(
+                'UPDATE instances SET status = ?, scan_type = ?, db_version = ?, files_scanned = ?, '
+                'data_scanned_mb = ?, scan_seconds = ?, infected_files = ?, completed_at = ? '
+                'WHERE run_id = ? AND project = ? AND instance = ?',
+                ('complete' if results.complete else 'incomplete',
+                 scan_info.get('scan_type') or None, scan_info.get('db_version') or None,
+                 summary.scanned_files if summary else None,
+                 summary.data_scanned_mb if summary else None,
+                 summary.seconds if summary else None,
+                 len(results.findings), time.time(),
+                 self.run_id, project, instance)
+            )
+            self._db.executemany(
+                'INSERT OR IGNORE INTO findings (run_id, project, instance, path, signature) VALUES (?, ?, ?, ?, ?)',
+                ((self.run_id, project, instance, finding.path, finding.signature or '')
+                 for finding in results.findings)
+            )
+            self._db.commit()
+
+    def record_live_findings(self, project: str, instance: str, findings: Iterable[Tuple[str, str]],
+                             detected_at: float) -> None:
+        """Findings (path, signature) reported by a scan before it finished."""
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO live_findings (run_id, project, instance, path, signature, detected_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                ((self.run_id, project, instance, path, signature, detected_at) for path, signature in findings)
+            )
+            self._db.commit()
+
+    def _query(self, sql: str, parameters: Iterable) -> List[tuple]:
+        with self._lock:
+            return self._db.execute(sql, tuple(parameters)).fetchall()
+
+    def new_findings(self, run_id: Optional[int] = None) -> List[Finding]:
+        """Findings of the run that the previous completed scan of the same instance did not report."""
+        return self._query(NEW_FINDINGS, (run_id or self.run_id,))
+
+    def resolved_findings(self, run_id: Optional[int] = None) -> List[Finding]:
+        """Findings of the previous completed scan of each instance that the run no longer reports."""
+        return self._query(RESOLVED_FINDINGS, (run_id or self.run_id,))
+
+    def persistent_findings(self, run_id: Optional[int] = None) -> List[Finding]:
+        """Findings of the run that the previous completed scan of the same instance also reported."""
+        return self._query(PERSISTENT_FINDINGS, (run_id or self.run_id,))
+
+    def new_findings_since(self, timestamp: float) -> List[tuple]:
+        """(project, instance, path, signature, first_seen) of findings first reported at or after timestamp."""
+        return self._query(NEW_FINDINGS_SINCE, (timestamp,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,95 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Instance states in lifecycle order. An instance with no state record is discovered.
+STATES = ('discovered', 'deployed', 'running', 'retrieved', 'cleaned')
+
+Target = Tuple[str, str, str]   # project, zone, instance
+
+
+class RunJournal:
+    """Append-only JSON lines log of a run's instance state transitions.
+
+    Every record is fsync'd before record() returns, so after a crash or reboot
+    the journal holds each transition that completed, and at most a torn last
+    line, which read_journal() ignores.
+    """
+
+    def __init__(self, path: Path, append: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        created = not path.exists()
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if append else os.O_TRUNC)
+        self._fd = os.open(path, flags, 0o600)
+        if created:
+            # Make the new directory entry itself durable
+            directory = os.open(path.parent, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    def _append(self, record: Dict) -> None:
+        line = (json.dumps(record) + '\n').encode()
+        with self._lock:
+            os.write(self._fd, line)
+            os.fsync(self._fd)
+
+    def start(self, run_id: int, instances: List[Target]) -> None:
+        """Begin a run; its instances start out discovered."""
+        self._append({'event': 'run', 'run_id': run_id, 'at': time.time(),
+                      'instances': [list(target) for target in instances]})
+
+    def resumed(self, run_id: int) -> None:
+        self._append({'event': 'resumed', 'run_id': run_id, 'at': time.time()})
+
+    def record(self, target: Target, state: str) -> None:
+        project_id, zone, instance = target
+        self._append({'event': 'state', 'project': project_id, 'zone': zone, 'instance': instance,
+                      'state': state, 'at': time.time()})
+
+    def finish(self) -> None:
+        self._append({'event': 'finished', 'at': time.time()})
+
+    def close(self) -> None:
+        with self._lock:
+            os.close(self._fd)
+
+
+def read_journal(path: Path) -> Optional[Dict]:
+    """The run recorded in the journal, or None if there is none:
+    {'run_id', 'started_at', 'finished', 'instances': [target],
+     'states': {target: state}, 'deployed_at': {target: at}}, with each
+    instance's latest state and when its scan was last deployed."""
+    try:
+        f = open(path, encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    run = None
+    with f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record['event'] == 'run':
+                run = {'run_id': record['run_id'], 'started_at': record['at'], 'finished': False,
+                       'instances': [tuple(target) for target in record['instances']],
+                       'states': {}, 'deployed_at': {}}
+            elif run is None:
+                continue
+            elif record['event'] == 'resumed':
+                run['run_id'] = record['run_id']
+                run['finished'] = False
+            elif record['event'] == 'finished':
+                run['finished'] = True
+            elif record['event'] == 'state':
+                target = (record['project'], record['zone'], record['instance'])
+                run['states'][target] = record['state']
+                if record['state'] == 'deployed':
+                    run['deployed_at'][target] = record['at']
+    return run
@@ -0,0 +1,258 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Phase records carry the gcloud/ssh calls made while they were current on
+# their thread: calls, failed calls, retries and bytes sent and received.
+# Failed calls count every failed attempt, including ones retried successfully.
+COUNTERS = ('calls', 'failures', 'retries', 'bytes_sent', 'bytes_received')
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def _label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RunMetrics:
+    """Per-phase timings, transfer counters and scan durations of one run.
+
+    Lifecycle phases are timed with phase(); calls made on the same thread
+    while a phase is open are attributed to it through record_call(),
+    record_retry() and record_failure().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = threading.local()
+        self._phases: List[Dict] = []
+        self._scans: Dict[tuple, Dict] = {}
+        self._failure_classes = Counter()
+        self._instance_failure_classes: Dict[tuple, Counter] = {}
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    @contextmanager
+    def phase(self, project_id: str, zone: str, instance: str, name: str):
+        """Time a phase. It counts as failed if it raises or a call in it fails for good."""
+        record = dict(project=project_id, zone=zone, instance=instance, phase=name,
+                      started_at=time.time(), finished_at=None, ok=False, failure=None,
+                      **dict.fromkeys(COUNTERS, 0))
+        previous = getattr(self._current, 'record', None)
+        self._current.record = record
+        raised = True
+        try:
+            yield record
+            raised = False
+        finally:
+            self._current.record = previous
+            record['finished_at'] = time.time()
+            record['ok'] = not raised and record['failure'] is None
+            with self._lock:
+                self._phases.append(record)
+
+    def record_call(self, ok: bool, bytes_sent: int = 0, bytes_received: int = 0) -> None:
+        record = getattr(self._current, 'record', None)
+        if record is None:
+            return
+        record['calls'] += 1
+        record['failures'] += 0 if ok else 1
+        self.record_transfer(bytes_sent, bytes_received)
+
+    def record_transfer(self, bytes_sent: int, bytes_received: int) -> None:
+        """Bytes moved by a call whose stdin/stdout are not the data, such as scp."""
+        record = getattr(self._current, 'record', None)
+        if record is not None:
+            record['bytes_sent'] += bytes_sent
+            record['bytes_received'] += bytes_received
+
+    def record_retry(self) -> None:
+        record = getattr(self._current, 'record', None)
+        if record is not None:
+            record['retries'] += 1
+
+    def record_failure(self, failure: str) -> None:
+        """Class of a call that failed after its retries, such as unreachable or
+        timeout. The phase keeps the class of its last failed call."""
+        record = getattr(self._current, 'record', None)
+        with self._lock:
+            self._failure_classes[failure] += 1
+            if record is not None:
+                key = (record['project'], record['zone'], record['instance'])
+                self._instance_failure_classes.setdefault(key, Counter())[failure] += 1
+        if record is not None:
+            record['failure'] = failure
+
+    def failure_classes(self) -> Dict[str, int]:
+        """Calls of the run that failed after their retries, by class."""
+        with self._lock:
+            return dict(self._failure_classes)
+
+    def instance_failures(self, project_id: str, instance: str) -> List[tuple]:
+        """(phase, failure class) of each of the instance's phases with a failed call."""
+        with self._lock:
+            return [(record['phase'], record['failure']) for record in self._phases
+                    if record['project'] == project_id and record['instance'] == instance and record['failure']]
+
+    def record_scan(self, project_id: str, zone: str, instance: str, **durations: float) -> None:
+        """Scan durations of an instance: host_seconds as measured by the scan script,
+        observed_seconds from the end of deployment until completion was detected and
+        first_detection_seconds until its first streamed finding was collected."""
+        with self._lock:
+            self._scans.setdefault((project_id, zone, instance), {}).update(durations)
+
+    def instance_metrics(self, project_id: str, zone: str, instance: str) -> Dict:
+        """The phases, scan durations and failed-call classes of one instance, as JSON-able
+        data for merge_instance() in another process, such as a coordinator."""
+        key = (project_id, zone, instance)
+        with self._lock:
+            return {
+                'project': project_id,
+                'zone': zone,
+                'instance': instance,
+                'phases': [record for record in self._phases
+                           if (record['project'], record['zone'], record['instance']) == key],
+                'scans': dict(self._scans.get(key, {})),
+                'failure_classes': dict(self._instance_failure_classes.get(key, {}))
+            }
+
+    def merge_instance(self, metrics: Dict) -> None:
+        """Add an instance's metrics recorded by another process (see instance_metrics)."""
+        key = (metrics['project'], metrics['zone'], metrics['instance'])
+        with self._lock:
+            self._phases.extend(metrics['phases'])
+            if metrics['scans']:
+                self._scans.setdefault(key, {}).update(metrics['scans'])
+            self._instance_failure_classes.setdefault(key, Counter()).update(metrics['failure_classes'])
+            self._failure_classes.update(metrics['failure_classes'])
+
+    def finish(self) -> None:
+        self.finished_at = time.time()
+
+    def timeline(self) -> Dict:
+        """Every phase of the run in start order, plus per-instance scan durations."""
+        with self._lock:
+            phases = sorted(self._phases, key=lambda record: record['started_at'])
+            scans = [dict(project=project_id, zone=zone, instance=instance, **durations)
+                     for (project_id, zone, instance), durations in sorted(self._scans.items())]
+        return {'started_at': self.started_at, 'finished_at': self.finished_at, 'phases': phases, 'scans': scans}
+
+    def write_timeline(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.timeline(), indent=1))
+
+    def _by_phase(self) -> Dict[str, List[Dict]]:
+        grouped = {}
+        with self._lock:
+            for record in self._phases:
+                grouped.setdefault(record['phase'], []).append(record)
+        return grouped
+
+    def phase_table(self) -> List[Dict]:
+        """Per phase: count, failed, total/mean/p95/max seconds and the summed counters."""
+        rows = []
+        for name, records in self._by_phase().items():
+            seconds = [record['finished_at'] - record['started_at'] for record in records]
+            row = {
+                'phase': name,
+                'count': len(records),
+                'failed': sum(not record['ok'] for record in records),
+                'total_seconds': sum(seconds),
+                'mean_seconds': sum(seconds) / len(seconds),
+                'p95_seconds': percentile(seconds, 0.95),
+                'max_seconds': max(seconds)
+            }
+            row.update((counter, sum(record[counter] for record in records)) for counter in COUNTERS)
+            rows.append(row)
+        return rows
+
+    def slowest_hosts(self, count: int) -> List[Dict]:
+        """The count instances with the longest time from the start of deployment to the
+        end of their last phase, with the seconds spent in each phase and scanning."""
+        hosts = {}
+        with self._lock:
+            for record in self._phases:
+                if not record['instance']:
+                    continue
+                key = (record['project'], record['zone'], record['instance'])
+                host = hosts.setdefault(key, {'started_at': record['started_at'], 'finished_at': 0, 'phases': {}})
+                host['started_at'] = min(host['started_at'], record['started_at'])
+                host['finished_at'] = max(host['finished_at'], record['finished_at'])
+                host['phases'][record['phase']] = (host['phases'].get(record['phase'], 0)
+                                                   + record['finished_at'] - record['started_at'])
+            scans = dict(self._scans)
+        rows = [
+            dict(project=project_id, zone=zone, instance=instance,
+                 total_seconds=host['finished_at'] - host['started_at'], phases=host['phases'],
+                 **scans.get((project_id, zone, instance), {}))
+            for (project_id, zone, instance), host in hosts.items()
+        ]
+        rows.sort(key=lambda row: row['total_seconds'], reverse=True)
+        return rows[:count]
+
+    def prometheus_text(self) -> str:
+        """The run's metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name: str, kind: str, description: str, samples):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{_label(value)}"' for key, value in labels.items())
+                series = f"{name}{suffix}{{{label_text}}}" if labels else f"{name}{suffix}"
+                lines.append(f"{series} {float(value)!r}")
+
+        def summary_samples(labels: Dict, values: List[float]):
+            for quantile in (0.5, 0.95, 0.99):
+                yield '', dict(labels, quantile=str(quantile)), percentile(values, quantile)
+            yield '_sum', labels, sum(values)
+            yield '_count', labels, len(values)
+
+        metric('ishield_run_start_time_seconds', 'gauge', 'Start of the last run as a Unix timestamp.',
+               [('', {}, self.started_at)])
+        metric('ishield_run_duration_seconds', 'gauge', 'Wall time of the last run.',
+               [('', {}, (self.finished_at or time.time()) - self.started_at)])
+        by_phase = self._by_phase()
+        metric('ishield_phase_duration_seconds', 'summary', 'Time spent in each lifecycle phase in the last run.',
+               [sample for name, records in sorted(by_phase.items())
+                for sample in summary_samples({'phase': name}, [r['finished_at'] - r['started_at'] for r in records])])
+        metric('ishield_phase_failed', 'gauge', 'Phases in the last run that raised or had a failed call.',
+               [('', {'phase': name}, sum(not r['ok'] for r in records)) for name, records in sorted(by_phase.items())])
+        for counter, description in (('calls', 'gcloud/ssh/scp calls'), ('failures', 'Failed gcloud/ssh/scp calls'),
+                                     ('retries', 'Retried gcloud/ssh/scp calls'), ('bytes_sent', 'Bytes sent'),
+                                     ('bytes_received', 'Bytes received')):
+            metric(f'ishield_phase_{counter}', 'gauge', f'{description} per lifecycle phase in the last run.',
+                   [('', {'phase': name}, sum(r[counter] for r in records)) for name, records in sorted(by_phase.items())])
+        failure_classes = self.failure_classes()
+        if failure_classes:
+            metric('ishield_call_failures', 'gauge', 'gcloud/ssh/scp calls that failed after their retries, by class, in the last run.',
+                   [('', {'class': name}, count) for name, count in sorted(failure_classes.items())])
+        with self._lock:
+            host_seconds = [scan['host_seconds'] for scan in self._scans.values() if 'host_seconds' in scan]
+        if host_seconds:
+            metric('ishield_scan_duration_seconds', 'summary', 'Scan duration measured on the instances in the last run.',
+                   summary_samples({}, host_seconds))
+        with self._lock:
+            first_detections = [scan['first_detection_seconds'] for scan in self._scans.values()
+                                if 'first_detection_seconds' in scan]
+        if first_detections:
+            metric('ishield_first_detection_seconds', 'summary',
+                   'Time from deployment to the first finding streamed from a running scan in the last run.',
+                   summary_samples({}, first_detections))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: Path) -> None:
+        """Write the node_exporter textfile atomically so it is never scraped half written."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(self.prometheus_text())
+        os.replace(tmp_path, path)
@@ -0,0 +1,152 @@
+import gzip
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Union
+
+# clamscan/clamdscan result lines: "<path>: <signature> FOUND", "<path>: <message> ERROR"
+# and "<path>: OK", "<path>: Empty file", "<path>: Symbolic link", ... Paths may contain ": ".
+FOUND_LINE = re.compile(r'^(/.*): (\S+) FOUND$')
+ERROR_LINE = re.compile(r'^(/.*?): (.*) ERROR$')
+STATUS_LINE = re.compile(r'^(/.*): ([^:]+)$')
+SUMMARY_START = '----------- SCAN SUMMARY -----------'
+# Prefix clamscan sees the instance's root filesystem under
+HOST_PREFIX = '/host'
+
+
+class FileResult(NamedTuple):
+    """One scanned (or skipped) file."""
+    path: str
+    status: str                 # OK, FOUND, ERROR or the skip reason, such as "Empty file"
+    signature: Optional[str]    # Signature name for FOUND, error message for ERROR
+
+
+class ScanSummary(NamedTuple):
+    """The SCAN SUMMARY block at the end of a clamscan log."""
+    known_viruses: Optional[int]
+    engine_version: Optional[str]
+    scanned_directories: Optional[int]
+    scanned_files: Optional[int]
+    infected_files: Optional[int]
+    data_scanned_mb: Optional[float]
+    data_read_mb: Optional[float]
+    seconds: Optional[float]
+    start_date: Optional[str]
+    end_date: Optional[str]
+
+
+ScanRecord = Union[FileResult, ScanSummary]
+
+
+def _megabytes(value: str) -> Optional[float]:
+    """"12.34 MB", "1.2 GiB (ratio 2.00:1)" -> megabytes. Units are matched on their
+    first letter, so binary (GiB, MiB, KiB) and decimal spellings both work."""
+    parts = value.split()
+    if len(parts) < 2:
+        return None
+    try:
+        number = float(parts[0])
+    except ValueError:
+        return None
+    return number * {'T': 1048576, 'G': 1024, 'K': 1 / 1024, 'B': 1 / 1048576}.get(parts[1][:1].upper(), 1)
+
+
+def _int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _summary(fields: Dict[str, str]) -> ScanSummary:
+    """Build a ScanSummary from "Name: value" pairs, keyed by lower_snake_case name."""
+    seconds = str(fields.get('time', '')).split(' ', 1)[0]
+    return ScanSummary(
+        known_viruses=_int(fields.get('known_viruses')),
+        engine_version=fields.get('engine_version'),
+        scanned_directories=_int(fields.get('scanned_directories')),
+        scanned_files=_int(fields.get('scanned_files')),
+        infected_files=_int(fields.get('infected_files')),
+        data_scanned_mb=_megabytes(str(fields.get('data_scanned', ''))),
+        data_read_mb=_megabytes(str(fields.get('data_read', ''))),
+        seconds=float(seconds) if re.fullmatch(r'[0-9]+(\.[0-9]+)?', seconds) else None,
+        start_date=fields.get('start_date'),
+        end_date=fields.get('end_date')
+    )
+
+
+def _file_result(line: str) -> Optional[FileResult]:
+    for pattern, status in ((FOUND_LINE, 'FOUND'), (ERROR_LINE, 'ERROR'), (STATUS_LINE, None)):
+        match = pattern.match(line)
+        if match is None:
+            continue
+        path, detail = match.groups()
+        if path.startswith(HOST_PREFIX + '/'):
+            path = path[len(HOST_PREFIX):]
+        return FileResult(path, status, detail) if status else FileResult(path, detail, None)
+    return None
+
+
+def parse_scan_log(lines: Iterable[str]) -> Iterator[ScanRecord]:
+    """Parse clamscan output line by line, yielding a FileResult per file and a
+    ScanSummary per SCAN SUMMARY block. Other lines (warnings, blank lines) are skipped."""
+    summary = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line == SUMMARY_START:
+            summary = {}
+            continue
+        if summary is not None:
+            name, sep, value = line.partition(':')
+            if sep:
+                summary[name.strip().lower().replace(' ', '_')] = value.strip()
+                if name == 'End Date':
+                    yield _summary(summary)
+                    summary = None
+            continue
+        record = _file_result(line)
+        if record is not None:
+            yield record
+    # A summary without End Date, for example from an interrupted merge
+    if summary:
+        yield _summary(summary)
+
+
+def open_scan_log(path: Path) -> Iterator[str]:
+    """Lines of a plain or gzip'd scan log, read lazily."""
+    opener = gzip.open if path.suffix == '.gz' else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        yield from f
+
+
+def records_from_summary(summary: Dict) -> Iterator[ScanRecord]:
+    """Records from the summary.json written by run_clamav_scan.sh, which only lists findings."""
+    for finding in summary.get('findings', []):
+        yield FileResult(finding.get('path', ''), 'FOUND', finding.get('signature'))
+    if summary.get('complete'):
+        yield _summary(summary.get('summary', {}))
+
+
+class InstanceResults:
+    """Aggregate of one instance's scan records, built in a single pass."""
+
+    def __init__(self, records: Iterable[ScanRecord]):
+        self.findings: List[FileResult] = []
+        self.errors = 0
+        self.files_ok = 0
+        self.summary: Optional[ScanSummary] = None
+        self.signatures = Counter()
+        for record in records:
+            if isinstance(record, ScanSummary):
+                self.summary = record
+            elif record.status == 'FOUND':
+                self.findings.append(record)
+                self.signatures[record.signature] += 1
+            elif record.status == 'ERROR':
+                self.errors += 1
+            elif record.status == 'OK':
+                self.files_ok += 1
+
+    @property
+    def complete(self) -> bool:
+        return self.summary is not None
@@ -0,0 +1,179 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS queue (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    run_id INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    staging TEXT                           -- JSON of the scan assets the coordinator staged, if any
+);
+CREATE TABLE IF NOT EXISTS work (
+    project TEXT NOT NULL,
+    zone TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    state TEXT NOT NULL,                   -- pending, leased, done or failed
+    worker TEXT,
+    lease_expires REAL,
+    leases INTEGER NOT NULL DEFAULT 0,     -- times the instance was handed to a worker
+    fragment TEXT,                         -- report fragment JSON of the worker that finished it
+    metrics TEXT,                          -- JSON of the worker's run metrics of the instance
+    finished_at REAL,
+    finished_seq INTEGER,                  -- order in which instances finished, across workers
+    PRIMARY KEY (project, zone, instance)
+);
+CREATE INDEX IF NOT EXISTS work_by_state ON work (state, lease_expires);
+'''
+
+Target = Tuple[str, str, str]   # project, zone, instance
+
+
+class WorkQueue:
+    """Shared SQLite queue of the instances of a coordinated run.
+
+    A coordinator fills it; workers in other processes or on other hosts lease
+    instances from it, renew their leases while they run the scan lifecycle and
+    mark each instance done or failed. A lease that is not renewed in time
+    expires and the instance is handed to the next worker that asks.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        # Transactions are explicit so leasing takes the write lock before it reads
+        self._db = sqlite3.connect(str(path), timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        # Queues created before staging and metrics were passed through them
+        if 'staging' not in [row[1] for row in self._db.execute('PRAGMA table_info(queue)')]:
+            self._db.execute('ALTER TABLE queue ADD COLUMN staging TEXT')
+        if 'metrics' not in [row[1] for row in self._db.execute('PRAGMA table_info(work)')]:
+            self._db.execute('ALTER TABLE work ADD COLUMN metrics TEXT')
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def fill(self, run_id: int, targets: Iterable[Target], staging: Optional[Dict] = None) -> None:
+        """Start a new coordinated run with targets pending, replacing the previous one.
+        staging describes the scan assets staged for the run, for the workers to use."""
+        with self._transaction() as db:
+            db.execute('DELETE FROM work')
+            db.execute('INSERT OR REPLACE INTO queue (id, run_id, created_at, staging) VALUES (1, ?, ?, ?)',
+                       (run_id, time.time(), json.dumps(staging) if staging is not None else None))
+            db.executemany("INSERT OR IGNORE INTO work (project, zone, instance, state) VALUES (?, ?, ?, 'pending')",
+                           targets)
+
+    def run(self) -> Optional[Dict]:
+        """{'run_id', 'created_at', 'staging'} of the queued run, or None before a coordinator filled the queue."""
+        with self._lock:
+            row = self._db.execute('SELECT run_id, created_at, staging FROM queue WHERE id = 1').fetchone()
+        if row is None:
+            return None
+        return {'run_id': row[0], 'created_at': row[1], 'staging': json.loads(row[2]) if row[2] else None}
+
+    def lease(self, worker: str, count: int, lease_seconds: float, max_leases: int) -> List[Tuple[Target, int]]:
+        """Lease up to count pending instances, or instances whose lease expired, to worker.
+        Returns (target, leases) pairs; leases > 1 means an earlier worker held the instance.
+        Instances already leased max_leases times are marked failed instead."""
+        now = time.time()
+        leased = []
+        with self._transaction() as db:
+            while len(leased) < count:
+                rows = db.execute(
+                    "SELECT project, zone, instance, leases FROM work "
+                    "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                    "ORDER BY leases, rowid LIMIT ?",
+                    (now, count - len(leased))
+                ).fetchall()
+                if not rows:
+                    break
+                for project, zone, instance, leases in rows:
+                    if leases >= max_leases:
+                        db.execute("UPDATE work SET state = 'failed', worker = NULL, finished_at = ? "
+                                   "WHERE project = ? AND zone = ? AND instance = ?", (now, project, zone, instance))
+                        continue
+                    db.execute("UPDATE work SET state = 'leased', worker = ?, lease_expires = ?, leases = leases + 1 "
+                               "WHERE project = ? AND zone = ? AND instance = ?",
+                               (worker, now + lease_seconds, project, zone, instance))
+                    leased.append(((project, zone, instance), leases + 1))
+        return leased
+
+    def heartbeat(self, worker: str, targets: Iterable[Target], lease_seconds: float) -> List[Target]:
+        """Renew worker's leases on targets. Returns the targets it no longer holds."""
+        lost = []
+        with self._transaction() as db:
+            for target in targets:
+                cursor = db.execute(
+                    "UPDATE work SET lease_expires = ? "
+                    "WHERE project = ? AND zone = ? AND instance = ? AND state = 'leased' AND worker = ?",
+                    (time.time() + lease_seconds, *target, worker)
+                )
+                if cursor.rowcount == 0:
+                    lost.append(target)
+        return lost
+
+    def finish(self, worker: str, target: Target, ok: bool, fragment: Optional[Dict] = None,
+               metrics: Optional[Dict] = None) -> bool:
+        """Mark an instance leased by worker done (or failed), with its report fragment and
+        the worker's metrics of it. False if the lease had passed to another worker, which
+        now owns the instance."""
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE work SET state = ?, fragment = ?, metrics = ?, finished_at = ?, lease_expires = NULL, "
+                "finished_seq = (SELECT COALESCE(MAX(finished_seq), 0) + 1 FROM work) "
+                "WHERE project = ? AND zone = ? AND instance = ? AND state = 'leased' AND worker = ?",
+                ('done' if ok else 'failed', json.dumps(fragment) if fragment is not None else None,
+                 json.dumps(metrics) if metrics is not None else None, time.time(), *target, worker)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, worker: str) -> int:
+        """Return worker's leases to the queue, such as when it shuts down, so another worker
+        takes them over without waiting for them to expire. Returns how many."""
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE work SET state = 'pending', worker = NULL, lease_expires = NULL "
+                                "WHERE state = 'leased' AND worker = ?", (worker,))
+        return cursor.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """Instances per state, plus 'workers' currently holding leases."""
+        with self._lock:
+            counts = dict.fromkeys(('pending', 'leased', 'done', 'failed'), 0)
+            counts.update(self._db.execute('SELECT state, COUNT(*) FROM work GROUP BY state').fetchall())
+            counts['workers'] = self._db.execute(
+                "SELECT COUNT(DISTINCT worker) FROM work WHERE state = 'leased'").fetchone()[0]
+        return counts
+
+    def drained(self) -> bool:
+        """True once the queue was filled and every instance is done or failed."""
+        counts = self.counts()
+        return self.run() is not None and counts['pending'] + counts['leased'] == 0
+
+    def targets(self) -> List[Target]:
+        with self._lock:
+            return [tuple(row) for row in self._db.execute('SELECT project, zone, instance FROM work ORDER BY rowid')]
+
+    def fragments(self, after: int = 0) -> Tuple[List[Dict], List[Dict], int]:
+        """Report fragments and worker metrics of the instances finished after position
+        after, and the position to pass next time to get only the ones finished since."""
+        with self._lock:
+            rows = self._db.execute('SELECT finished_seq, fragment, metrics FROM work WHERE finished_seq > ? '
+                                    'ORDER BY finished_seq', (after,)).fetchall()
+        fragments = [json.loads(fragment) for _, fragment, _ in rows if fragment is not None]
+        metrics = [json.loads(instance_metrics) for _, _, instance_metrics in rows if instance_metrics is not None]
+        return fragments, metrics, rows[-1][0] if rows else after
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()